@@ -28,7 +28,7 @@ from kwiklib.dataio.tools import get_array
 from kwiklib.dataio import KlustersLoader, KwikLoader, read_clusters
 from klustaviewa.gui.buffer import Buffer
 from klustaviewa.gui.dock import ViewDockWidget, DockTitleBar
-from klustaviewa.stats.cache import StatsCache
+from klustaviewa.stats.cache import StatsCache, get_cluster_hashes
 from klustaviewa.stats.correlograms import NCORRBINS_DEFAULT, CORRBIN_DEFAULT
 from klustaviewa.stats.correlations import normalize
 from kwiklib.utils import logger as log
@@ -153,7 +153,8 @@ class MainWindow(QtGui.QMainWindow):
         # QtGui.QApplication.setOverrideCursor(self.normal_cursor)
         QtGui.QApplication.restoreOverrideCursor()
     
-    def set_busy(self, computing_correlograms=None, computing_matrix=None):
+    def set_busy(self, computing_correlograms=None, computing_matrix=None,
+            message=None):
         if computing_correlograms is not None:
             self.computing_correlograms = computing_correlograms
         if computing_matrix is not None:
@@ -162,9 +163,13 @@ class MainWindow(QtGui.QMainWindow):
         if busy:
             self.set_busy_cursor()
             self.is_busy = True
+            # Progress of long computations.
+            if message is not None:
+                self.statusBar().showMessage(message)
         else:
             self.set_normal_cursor()
             self.is_busy = False
+            self.statusBar().clearMessage()
     
     def initialize_view_logger(self):
         # Initialize the view logger.
@@ -595,6 +600,8 @@ class MainWindow(QtGui.QMainWindow):
             select=self.get_view('ClusterView').select,
             loader=self.loader,
             stats=self.statscache,
+            cache_counters=(self.statscache.counters 
+                if self.statscache is not None else None),
             wizard=self.wizard,
             )
         view.set_data(**namespace)
@@ -746,6 +753,7 @@ class MainWindow(QtGui.QMainWindow):
         if path:
             # Launch the loading task in the background asynchronously.
             self._path = path
+            self.save_statscache()
             self.open_task.open(self.loader, path)
             # Save the folder.
             folder = os.path.dirname(path)
@@ -780,6 +788,7 @@ class MainWindow(QtGui.QMainWindow):
             self.loader.copy_clustering(clustering_from=clustering_name, 
                                         clustering_to='main')
             # Reload the file.
+            self.save_statscache()
             self.loader.close()
             self.open_task.open(self.loader, self._path)
         # elif reply == QtGui.QMessageBox.Cancel:
@@ -811,6 +820,7 @@ class MainWindow(QtGui.QMainWindow):
         self.clear_view('CorrelogramsView')
         self.clear_view('TraceView')
 
+        self.save_statscache()
         self.loader.close()
         self.is_file_open = False
         
@@ -823,6 +833,7 @@ class MainWindow(QtGui.QMainWindow):
             1)
         if ok:
             if shank in self.loader.shanks:
+                self.save_statscache()
                 self.loader.set_shank(shank)
                 self.open_done()
             else:
@@ -872,11 +883,18 @@ class MainWindow(QtGui.QMainWindow):
         self.controller = Controller(self.loader)
         # Create the cache for the cluster statistics that need to be
         # computed in the background.
-        self.statscache = StatsCache(SETTINGS.get('correlograms.ncorrbins', NCORRBINS_DEFAULT))
+        self.statscache = StatsCache(
+            *self.taskgraph.get_correlograms_base_binning(self.loader.freq),
+            similarity_sparse=USERPREF.get('similarity_matrix_sparse', False),
+            max_memory=USERPREF.get('correlograms_max_memory', 1e9))
+        # Restore the correlograms of the unchanged clusters from the
+        # previous session.
+        self.load_statscache()
         # Update stats cache in IPython view.
         ipython = self.get_view('IPythonView')
         if ipython:
-            ipython.set_data(stats=self.statscache)
+            ipython.set_data(stats=self.statscache,
+                cache_counters=self.statscache.counters)
         
         # Initialize the wizard.
         self.wizard = Wizard()
@@ -969,6 +987,50 @@ class MainWindow(QtGui.QMainWindow):
         self.taskgraph.override_color(self.override_color)
     
     
+    # Correlograms cache.
+    # -------------------
+    def get_statscache_filename(self):
+        """Return the file next to the experiment where the correlograms
+        of the current shank are saved."""
+        return '{0:s}.correlograms.{1:d}.npz'.format(
+            os.path.splitext(self.loader.filename)[0], self.loader.shank)
+    
+    def get_statscache_params(self):
+        """Return the parameters the cached correlograms depend on."""
+        return dict(
+            ncorrbins=self.statscache.ncorrbins,
+            corrbin=self.statscache.corrbin,
+            nexcerpts=USERPREF.get('correlograms_nexcerpts', 100),
+            excerpt_size=USERPREF.get('correlograms_excerpt_size', 20000),
+            )
+    
+    def load_statscache(self):
+        if not USERPREF.get('correlograms_persistent', True):
+            return
+        filename = self.get_statscache_filename()
+        clusters = get_array(self.loader.get_clusters('all'))
+        try:
+            if self.statscache.load(filename, get_cluster_hashes(clusters),
+                    **self.get_statscache_params()):
+                log.debug("Correlograms loaded from {0:s}.".format(filename))
+        except Exception as e:
+            log.warn("Unable to load the correlograms from {0:s}: {1:s}".
+                format(filename, str(e)))
+    
+    def save_statscache(self):
+        if (not USERPREF.get('correlograms_persistent', True) or
+                not self.is_file_open or self.statscache is None):
+            return
+        filename = self.get_statscache_filename()
+        clusters = get_array(self.loader.get_clusters('all'))
+        try:
+            self.statscache.save(filename, get_cluster_hashes(clusters),
+                **self.get_statscache_params())
+        except Exception as e:
+            log.warn("Unable to save the correlograms to {0:s}: {1:s}".
+                format(filename, str(e)))
+    
+    
     # Correlograms callbacks.
     # -----------------------
     def change_ncorrbins_callback(self, checked=None):
@@ -1251,6 +1313,9 @@ class MainWindow(QtGui.QMainWindow):
         # End the threads.
         self.join_threads()
         
+        # Save the correlograms for the next session.
+        self.save_statscache()
+        
         # Close the loader.
         self.loader.close()
         
@@ -0,0 +1,173 @@
+"""Arrays shared with external processes through memory-mapped files.
+
+The files are created in the POSIX shared memory filesystem when it is
+available, so that the arrays never touch the disk.
+
+"""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+import tempfile
+
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        # The file may still be mapped by another process on Windows.
+        pass
+
+def get_shared_dirname():
+    """Return the directory where the shared arrays are created: the POSIX
+    shared memory filesystem if possible, the temporary directory
+    otherwise."""
+    dirname = '/dev/shm'
+    if os.path.isdir(dirname) and os.access(dirname, os.W_OK):
+        return dirname
+    return None
+
+
+# -----------------------------------------------------------------------------
+# Shared arrays
+# -----------------------------------------------------------------------------
+class SharedArray(object):
+    """Picklable handle to an array stored in a memory-mapped file.
+
+    Only the filename, dtype and shape are pickled when the handle is sent
+    to an external process, where the array is mapped again without any
+    copy.
+
+    """
+    def __init__(self, filename, dtype, shape, group=None):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.group = group
+        self._array = None
+
+    @staticmethod
+    def create(array, dirname=None, group=None):
+        """Copy an array into a new memory-mapped file."""
+        array = np.asarray(array)
+        if dirname is None:
+            dirname = get_shared_dirname()
+        fd, filename = tempfile.mkstemp(suffix='.dat',
+            prefix='klustaviewa_', dir=dirname)
+        os.close(fd)
+        shared = SharedArray(filename, array.dtype, array.shape, group=group)
+        if array.size > 0:
+            mm = np.memmap(filename, dtype=array.dtype, mode='w+',
+                shape=array.shape)
+            mm[...] = array
+            mm.flush()
+            del mm
+        return shared
+
+    @property
+    def array(self):
+        """Read-only view on the shared array, mapped at the first access."""
+        if self._array is None:
+            if int(np.prod(self.shape)) == 0:
+                self._array = np.zeros(self.shape, dtype=self.dtype)
+            else:
+                self._array = np.memmap(self.filename, dtype=self.dtype,
+                    mode='r', shape=self.shape)
+        return self._array
+
+    def delete(self):
+        """Delete the underlying file. The array must not be accessed
+        anymore in any process."""
+        self._array = None
+        _remove(self.filename)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+    def __repr__(self):
+        return '<SharedArray {0:s} {1:s} {2:s}>'.format(str(self.shape),
+            str(self.dtype), self.filename)
+
+
+def as_array(x):
+    """Return the array of a shared array, or the object itself."""
+    if isinstance(x, SharedArray):
+        return x.array
+    return x
+
+
+# -----------------------------------------------------------------------------
+# Temporary shared arrays
+# -----------------------------------------------------------------------------
+# Temporary shared arrays in every group, in creation order.
+_TEMPORARY = {}
+# Shared arrays waiting for the tasks of some groups to be done before being
+# deleted: (shared array, {group: last temporary array of the group}).
+_DISPOSED = []
+
+def share_temporary(array, group):
+    """Copy an array passed to a task into a new shared array.
+
+    The tasks of a group must be processed in order: when a task is done,
+    `release_temporary` deletes its shared array along with those of the
+    previous tasks of the group, including the tasks that were skipped.
+
+    """
+    shared = SharedArray.create(array, group=group)
+    _TEMPORARY.setdefault(group, []).append(shared.filename)
+    return shared
+
+def release_temporary(shared):
+    """Delete a temporary shared array, and all shared arrays of the same
+    group created before it."""
+    if not isinstance(shared, SharedArray):
+        return
+    filenames = _TEMPORARY.get(shared.group, [])
+    if shared.filename not in filenames:
+        return
+    n = filenames.index(shared.filename) + 1
+    for filename in filenames[:n]:
+        _remove(filename)
+    del filenames[:n]
+    _delete_disposed()
+
+def release_all_temporary():
+    """Delete all temporary shared arrays, and the disposed shared
+    arrays."""
+    for group, filenames in _TEMPORARY.iteritems():
+        for filename in filenames:
+            _remove(filename)
+    _TEMPORARY.clear()
+    _delete_disposed()
+
+def dispose(shared, groups):
+    """Delete a shared array once the tasks of the given groups queued so
+    far are done, i.e. once their temporary shared arrays have been
+    released. The array is deleted immediately if there are no such
+    tasks."""
+    if shared is None:
+        return
+    pending = dict((group, _TEMPORARY[group][-1]) for group in groups
+        if _TEMPORARY.get(group))
+    _DISPOSED.append((shared, pending))
+    _delete_disposed()
+
+def _delete_disposed():
+    for item in list(_DISPOSED):
+        shared, pending = item
+        if all(filename not in _TEMPORARY.get(group, [])
+            for group, filename in pending.iteritems()):
+            shared.delete()
+            _DISPOSED.remove(item)
+
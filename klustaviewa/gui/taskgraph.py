@@ -10,13 +10,14 @@ from qtools import inthread, inprocess
 from qtools import QtGui, QtCore
 
 from kwiklib.dataio import get_array, pandaize
-from klustaviewa.stats.correlations import normalize
-from klustaviewa.stats.correlograms import get_baselines, get_excerpts
+from klustaviewa.stats.correlograms import get_baselines, get_base_binning
 from kwiklib.utils import logger as log
 from klustaviewa import USERPREF
 from klustaviewa import SETTINGS
 from kwiklib.utils.colors import random_color
 from klustaviewa.gui.threads import ThreadedTasks
+from klustaviewa.gui.sharedmem import (SharedArray, share_temporary,
+    release_all_temporary, dispose)
 import klustaviewa.views.viewdata as vd
 
 
@@ -80,6 +81,17 @@ class AbstractTaskGraph(QtCore.QObject):
 # -----------------------------------------------------------------------------
 class TaskGraph(AbstractTaskGraph):
     def __init__(self, mainwindow):
+        # Incremented whenever the cached statistics are invalidated, so
+        # that stale background computations are discarded.
+        self.cache_generation = 0
+        # Whether a batch of correlograms is being computed in the
+        # background.
+        self.precomputing = False
+        # Arrays shared with the external processes, created once per
+        # session: spike times, and subset of the features used for the
+        # similarity matrix.
+        self.shared_spiketimes = None
+        self.background = None
         # Shortcuts for the main window.
         self.set(mainwindow)
         # Create external threads/processes for long-lasting tasks.
@@ -95,6 +107,9 @@ class TaskGraph(AbstractTaskGraph):
         self.wizard = self.mainwindow.wizard
         self.controller = self.mainwindow.controller
         self.statscache = self.mainwindow.statscache
+        self.cache_generation += 1
+        # The file or the shank may have changed.
+        self.clear_shared()
         
     def create_threads(self):
         # Create the external threads.
@@ -106,11 +121,19 @@ class TaskGraph(AbstractTaskGraph):
             self.recluster_done_callback)
         self.tasks.correlograms_task.correlogramsComputed.connect(
             self.correlograms_computed_callback)
+        self.tasks.correlograms_stream_task.correlogramsComputed.connect(
+            self.correlograms_computed_callback)
+        self.tasks.correlograms_stream_task.correlogramsProgress.connect(
+            self.correlograms_progress_callback)
+        self.tasks.correlograms_background_task.correlogramsComputed.connect(
+            self.correlograms_precomputed_callback)
         self.tasks.similarity_matrix_task.correlationMatrixComputed.connect(
             self.similarity_matrix_computed_callback)
     
     def join(self):
          self.tasks.join()
+         self.clear_shared()
+         release_all_temporary()
         
 
     # Selection.
@@ -153,6 +176,16 @@ class TaskGraph(AbstractTaskGraph):
         # (which handles the graph dependency).
         self.correlograms_computed(clusters, correlograms, ncorrbins, corrbin, wizard)
         
+    def correlograms_precomputed_callback(self, clusters, correlograms, 
+            ncorrbins, corrbin, wizard):
+        self.correlograms_precomputed(clusters, correlograms, ncorrbins, 
+            corrbin)
+        
+    def correlograms_progress_callback(self, progress, progress_max):
+        self.mainwindow.set_busy(computing_correlograms=True,
+            message="Computing correlograms ({0:d}%)...".format(
+                int(100. * progress / max(progress_max, 1))))
+        
     def similarity_matrix_computed_callback(self, clusters_selected, matrix, 
         clusters, cluster_groups, target_next=None):
         # Execute the callback function under the control of the task manager
@@ -163,48 +196,162 @@ class TaskGraph(AbstractTaskGraph):
         
     # Computations.
     # -------------
-    def _compute_correlograms(self, clusters_selected, wizard=None):
-        # Get the correlograms parameters.
-        spiketimes = get_array(self.loader.get_spiketimes('all'))
-        # print spiketimes.dtype
+    def get_spiketimes(self):
+        # Spike times in samples, as stored in the file: the correlograms
+        # are computed with integer arithmetic, without conversion.
+        return self.experiment.channel_groups[self.loader.shank].\
+            spikes.concatenated_time_samples[:]
+    
+    def get_shared_spiketimes(self):
+        """Return the spike times in an array shared with the correlograms
+        tasks, created once per session."""
+        if self.shared_spiketimes is None:
+            self.shared_spiketimes = SharedArray.create(self.get_spiketimes())
+        return self.shared_spiketimes
+    
+    def get_correlograms_data(self, group):
+        """Return the spike times and the spike clusters used to compute the
+        correlograms, shared with the task processes, and the keyword
+        arguments specifying the excerpts."""
+        spiketimes = self.get_shared_spiketimes()
         # Make a copy of the array so that it does not change before the
-        # computation of the correlograms begins.
-        clusters = np.array(get_array(self.loader.get_clusters('all')))
+        # computation of the correlograms begins. It is deleted once the
+        # task is done.
+        clusters = share_temporary(get_array(self.loader.get_clusters('all')),
+            group)
 
         # Get excerpts
         nexcerpts = USERPREF.get('correlograms_nexcerpts', 100)
         excerpt_size = USERPREF.get('correlograms_excerpt_size', 20000)
-        spiketimes_excerpts = get_excerpts(spiketimes, 
-            nexcerpts=nexcerpts, excerpt_size=excerpt_size)
-        clusters_excerpts = get_excerpts(clusters, 
-            nexcerpts=nexcerpts, excerpt_size=excerpt_size)
-
+        return spiketimes, clusters, dict(nexcerpts=nexcerpts, 
+            excerpt_size=excerpt_size)
+    
+    def get_correlograms_binning(self, freq=None):
+        """Return the number of bins, and the bin size in samples, of the
+        displayed correlograms."""
+        if freq is None:
+            freq = self.loader.freq
         # corrbin = self.loader.corrbin
         # ncorrbins = self.loader.ncorrbins
         corrbin = SETTINGS.get('correlograms.corrbin', .001)
         ncorrbins = SETTINGS.get('correlograms.ncorrbins', 100)
+        # Bin size in samples.
+        corrbin_samples = max(1, int(round(corrbin * freq)))
+        return ncorrbins, corrbin_samples
+    
+    def get_correlograms_base_binning(self, freq=None):
+        """Return the binning of the computed correlograms: the finest bins
+        and the widest window, so that changing the displayed binning does
+        not require any new computation. The cached correlograms take as
+        many times the memory of the displayed ones as they have more bins:
+        twice by default (1 ms bins in a 100 ms half-window)."""
+        if freq is None:
+            freq = self.loader.freq
+        ncorrbins, corrbin = self.get_correlograms_binning(freq)
+        corrbin_base = max(1, int(round(
+            USERPREF.get('correlograms_base_corrbin', .001) * freq)))
+        halfwidth_base = USERPREF.get('correlograms_base_halfwidth', .1)
+        ncorrbins_base = 2 * int(np.ceil(halfwidth_base * freq / 
+            corrbin_base))
+        return get_base_binning(ncorrbins, corrbin, 
+            corrbin_base=corrbin_base, ncorrbins_base=ncorrbins_base)
+    
+    def get_correlograms_parameters(self):
+        """Return the number of bins, and the bin size in samples, of the
+        correlograms to compute."""
+        return self.statscache.ncorrbins, self.statscache.corrbin
+    
+    def _compute_correlograms(self, clusters_selected, wizard=None):
+        # Get the correlograms parameters.
+        # Number of processes computing the correlograms in parallel (all
+        # cores by default).
+        nprocesses = USERPREF.get('correlograms_nprocesses', None)
+        ncorrbins, corrbin_samples = self.get_correlograms_parameters()
         
         # Get cluster indices that need to be updated.
-        clusters_to_update = (self.statscache.correlograms.
-            not_in_key_indices(clusters_selected))
+        clusters_to_update = self.statscache.get_correlograms_to_update(
+            clusters_selected)
+        # The selected clusters come first: abandon the batch being
+        # precomputed in the background, it is resumed afterwards.
+        if len(clusters_to_update) > 0 and self.precomputing:
+            self.tasks.cancel_background_correlograms()
             
         # If there are pairs that need to be updated, launch the task.
-        if len(clusters_to_update) > 0:
+        if len(clusters_to_update) > 0 and USERPREF.get(
+                'correlograms_full_recording', False):
+            # Set wait cursor.
+            self.mainwindow.set_busy(computing_correlograms=True)
+            # Use the whole recording, instead of excerpts. This is not
+            # out-of-core: the spike times and clusters are already in
+            # memory (kwiklib loads them when the file is opened), and only
+            # the computation is done chunk after chunk, with a bounded
+            # working memory. The task gets a copy of the spike clusters,
+            # which may change during the computation.
+            self.tasks.correlograms_stream_task.compute(
+                self.get_spiketimes(),
+                get_array(self.loader.get_clusters('all'), copy=True),
+                clusters_to_update=clusters_to_update,
+                clusters_unique=get_array(self.loader.get_clusters_unique()),
+                clusters_selected=clusters_selected,
+                ncorrbins=ncorrbins, corrbin=corrbin_samples,
+                wizard=wizard)
+        elif len(clusters_to_update) > 0:
             # Set wait cursor.
             self.mainwindow.set_busy(computing_correlograms=True)
             # Launch the task.
+            spiketimes, clusters, excerpts = self.get_correlograms_data(
+                'correlograms')
             self.tasks.correlograms_task.compute(
-                spiketimes_excerpts, 
-                clusters_excerpts,
+                spiketimes, 
+                clusters,
                 clusters_to_update=clusters_to_update, 
                 clusters_selected=clusters_selected,
-                ncorrbins=ncorrbins, corrbin=corrbin,
-                wizard=wizard)    
+                ncorrbins=ncorrbins, corrbin=corrbin_samples,
+                nprocesses=nprocesses,
+                wizard=wizard, **excerpts)    
         # Otherwise, update directly the correlograms view without launching
         # the task in the external process.
         else:
             # self.update_correlograms_view()
-            return ('_update_correlograms_view', (wizard,), {})
+            return [('_update_correlograms_view', (wizard,), {}),
+                    ('_precompute_correlograms',),
+                    ]
+    
+    def _precompute_correlograms(self):
+        """Compute in the background the correlograms of the clusters the
+        wizard is likely to show next, by small batches, as long as the
+        correlograms of the selected clusters are not being computed."""
+        if (not USERPREF.get('correlograms_precompute', True) or
+            USERPREF.get('correlograms_full_recording', False)):
+            return
+        # Only one batch at a time, and the selected clusters first.
+        if self.precomputing or self.mainwindow.computing_correlograms:
+            return
+        nclusters = USERPREF.get('correlograms_precompute_nclusters', 20)
+        batch_size = USERPREF.get('correlograms_precompute_batch_size', 4)
+        clusters = self.wizard.upcoming_clusters()[:nclusters]
+        # Keep the wizard order.
+        clusters_missing = set(self.statscache.correlograms.
+            not_in_key_indices(clusters))
+        clusters_to_update = [cluster for cluster in clusters 
+            if cluster in clusters_missing][:batch_size]
+        if len(clusters_to_update) == 0:
+            return
+        log.debug("Precomputing correlograms for clusters {0:s}.".format(
+            str(clusters_to_update)))
+        spiketimes, clusters, excerpts = self.get_correlograms_data(
+            'correlograms_background')
+        ncorrbins, corrbin_samples = self.get_correlograms_parameters()
+        self.precomputing = True
+        self.precompute_generation = self.cache_generation
+        self.tasks.cancel_background_correlograms(False)
+        self.tasks.correlograms_background_task.compute(
+            spiketimes, 
+            clusters,
+            clusters_to_update=clusters_to_update, 
+            clusters_selected=clusters_to_update,
+            ncorrbins=ncorrbins, corrbin=corrbin_samples,
+            nprocesses=1, **excerpts)
     
     def _recluster(self):
         exp = self.loader.experiment
@@ -217,6 +364,39 @@ class TaskGraph(AbstractTaskGraph):
                         spikes=None, clu=None, wizard=False):
         return [('_split2', (spikes, clu, wizard))]
 
+    def get_background(self):
+        """Return the spikes, features and masks used for the similarity
+        matrix. They are loaded from the file once per session and put in
+        memory-mapped files, so that the similarity matrix task can read
+        them without any copy."""
+        if self.background is None:
+            spikes_data = (self.experiment.channel_groups[self.loader.shank].
+                spikes)
+            spikes_selected, fm = spikes_data.load_features_masks(
+                fraction=.1)
+            fm = np.atleast_3d(fm)
+            features = SharedArray.create(fm[:, :, 0])
+            # masks = fm[:, ::fetdim, 1]
+            if fm.shape[2] > 1:
+                masks = SharedArray.create(fm[:, :, 1])
+            else:
+                masks = None
+            self.background = (spikes_selected, features, masks)
+        return self.background
+        
+    def clear_shared(self):
+        """Delete the arrays shared with the external processes during the
+        session, once the tasks already queued are done with them."""
+        if self.shared_spiketimes is not None:
+            dispose(self.shared_spiketimes, 
+                ['correlograms', 'correlograms_background'])
+            self.shared_spiketimes = None
+        if self.background is not None:
+            _, features, masks = self.background
+            dispose(features, ['similarity_matrix'])
+            dispose(masks, ['similarity_matrix'])
+            self.background = None
+    
     def _compute_similarity_matrix(self, target_next=None):
         # TODO: get_similarity_matrix_data in viewdata
         # return
@@ -241,21 +421,13 @@ class TaskGraph(AbstractTaskGraph):
         cluster_groups = pd.Series([clusters_data[cl].cluster_group or 0
                                    for cl in clusters_all], index=clusters_all)
                        
-        spikes_selected, fm = spikes_data.load_features_masks(fraction=.1)  
+        # Only the cluster labels are reloaded after every action.
+        spikes_selected, features, masks = self.get_background()
         clusters = getattr(spikes_data.clusters, clustering)[:][spikes_selected] 
         
-        fm = np.atleast_3d(fm)
-        features = fm[:, :, 0]
-        
         if features.shape[1] <= 1:
             return []
         
-        # masks = fm[:, ::fetdim, 1]
-        if fm.shape[2] > 1:
-            masks = fm[:, :, 1]
-        else:
-            masks = None
-        
         # features = pandaize(features, spikes_selected)
         # masks = pandaize(masks, spikes_selected)
         
@@ -273,10 +445,15 @@ class TaskGraph(AbstractTaskGraph):
         # If there are pairs that need to be updated, launch the task.
         if len(clusters_to_update) > 0:
             self.mainwindow.set_busy(computing_matrix=True)
+            # The task gets its own copy of the spike clusters, which is
+            # deleted once it is done.
+            clusters = share_temporary(clusters, 'similarity_matrix')
             # Launch the task.
             self.tasks.similarity_matrix_task.compute(features,
                 clusters, cluster_groups, masks, clusters_to_update,
-                target_next=target_next, similarity_measure=similarity_measure)
+                target_next=target_next, similarity_measure=similarity_measure,
+                spikes=spikes_selected,
+                lean=USERPREF.get('similarity_matrix_lean', False))
         # Otherwise, update directly the correlograms view without launching
         # the task in the external process.
         else:
@@ -290,20 +467,50 @@ class TaskGraph(AbstractTaskGraph):
         # correlograms.
         # Reset the cursor.
         self.mainwindow.set_busy(computing_correlograms=False)
+        if isinstance(correlograms, Exception):
+            log.warn("The correlograms could not be computed: {0:s}.".format(
+                str(correlograms)))
+            return
         if not np.array_equal(clusters, clusters_selected):
             log.debug("Skip update correlograms with clusters selected={0:s}"
             " and clusters updated={1:s}.".format(clusters_selected, clusters))
             return
-        if self.statscache.ncorrbins != ncorrbins:
-            log.debug(("Skip updating correlograms because ncorrbins has "
-                "changed (from {0:d} to {1:d})".format(
+        if (self.statscache.ncorrbins != ncorrbins or 
+            self.statscache.corrbin != corrbin):
+            log.debug(("Skip updating correlograms because the binning has "
+                "changed (from {0:d} to {1:d} bins)".format(
                 ncorrbins, self.statscache.ncorrbins)))
             return
         # Put the computed correlograms in the cache.
-        self.statscache.correlograms.update(clusters, correlograms)
+        self.statscache.update_correlograms(clusters, correlograms)
         # Update the view.
         # self.update_correlograms_view()
-        return ('_update_correlograms_view', (), dict(wizard=wizard))
+        return [('_update_correlograms_view', (), dict(wizard=wizard)),
+                ('_precompute_correlograms',),
+                ]
+        
+    def _correlograms_precomputed(self, clusters, correlograms, ncorrbins,
+            corrbin):
+        self.precomputing = False
+        if isinstance(correlograms, Exception):
+            log.warn("The correlograms could not be precomputed: "
+                "{0:s}.".format(str(correlograms)))
+            return
+        if correlograms is None:
+            log.debug("Cancelled the precomputation of the correlograms for "
+                "clusters {0:s}.".format(str(list(clusters))))
+            return ('_precompute_correlograms',)
+        # Discard the correlograms if the clusters or the parameters have
+        # changed during the computation.
+        if (self.precompute_generation != self.cache_generation or
+            self.statscache.ncorrbins != ncorrbins or
+            self.statscache.corrbin != corrbin):
+            log.debug("Discard the correlograms precomputed for clusters "
+                "{0:s}.".format(str(list(clusters))))
+        elif len(correlograms) > 0:
+            self.statscache.update_correlograms(clusters, correlograms)
+        # Next batch.
+        return ('_precompute_correlograms',)
         
     def _similarity_matrix_computed(self, clusters_selected, matrix, clusters,
             cluster_groups, target_next=None):
@@ -315,26 +522,34 @@ class TaskGraph(AbstractTaskGraph):
             # spikes=self.loader.background_spikes)
         # if not np.array_equal(clusters, clusters_now):
             # return False
+        if isinstance(matrix, Exception):
+            log.warn("The similarity matrix could not be computed: "
+                "{0:s}.".format(str(matrix)))
+            return []
         if len(matrix) == 0:
             return []
-        self.statscache.similarity_matrix.update(clusters_selected, matrix)
-        self.statscache.similarity_matrix_normalized = normalize(
-            self.statscache.similarity_matrix.to_array(copy=True))
+        # Only the changed rows of the normalized matrix are updated.
+        self.statscache.update_similarity_matrix(clusters_selected, matrix)
         # Update the cluster view with cluster quality.
-        quality = np.diag(self.statscache.similarity_matrix_normalized).copy()
         self.statscache.cluster_quality = pd.Series(
-            quality,
+            self.statscache.get_cluster_quality(),
             index=self.statscache.similarity_matrix.indices,
             )
         self.get_view('ClusterView').set_quality(
             self.statscache.cluster_quality)
         return [('_wizard_update', (target_next,)),
                 ('_update_similarity_matrix_view',),
+                ('_precompute_correlograms',),
                 ]
 
     def _invalidate(self, clusters):
+        self.cache_generation += 1
         self.statscache.invalidate(clusters)
         
+    def _invalidate_merged(self, clusters, cluster_merged):
+        self.cache_generation += 1
+        self.statscache.merge(clusters, cluster_merged)
+        
 
     # View updates.
     # -------------
@@ -343,11 +558,16 @@ class TaskGraph(AbstractTaskGraph):
         # HACK: work around a bug with some GPU drivers and empty selections
         if len(clu)==0:
             return
+        # Derive the displayed binning from the cached correlograms.
+        ncorrbins, corrbin = self.get_correlograms_binning()
+        correlograms = self.statscache.get_correlograms(clu, ncorrbins, 
+            corrbin)
         data = vd.get_correlogramsview_data(self.experiment, 
-            self.statscache.correlograms, 
+            correlograms, 
             clusters=clu,
             channel_group=self.loader.shank,
             wizard=wizard,
+            corrbin=corrbin * 1. / self.loader.freq,
             )
         [view.set_data(**data) for view in self.get_views('CorrelogramsView')]
         
@@ -420,8 +640,12 @@ class TaskGraph(AbstractTaskGraph):
             SETTINGS['correlograms.ncorrbins'] = ncorrbins
         if corrbin is not None:
             SETTINGS['correlograms.corrbin'] = corrbin
-        # Reset the cache.
-        self.statscache.reset(ncorrbins)
+        # Reset the cache, unless the new binning can be derived from the
+        # cached correlograms.
+        if self.statscache.get_rebin_factor(
+                *self.get_correlograms_binning()) is None:
+            self.cache_generation += 1
+            self.statscache.reset(*self.get_correlograms_base_binning())
         # Update the correlograms.
         clusters = self.loader.get_clusters_selected()
         return ('_compute_correlograms', (clusters,))
@@ -648,7 +872,8 @@ def union(*clusters_list):
 # Merge/split actions.
 def after_merge(output):
     if output.get('wizard', False):
-        r = [('_invalidate', (output['clusters_to_merge'],)),
+        r = [('_invalidate_merged', (output['clusters_to_merge'], 
+                                     output['cluster_merged'])),
              # We specify here that the target in the wizard must be the
              # merged cluster.
              ('_compute_similarity_matrix', (output['cluster_merged'],)),
@@ -659,7 +884,8 @@ def after_merge(output):
                                      output['cluster_merged_colors'][0]),)),
             ]
     else:
-        r = [('_invalidate', (output['clusters_to_merge'],)),
+        r = [('_invalidate_merged', (output['clusters_to_merge'], 
+                                     output['cluster_merged'])),
              ('_compute_similarity_matrix',),
              ('_update_cluster_view'),
              ('_select_in_cluster_view', (output['cluster_merged'],)),
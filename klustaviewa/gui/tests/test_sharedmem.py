@@ -0,0 +1,76 @@
+"""Unit tests for the sharedmem module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+import cPickle
+
+import numpy as np
+
+from klustaviewa.gui.sharedmem import (SharedArray, as_array,
+    share_temporary, release_temporary, release_all_temporary, dispose)
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_shared_array():
+    array = np.random.rand(100, 5).astype(np.float32)
+    shared = SharedArray.create(array)
+    
+    assert shared.shape == (100, 5)
+    assert len(shared) == 100
+    assert np.array_equal(as_array(shared), array)
+    assert as_array(array) is array
+    
+    # Only the handle is pickled.
+    s = cPickle.dumps(shared, cPickle.HIGHEST_PROTOCOL)
+    assert len(s) < array.nbytes
+    shared2 = cPickle.loads(s)
+    assert np.array_equal(shared2.array, array)
+    
+    shared.delete()
+    assert not os.path.exists(shared.filename)
+    
+def test_shared_array_empty():
+    shared = SharedArray.create(np.zeros((0, 3)))
+    assert shared.array.shape == (0, 3)
+    shared.delete()
+
+def test_shared_temporary():
+    shared = [share_temporary(np.arange(10), 'test') for _ in xrange(3)]
+    other = share_temporary(np.arange(10), 'other')
+    
+    # The task of the second array is done: the first task was skipped.
+    release_temporary(cPickle.loads(cPickle.dumps(shared[1])))
+    assert not os.path.exists(shared[0].filename)
+    assert not os.path.exists(shared[1].filename)
+    assert os.path.exists(shared[2].filename)
+    assert os.path.exists(other.filename)
+    
+    release_all_temporary()
+    assert not os.path.exists(shared[2].filename)
+    assert not os.path.exists(other.filename)
+    
+def test_shared_dispose():
+    shared = [share_temporary(np.arange(10), 'test') for _ in xrange(2)]
+    session = SharedArray.create(np.arange(10))
+    
+    # The tasks queued so far may still use the array.
+    dispose(session, ['test', 'other'])
+    assert os.path.exists(session.filename)
+    # A task queued afterwards does not delay the deletion.
+    later = share_temporary(np.arange(10), 'test')
+    release_temporary(shared[0])
+    assert os.path.exists(session.filename)
+    release_temporary(shared[1])
+    assert not os.path.exists(session.filename)
+    
+    # Without any queued task, the array is deleted immediately.
+    session = SharedArray.create(np.arange(10))
+    dispose(session, ['other'])
+    assert not os.path.exists(session.filename)
+    
+    release_all_temporary()
+    assert not os.path.exists(later.filename)
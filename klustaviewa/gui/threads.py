@@ -3,10 +3,13 @@
 # -----------------------------------------------------------------------------
 # Imports
 # -----------------------------------------------------------------------------
+import hashlib
+import os
 import time
 import sys
 import traceback
-from threading import Lock
+from threading import Lock, Thread
+from multiprocessing import Pool, Value, cpu_count
 
 import numpy as np
 from qtools import inthread, inprocess
@@ -15,8 +18,11 @@ from qtools import QtGui, QtCore
 from kwiklib.dataio import KlustersLoader
 from kwiklib.dataio.tools import get_array
 from klustaviewa.wizard.wizard import Wizard
+from klustaviewa.gui.sharedmem import as_array, release_temporary
 from kwiklib.utils import logger as log
-from klustaviewa.stats import compute_correlograms, compute_correlations
+from klustaviewa.stats import (compute_correlograms_parallel, 
+    compute_correlograms_stream, compute_correlations, ClusterStatistics,
+    split_excerpts)
 from recluster import run_klustakwik
 
 # -----------------------------------------------------------------------------
@@ -66,26 +72,131 @@ class ReclusterTask(QtCore.QObject):
         self.reclusterDone.emit(channel_group, clusters, spikes, clu, wizard)
 
 
+def _exit_with_parent(ppid):
+    """Initializer of the correlograms pool processes: exit as soon as the
+    parent process is gone, so that they are not orphaned when the task
+    worker is killed."""
+    if not hasattr(os, 'getppid'):
+        return
+    def watch():
+        while os.getppid() == ppid:
+            time.sleep(1.)
+        os._exit(0)
+    thread = Thread(target=watch)
+    thread.daemon = True
+    thread.start()
+
+
 class CorrelogramsTask(QtCore.QObject):
     correlogramsComputed = QtCore.pyqtSignal(np.ndarray, object, int, float, object)
     
-    # def __init__(self, parent=None):
-        # super(CorrelogramsTask, self).__init__(parent)
+    def __init__(self, parent=None, niceness=0, cancel=None):
+        super(CorrelogramsTask, self).__init__(parent)
+        # Process pool, created on demand in the worker process.
+        self.pool = None
+        self.nprocesses = None
+        # Priority of the worker process, lowered on the first computation
+        # (this object is also instanciated in the GUI process).
+        self.niceness = niceness
+        self.niced = False
+        # Shared flag: when set, the running computation is abandoned.
+        self.cancel = cancel
+    
+    def set_priority(self):
+        if self.niceness and not self.niced and hasattr(os, 'nice'):
+            os.nice(self.niceness)
+        self.niced = True
+    
+    def cancelled(self):
+        return bool(self.cancel.value)
+    
+    def get_pool(self, nprocesses):
+        if nprocesses != self.nprocesses:
+            self.close()
+            if nprocesses > 1:
+                self.pool = Pool(nprocesses, initializer=_exit_with_parent,
+                    initargs=(os.getpid(),))
+            self.nprocesses = nprocesses
+        return self.pool
+    
+    def close(self):
+        """Stop the process pool. To be called in the worker process before
+        it exits."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self.nprocesses = None
     
     def compute(self, spiketimes, clusters, clusters_to_update=None,
-            clusters_selected=None, ncorrbins=None, corrbin=None, wizard=None):
+            clusters_selected=None, ncorrbins=None, corrbin=None, 
+            nprocesses=None, wizard=None, nexcerpts=None, excerpt_size=None):
+        """Compute the correlograms. spiketimes and clusters are arrays,
+        possibly shared, from which excerpts are taken and split across
+        `nprocesses` processes."""
         log.debug("Computing correlograms for clusters {0:s}.".format(
             str(list(clusters_to_update))))
         if len(clusters_to_update) == 0:
             return {}
+        self.set_priority()
         clusters_to_update = np.array(clusters_to_update, dtype=np.int32)
-        correlograms = compute_correlograms(spiketimes, clusters,
+        if nprocesses is None:
+            nprocesses = cpu_count()
+        # The excerpts are views on the (shared) arrays.
+        spiketimes = split_excerpts(as_array(spiketimes), 
+            nexcerpts=nexcerpts, excerpt_size=excerpt_size)
+        clusters = split_excerpts(as_array(clusters), 
+            nexcerpts=nexcerpts, excerpt_size=excerpt_size)
+        if self.cancel is not None:
+            # Cancellable computation: the excerpts are processed one after
+            # the other, and None is returned when cancelled.
+            return compute_correlograms_parallel(spiketimes, clusters,
+                clusters_to_update=clusters_to_update,
+                ncorrbins=ncorrbins, corrbin=corrbin, 
+                cancelled=self.cancelled)
+        correlograms = compute_correlograms_parallel(spiketimes, clusters,
             clusters_to_update=clusters_to_update,
-            ncorrbins=ncorrbins, corrbin=corrbin)
+            ncorrbins=ncorrbins, corrbin=corrbin, 
+            pool=self.get_pool(nprocesses), nchunks=nprocesses)
+        return correlograms
+    
+    def compute_done(self, spiketimes, clusters, clusters_to_update=None,
+            clusters_selected=None, ncorrbins=None, corrbin=None, 
+            nprocesses=None, wizard=None, nexcerpts=None, excerpt_size=None,
+            _result=None):
+        correlograms = _result
+        # The spike clusters were copied for this task.
+        release_temporary(clusters)
+        self.correlogramsComputed.emit(np.array(clusters_selected),
+            correlograms, ncorrbins, corrbin, wizard)
+
+
+class CorrelogramsStreamTask(QtCore.QObject):
+    """Compute the correlograms on the whole recording, chunk after chunk.
+    This runs in a thread, on in-memory arrays that are not modified during
+    the computation. Only the working memory of the computation is bounded,
+    not the memory of the input arrays."""
+    correlogramsProgress = QtCore.pyqtSignal(int, int)
+    correlogramsComputed = QtCore.pyqtSignal(np.ndarray, object, int, float, object)
+    
+    def compute(self, spiketimes, clusters, clusters_to_update=None,
+            clusters_unique=None, clusters_selected=None, ncorrbins=None, 
+            corrbin=None, wizard=None):
+        log.debug(("Computing correlograms on the whole recording for "
+            "clusters {0:s}.").format(str(list(clusters_to_update))))
+        if len(clusters_to_update) == 0:
+            return {}
+        clusters_to_update = np.array(clusters_to_update, dtype=np.int32)
+        correlograms = compute_correlograms_stream(spiketimes, clusters,
+            clusters_to_update=clusters_to_update, 
+            clusters_unique=clusters_unique,
+            ncorrbins=ncorrbins, corrbin=corrbin,
+            progress=self.correlogramsProgress.emit)
         return correlograms
     
     def compute_done(self, spiketimes, clusters, clusters_to_update=None,
-            clusters_selected=None, ncorrbins=None, corrbin=None, wizard=None, _result=None):
+            clusters_unique=None, clusters_selected=None, ncorrbins=None, 
+            corrbin=None, wizard=None, _result=None):
         correlograms = _result
         self.correlogramsComputed.emit(np.array(clusters_selected),
             correlograms, ncorrbins, corrbin, wizard)
@@ -95,28 +206,47 @@ class SimilarityMatrixTask(QtCore.QObject):
     correlationMatrixComputed = QtCore.pyqtSignal(np.ndarray, object,
         np.ndarray, np.ndarray, object)
     
-    # def __init__(self, parent=None):
-        # super(SimilarityMatrixTask, self).__init__(parent)
+    def __init__(self, parent=None):
+        super(SimilarityMatrixTask, self).__init__(parent)
+        # Statistics of the clusters, kept between successive calls.
+        self.statistics = ClusterStatistics()
         
     def compute(self, features, clusters, 
             cluster_groups, masks, clusters_selected, target_next=None,
-            similarity_measure=None):
+            similarity_measure=None, spikes=None, lean=False):
         log.debug("Computing correlation for clusters {0:s}.".format(
             str(list(clusters_selected))))
         if len(clusters_selected) == 0:
             return {}
+        # The features, masks and spike clusters may be in memory-mapped
+        # files. The spike clusters were copied for this task.
+        features = as_array(features)
+        masks = as_array(masks)
+        clusters = np.array(as_array(clusters))
         
+        if lean != self.statistics.lean:
+            self.statistics = ClusterStatistics(lean=lean)
+        # The cluster statistics are only updated for the changed clusters
+        # as long as the spikes are the same.
+        if spikes is not None:
+            key = hashlib.sha1(np.ascontiguousarray(spikes)).hexdigest()
+        else:
+            key = None
+        stats = self.statistics.update(features, clusters, masks, key=key)
         correlations = compute_correlations(features, clusters, 
-            masks, clusters_selected, similarity_measure=similarity_measure)
+            masks, clusters_selected, similarity_measure=similarity_measure,
+            stats=stats)
         return correlations
         
     def compute_done(self, features, clusters, 
             cluster_groups, masks, clusters_selected, target_next=None,
-            similarity_measure=None, _result=None):
+            similarity_measure=None, spikes=None, lean=False, _result=None):
         correlations = _result
+        clusters_array = get_array(as_array(clusters), copy=True)
+        release_temporary(clusters)
         self.correlationMatrixComputed.emit(np.array(clusters_selected),
             correlations, 
-            get_array(clusters, copy=True), 
+            clusters_array, 
             get_array(cluster_groups, copy=True),
             target_next)
 
@@ -133,6 +263,16 @@ class ThreadedTasks(QtCore.QObject):
             impatient=True)
         self.correlograms_task = inprocess(CorrelogramsTask)(
             impatient=True, use_master_thread=False)
+        self.correlograms_stream_task = inthread(CorrelogramsStreamTask)(
+            impatient=True)
+        # Separate process for the correlograms precomputed in the
+        # background, so that they never delay the selected clusters: it
+        # runs with a low priority, and its computation is abandoned as soon
+        # as the correlograms of the selected clusters are requested.
+        self.correlograms_background_cancel = Value('b', 0)
+        self.correlograms_background_task = inprocess(CorrelogramsTask)(
+            impatient=True, use_master_thread=False, niceness=10,
+            cancel=self.correlograms_background_cancel)
         # HACK: the similarity matrix view does not appear to update on
         # some versions of Mac+Qt, but it seems to work with inthread
         if sys.platform == 'darwin':
@@ -142,14 +282,27 @@ class ThreadedTasks(QtCore.QObject):
             self.similarity_matrix_task = inprocess(SimilarityMatrixTask)(
                 impatient=True, use_master_thread=False)
 
+    def cancel_background_correlograms(self, cancel=True):
+        """Abandon the correlograms being precomputed in the background."""
+        self.correlograms_background_cancel.value = int(cancel)
+    
     def join(self):
+        self.cancel_background_correlograms()
+        # Stop the correlograms process pools while the workers are still
+        # alive: joining a worker kills it.
+        self.correlograms_task.close(_sync=True)
+        self.correlograms_background_task.close(_sync=True)
         self.selection_task.join()
         self.recluster_task.join()
         self.correlograms_task.join()
+        self.correlograms_stream_task.join()
+        self.correlograms_background_task.join()
         self.similarity_matrix_task.join()
         
     def terminate(self):
+        # The pool processes exit by themselves once their worker is killed.
         self.correlograms_task.terminate()
+        self.correlograms_background_task.terminate()
         # The similarity matrix is in an external process only
         # if the system is not a Mac.
         if sys.platform != 'darwin':
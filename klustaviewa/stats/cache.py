@@ -4,12 +4,20 @@ second-order statistics in memory, and updating them when necessary."""
 # -----------------------------------------------------------------------------
 # Imports
 # -----------------------------------------------------------------------------
-from collections import namedtuple
+import hashlib
+import os
+import zipfile
+from collections import namedtuple, OrderedDict
 from itertools import product
 
 import numpy as np
 
-from klustaviewa.stats.indexed_matrix import IndexedMatrix, CacheMatrix
+from klustaviewa.stats.indexed_matrix import (IndexedMatrix, CacheMatrix,
+    SparseCacheMatrix, MatrixBlock, sparse)
+from klustaviewa.stats.correlograms import (get_rebin_factor,
+    rebin_correlograms)
+from klustaviewa.stats.correlations import normalize
+from kwiklib.utils.logger import warn
 
 
 # -----------------------------------------------------------------------------
@@ -23,27 +31,356 @@ def is_indices(item):
     return (isinstance(item, list) or isinstance(item, tuple) or 
         isinstance(item, np.ndarray) or isinstance(item, (int, long, np.integer)))
         
+def get_cluster_hashes(spike_clusters):
+    """Return a dictionary cluster => hash of the indices of its spikes.
+    A cluster keeps the same hash across sessions as long as its spikes
+    do not change, even if it is renumbered."""
+    spike_clusters = np.asarray(spike_clusters)
+    # The sort is stable, so that the spikes of every cluster are sorted.
+    spikes = np.argsort(spike_clusters, kind='mergesort').astype(np.int64)
+    clusters, start = np.unique(spike_clusters[spikes], return_index=True)
+    end = np.append(start[1:], len(spikes))
+    return dict((cluster, hashlib.sha1(spikes[i:j].tostring()).hexdigest())
+        for cluster, i, j in zip(clusters, start, end))
+        
 
 # -----------------------------------------------------------------------------
 # Stats cache
 # -----------------------------------------------------------------------------
 class StatsCache(object):
-    def __init__(self, ncorrbins=None):
+    def __init__(self, ncorrbins=None, corrbin=None, 
+        similarity_sparse=False, max_memory=None):
+        # Binning of the cached correlograms, from which the displayed 
+        # binnings are derived.
         self.ncorrbins = ncorrbins
+        self.corrbin = corrbin
+        # Maximum size of the correlograms in bytes, None for no limit.
+        self.max_memory = max_memory
+        # Number of clusters found in the cache or computed, and number of
+        # clusters evicted from the cache.
+        self.counters = dict(hits=0, misses=0, evictions=0)
+        # Whether the similarity matrix is stored in a sparse matrix.
+        if similarity_sparse and sparse is None:
+            warn(("scipy is not available, the similarity matrix is stored "
+                "in a dense matrix."))
+            similarity_sparse = False
+        self.similarity_sparse = similarity_sparse
         self.reset()
     
     def invalidate(self, clusters):
         self.correlograms.invalidate(clusters)
-        self.similarity_matrix.invalidate(clusters)
+        self._forget(clusters)
+        self.invalidate_similarity_matrix(clusters)
+        
+    def merge(self, clusters, cluster_merged):
+        """Update the cache after a merge. The correlograms of the merged
+        cluster are the sums of the cached correlograms of the clusters to
+        merge, so that they do not need to be recomputed."""
+        if self.correlograms.merge(clusters, cluster_merged):
+            self._touch([cluster_merged])
+        else:
+            self.correlograms.invalidate(clusters)
+        self._forget(clusters)
+        self.invalidate_similarity_matrix(clusters)
         
-    def reset(self, ncorrbins=None):
+    def reset(self, ncorrbins=None, corrbin=None):
         if ncorrbins is not None:
             self.ncorrbins = ncorrbins
-        self.correlograms = CacheMatrix(shape=(0, 0, self.ncorrbins))
-        self.similarity_matrix = CacheMatrix()
+        if corrbin is not None:
+            self.corrbin = corrbin
+        self.correlograms = self._create_correlograms()
+        # Clusters of the correlograms, from the least to the most recently
+        # used.
+        self.correlograms_used = OrderedDict()
+        if self.similarity_sparse:
+            self.similarity_matrix = SparseCacheMatrix()
+            self.similarity_normalized = SparseCacheMatrix()
+        else:
+            self.similarity_matrix = CacheMatrix()
+            self.similarity_normalized = CacheMatrix()
+        # Rows of the similarity matrix that need to be normalized again.
+        self.similarity_dirty = set()
+        # Cluster => quality, the diagonal of the normalized matrix.
+        self.similarity_quality = {}
         self.similarity_matrix_normalized = None
         self.cluster_quality = None
         
+    
+    # Similarity matrix
+    # -----------------
+    def invalidate_similarity_matrix(self, clusters):
+        """Remove clusters from the similarity matrix. The rows with
+        values in the columns of these clusters will be normalized again at
+        the next update."""
+        if isinstance(clusters, (int, long, np.integer)):
+            clusters = [clusters]
+        matrix = self.similarity_matrix
+        clusters = sorted(set(clusters).intersection(matrix.indices))
+        if len(clusters) == 0:
+            return
+        kept = sorted(set(matrix.indices) - set(clusters))
+        if kept:
+            columns = matrix[kept, clusters]
+            self.similarity_dirty.update(
+                np.array(kept)[np.any(columns != 0, axis=1)])
+        matrix.invalidate(clusters)
+        self.similarity_normalized.invalidate(clusters)
+        self.similarity_dirty.difference_update(clusters)
+        for cluster in clusters:
+            self.similarity_quality.pop(cluster, None)
+        
+    def _get_mirror_values(self, block):
+        """Return the similarity values of the symmetric pairs
+        (columns[j], rows[i]) of a block in an array values[j, i], null for
+        the clusters which are not in the matrix."""
+        matrix = self.similarity_matrix
+        values = np.zeros((len(block.columns), len(block.rows)))
+        columns = np.in1d(block.columns, matrix.indices)
+        rows = np.in1d(block.rows, matrix.indices)
+        if np.any(columns) and np.any(rows):
+            values[np.ix_(columns, rows)] = matrix[block.columns[columns],
+                block.rows[rows]]
+        return values
+        
+    def update_similarity_matrix(self, clusters, matrix):
+        """Update the similarity matrix with the rows of the given clusters
+        (a MatrixBlock or a dictionary, see `CacheMatrix.update`). Only the
+        changed rows of the row-normalized matrix and the quality of their
+        clusters are computed again."""
+        mirror = isinstance(matrix, MatrixBlock) and matrix.mirror is not None
+        if mirror:
+            mirror_values = self._get_mirror_values(matrix)
+        self.similarity_matrix.update(clusters, matrix)
+        if isinstance(matrix, MatrixBlock):
+            rows = list(matrix.rows)
+            # The rows of the symmetric pairs whose values have changed.
+            if mirror:
+                changed = np.any(self._get_mirror_values(matrix) != 
+                    mirror_values, axis=1)
+                rows.extend(matrix.columns[changed])
+        else:
+            rows = [row for row, column in matrix.keys()]
+        self.similarity_dirty.update(rows)
+        dirty = sorted(self.similarity_dirty)
+        indices = self.similarity_matrix.indices
+        if dirty:
+            # The rows of a sparse matrix are normalized without being
+            # densified.
+            if self.similarity_sparse:
+                data = self.similarity_matrix.sparse_rows(dirty)
+            else:
+                data = self.similarity_matrix[dirty, indices]
+            data = normalize(data.astype(np.float64))
+            self.similarity_normalized.update(dirty, 
+                MatrixBlock(dirty, indices, data))
+            diagonal = np.asarray(data[np.arange(len(dirty)), 
+                np.searchsorted(indices, dirty)]).ravel()
+            self.similarity_quality.update(zip(dirty, diagonal))
+        self.similarity_dirty.clear()
+        # Copy: the matrix is handed to the views and the wizard, while the
+        # cache storage is updated in place.
+        self.similarity_matrix_normalized = (
+            self.similarity_normalized.to_array(copy=True))
+        
+    def get_cluster_quality(self):
+        """Return the quality of the clusters of the similarity matrix, in
+        the order of its indices."""
+        return np.array([self.similarity_quality.get(cluster, 0.)
+            for cluster in self.similarity_matrix.indices])
+        
+    
+    # Correlograms memory
+    # -------------------
+    def get_max_clusters(self, correlograms):
+        """Return the maximum number of clusters in a correlograms cache, or
+        None if there is no memory limit."""
+        if self.max_memory is None:
+            return None
+        pair = correlograms.to_array().itemsize * (self.ncorrbins or 1)
+        return max(int(np.sqrt(self.max_memory / float(pair))), 1)
+    
+    def _create_correlograms(self):
+        correlograms = CacheMatrix(shape=(0, 0, self.ncorrbins))
+        correlograms.max_capacity = self.get_max_clusters(correlograms)
+        return correlograms
+    
+    def _touch(self, clusters):
+        for cluster in clusters:
+            self.correlograms_used.pop(cluster, None)
+            self.correlograms_used[cluster] = True
+        
+    def _forget(self, clusters):
+        if isinstance(clusters, (int, long, np.integer)):
+            clusters = [clusters]
+        for cluster in clusters:
+            self.correlograms_used.pop(cluster, None)
+        
+    def get_correlograms_to_update(self, clusters):
+        """Return the clusters whose correlograms need to be computed, and
+        count the cache hits and misses."""
+        clusters_to_update = self.correlograms.not_in_key_indices(clusters)
+        self.counters['misses'] += len(clusters_to_update)
+        self.counters['hits'] += (len(set(clusters)) - 
+            len(clusters_to_update))
+        self._touch(clusters)
+        return clusters_to_update
+    
+    def evict(self, nclusters=0, protected=[]):
+        """Evict the least recently used clusters from the correlograms
+        cache, so that `nclusters` new clusters can be added without
+        exceeding the memory limit. The protected clusters are never
+        evicted."""
+        max_clusters = self.correlograms.max_capacity
+        if max_clusters is None:
+            return []
+        nevicted = self.correlograms.n + nclusters - max_clusters
+        if nevicted <= 0:
+            return []
+        protected = set(protected)
+        # The clusters that have never been used are evicted first.
+        indices = self.correlograms.indices
+        candidates = [cluster for cluster in indices 
+            if cluster not in self.correlograms_used]
+        candidates.extend(self.correlograms_used)
+        evicted = [cluster for cluster in candidates 
+            if cluster not in protected][:nevicted]
+        self.correlograms.invalidate(evicted)
+        self._forget(evicted)
+        self.counters['evictions'] += len(evicted)
+        return evicted
+    
+    def update_correlograms(self, clusters, correlograms):
+        """Put computed correlograms in the cache (a MatrixBlock or a 
+        dictionary, see `CacheMatrix.update`), after evicting the least
+        recently used clusters if needed. Only the pairs of key clusters
+        are stored, so that the memory limit bounds the number of key
+        clusters, whatever the number of columns of the computed
+        correlograms."""
+        if isinstance(clusters, (int, long, np.integer)):
+            clusters = [clusters]
+        clusters = sorted(set(clusters))
+        self.evict(len(self.correlograms.not_in_indices(clusters)), 
+            protected=clusters)
+        keys = set(self.correlograms.key_indices).union(clusters)
+        if isinstance(correlograms, MatrixBlock):
+            kept = np.in1d(correlograms.columns, sorted(keys))
+            correlograms = MatrixBlock(correlograms.rows, 
+                correlograms.columns[kept], correlograms.data[:, kept, ...],
+                mirror=correlograms.mirror)
+        else:
+            correlograms = dict(((cluster0, cluster1), value) 
+                for (cluster0, cluster1), value in correlograms.iteritems()
+                    if cluster0 in keys and cluster1 in keys)
+            if not correlograms:
+                return
+        self.correlograms.update(clusters, correlograms)
+        self._touch(clusters)
+        
+        
+    # Correlograms binning
+    # --------------------
+    def get_rebin_factor(self, ncorrbins, corrbin):
+        """Return the number of cached bins in every requested bin, or None
+        if the requested binning cannot be derived from the cache."""
+        if self.corrbin is None:
+            return 1 if ncorrbins == self.ncorrbins else None
+        return get_rebin_factor(ncorrbins, corrbin, self.ncorrbins, 
+            self.corrbin)
+    
+    def _copy_correlograms(self, clusters):
+        correlograms = self.correlograms.submatrix(clusters)
+        data = correlograms.to_array()
+        # The submatrix is a read-only view on the storage when the slots of
+        # the clusters are contiguous, and a new array otherwise.
+        if not data.flags.writeable:
+            data = data.copy()
+        return IndexedMatrix._from_data(correlograms.indices, data)
+    
+    def get_correlograms(self, clusters, ncorrbins=None, corrbin=None):
+        """Return an IndexedMatrix with the correlograms of the specified
+        clusters, derived from the cache with the requested binning. The
+        values are copied: the cache storage is reused when clusters are
+        evicted or updated."""
+        self._touch(clusters)
+        if ncorrbins is None:
+            return self._copy_correlograms(clusters)
+        factor = self.get_rebin_factor(ncorrbins, corrbin)
+        if factor is None:
+            raise ValueError(("The binning ({0:d}, {1:s}) cannot be derived "
+                "from the cached correlograms.").format(ncorrbins, 
+                str(corrbin)))
+        if factor == 1 and ncorrbins == self.ncorrbins:
+            return self._copy_correlograms(clusters)
+        correlograms = self.correlograms.submatrix(clusters)
+        return IndexedMatrix(indices=correlograms.indices,
+            data=rebin_correlograms(correlograms.to_array(), factor, 
+                ncorrbins))
+    
+    
+    # Persistence
+    # -----------
+    def save(self, filename, cluster_hashes, **params):
+        """Save the correlograms in a .npz file, along with the hash of every
+        cluster (see `get_cluster_hashes`) and the parameters the
+        correlograms depend on."""
+        correlograms = self.correlograms
+        indices = correlograms.indices
+        params = dict(('param_' + name, value) 
+            for name, value in params.iteritems())
+        np.savez(filename,
+            correlograms=correlograms.to_array(),
+            hashes=np.array([cluster_hashes.get(index, '') 
+                for index in indices], dtype=str),
+            keys=np.in1d(indices, correlograms.key_indices),
+            **params)
+    
+    def load(self, filename, cluster_hashes, **params):
+        """Restore the correlograms saved with `save`. Only the clusters with
+        an unchanged hash are restored, possibly under a new index. Nothing
+        happens if the parameters have changed. Return whether the 
+        correlograms have been loaded."""
+        if not os.path.exists(filename):
+            return False
+        try:
+            with np.load(filename) as data:
+                names = sorted(name for name in data.files 
+                    if name.startswith('param_'))
+                if names != sorted('param_' + name for name in params):
+                    return False
+                if not set(['correlograms', 'hashes', 'keys']).issubset(
+                    data.files):
+                    return False
+                for name, value in params.iteritems():
+                    if data['param_' + name] != value:
+                        return False
+                correlograms = data['correlograms']
+                hashes, keys = data['hashes'], data['keys']
+        except (IOError, ValueError, zipfile.BadZipfile):
+            # Corrupt file.
+            return False
+        if hashes.ndim != 1:
+            return False
+        n = len(hashes)
+        if (correlograms.shape != (n, n, self.ncorrbins) or 
+            keys.shape != (n,)):
+            return False
+        # Stored relative index => current cluster.
+        clusters = dict((hash, cluster) 
+            for cluster, hash in cluster_hashes.iteritems())
+        matched = [(i, clusters[hash]) for i, hash in enumerate(hashes)
+            if hash in clusters]
+        dic = {}
+        for i, cluster0 in matched:
+            for j, cluster1 in matched:
+                if keys[i] or keys[j]:
+                    dic[(cluster0, cluster1)] = correlograms[i, j, ...]
+        self.correlograms = self._create_correlograms()
+        self.correlograms_used = OrderedDict()
+        if dic:
+            self.update_correlograms([cluster for i, cluster in matched
+                if keys[i]], dic)
+        return True
+        
     # def add(self, clusters):
         # self.correlograms.add_indices(clusters)
         # self.similarity_matrix.add_indices(clusters)
@@ -10,178 +10,543 @@ import numpy as np
 # import scipy.linalg
 
 from tools import matrix_of_pairs
+from indexed_matrix import MatrixBlock, is_sparse
 from kwiklib.utils.logger import warn
 
 
 # -----------------------------------------------------------------------------
-# Correlation matrix
+# Covariance factorization
 # -----------------------------------------------------------------------------
-def compute_statistics(Fet1, Fet2, spikes_in_clusters, masks):
-    """Return Gaussian statistics about each cluster."""
+def get_covariance_factor(CovMat):
+    """Return a matrix L such that CovMat = L L^T: the Cholesky factor, or
+    a factor obtained from the eigendecomposition if the covariance matrix
+    is not numerically positive definite."""
+    try:
+        return np.linalg.cholesky(CovMat)
+    except np.linalg.LinAlgError:
+        w, V = np.linalg.eigh(CovMat)
+        # Clip the null or negative eigenvalues.
+        w = np.maximum(w, max(w.max(), 1.) * 1e-12)
+        return V * np.sqrt(w).reshape((1, -1))
 
-    nPoints = Fet1.shape[0] #size(Fet1, 1)
-    nDims = Fet1.shape[1] #size(Fet1, 2)
-    # nclusters = Clu2.max() #max(Clu2)
-    nclusters = len(spikes_in_clusters)
 
-    # Default masks.
+# -----------------------------------------------------------------------------
+# Cluster statistics
+# -----------------------------------------------------------------------------
+# Number of spikes processed at once when going through all spikes.
+CHUNK_SIZE = 10000
+
+def _chunks(n, chunk_size=None):
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    return [(i, min(i + chunk_size, n)) for i in xrange(0, n, chunk_size)]
+
+def get_masked_moments(Fet2, masks, chunk_size=None):
+    """Return the mean nu and the variance sigma2 of the masked features,
+    as (1, nDims) arrays. The features are processed by chunks of spikes,
+    and the sums are accumulated in double precision."""
+    nPoints, nDims = Fet2.shape
+    nu = np.zeros(nDims)
+    sigma2 = np.zeros(nDims)
+    # No masked point.
     if masks is None:
-        masks = np.ones((nPoints, nDims), dtype=np.float32)
-
-    # precompute the mean and variances of the masked points for each feature
-    # contains 1 when the corresponding point is masked
-    masked = np.zeros_like(masks)
-    masked[masks == 0] = 1
-    nmasked = np.sum(masked, axis=0)
-    nu = np.sum(Fet2 * masked, axis=0) / nmasked
+        return nu.reshape((1, -1)), sigma2.reshape((1, -1))
+    nmasked = np.zeros(nDims)
+    for i, j in _chunks(nPoints, chunk_size):
+        # contains 1 when the corresponding point is masked
+        masked = masks[i:j] == 0
+        nmasked += masked.sum(axis=0)
+        nu += (Fet2[i:j] * masked).sum(axis=0, dtype=np.float64)
     # Handle nmasked == 0.
-    nu[np.isnan(nu)] = 0
-    nu = nu.reshape((1, -1))
-    sigma2 = np.sum(((Fet2 - nu) * masked) ** 2, axis=0) / nmasked
-    sigma2[np.isnan(sigma2)] = 0
-    sigma2 = sigma2.reshape((1, -1))
-    D = np.diag(sigma2.ravel())
+    indices = nmasked > 0
+    nu[indices] /= nmasked[indices]
+    for i, j in _chunks(nPoints, chunk_size):
+        masked = masks[i:j] == 0
+        sigma2 += (((Fet2[i:j] - nu) * masked) ** 2).sum(axis=0)
+    sigma2[indices] /= nmasked[indices]
+    return nu.reshape((1, -1)), sigma2.reshape((1, -1))
+
+def get_expected_features(Fet1, masks, nu, sigma2):
+    """Return the expected features y and their variance eta of some spikes,
+    given their features, their masks (None if they are all unmasked) and
+    the moments of the masked features (see `get_masked_moments`).
+    
+    The results have the floating-point type of the features, so that
+    single-precision features are never promoted to double precision.
+    
+    """
+    dtype = np.result_type(Fet1.dtype, np.float32)
+    if masks is None:
+        return Fet1.astype(dtype), np.zeros(Fet1.shape, dtype=dtype)
+    masks = masks.astype(dtype, copy=False)
+    nu = nu.astype(dtype)
+    sigma2 = sigma2.astype(dtype)
     # expected features
-    y = Fet1 * masks + (1 - masks) * nu
-    z = masks * Fet1**2 + (1 - masks) * (nu ** 2 + sigma2)
-    eta = z - y ** 2
-
-    LogP = np.zeros((nPoints, nclusters))
+    y = Fet1 * masks
+    y += (1 - masks) * nu
+    # z = masks * Fet1**2 + (1 - masks) * (nu ** 2 + sigma2)
+    eta = masks * Fet1 ** 2
+    eta += (1 - masks) * (nu ** 2 + sigma2)
+    eta -= y ** 2
+    return y, eta
+
+def compute_sufficient_statistics(y, eta, masks, spikes=None, y0=None):
+    """Return the sufficient statistics of a cluster: a tuple (count, sum,
+    sum of outer products, sum of eta, number of unmasked spikes per
+    feature). If `spikes` is None, the arrays only contain the spikes of the
+    cluster. The features are centered on `y0` to avoid cancellation
+    errors when computing the covariance matrix. Statistics computed with
+    the same `y0` can be summed."""
+    if spikes is not None:
+        y = np.take(y, spikes, axis=0)
+        eta = np.take(eta, spikes, axis=0)
+        if masks is not None:
+            masks = np.take(masks, spikes, axis=0)
+    MyFet2 = y.astype(np.float64)
+    if y0 is not None:
+        MyFet2 -= y0
+    npoints = len(MyFet2)
+    if masks is None:
+        unmasksum = np.repeat(npoints, MyFet2.shape[1])
+    else:
+        unmasksum = (masks > 0).sum(axis=0)
+    return (npoints, MyFet2.sum(axis=0), np.dot(MyFet2.T, MyFet2),
+        eta.sum(axis=0, dtype=np.float64), unmasksum)
+
+class ExpectedFeatures(object):
+    """Expected features of all spikes, from which the sufficient statistics
+    of the clusters are computed.
+    
+    By default, the expected features y and their variance eta are computed
+    once for all spikes. If `lean` is True, they are only computed for the
+    spikes of one cluster at a time, so that the memory used stays close to
+    the memory of the features.
+    
+    """
+    def __init__(self, Fet1, Fet2, masks, lean=False, chunk_size=None):
+        self.lean = lean
+        self.masks = masks
+        self.nu, self.sigma2 = get_masked_moments(Fet2, masks, 
+            chunk_size=chunk_size)
+        self.D = np.diag(self.sigma2.ravel())
+        nPoints = Fet1.shape[0]
+        if lean:
+            self.features = Fet1
+            self.y = self.eta = None
+            # Mean of the expected features.
+            s = 0
+            for i, j in _chunks(nPoints, chunk_size):
+                y, _ = self.get_expected_features(i, j)
+                s = s + y.sum(axis=0, dtype=np.float64)
+            self.y0 = s / max(nPoints, 1)
+        else:
+            self.features = None
+            dtype = np.result_type(Fet1.dtype, np.float32)
+            self.y = np.empty(Fet1.shape, dtype=dtype)
+            self.eta = np.empty(Fet1.shape, dtype=dtype)
+            for i, j in _chunks(nPoints, chunk_size):
+                self.y[i:j], self.eta[i:j] = self.get_expected_features(i, j,
+                    Fet1=Fet1)
+            self.y0 = self.y.mean(axis=0, dtype=np.float64)
+    
+    def get_expected_features(self, i, j, Fet1=None):
+        if Fet1 is None:
+            Fet1 = self.features
+        masks = self.masks[i:j] if self.masks is not None else None
+        return get_expected_features(Fet1[i:j], masks, self.nu, self.sigma2)
+    
+    def get_sufficient_statistics(self, spikes):
+        """Return the sufficient statistics of the given spikes (see
+        `compute_sufficient_statistics`)."""
+        if not self.lean:
+            return compute_sufficient_statistics(self.y, self.eta, 
+                self.masks, spikes, y0=self.y0)
+        masks = (np.take(self.masks, spikes, axis=0) 
+            if self.masks is not None else None)
+        y, eta = get_expected_features(np.take(self.features, spikes, 
+            axis=0), masks, self.nu, self.sigma2)
+        return compute_sufficient_statistics(y, eta, masks, y0=self.y0)
+
+def sum_sufficient_statistics(suffstats):
+    """Return the sufficient statistics of the union of several clusters."""
+    return tuple(np.sum(s, axis=0) if i > 0 else sum(s)
+        for i, s in enumerate(zip(*suffstats)))
+
+def get_statistics(suffstats, D, y0=None, c=None):
+    """Return the Gaussian statistics of a cluster from its sufficient
+    statistics (see `compute_statistics`)."""
+    npoints, s, ss, etasum, unmasksum = suffstats
+    nDims = len(s)
+    Mean = (s / npoints).reshape((1, -1))
+    if y0 is not None:
+        Mean += y0
+
+    if npoints <= 1:
+        CovMat = 1e-3*np.eye(nDims)
+        return (Mean, CovMat, np.sqrt(1e-3)*np.eye(nDims),
+            (1e-3)**nDims, npoints, np.zeros(nDims, dtype=np.bool))
+
+    # Covariance matrix, without the normalization factor.
+    CovMat = ss - np.outer(s, s) / npoints
+
+    # Variation Bayesian approximation
+    priorPoint = 1
+    CovMat += D * priorPoint  # D = np.diag(sigma2.ravel())
+    CovMat /= (npoints + priorPoint - 1)
+
+    # HACK: avoid instability issues, kind of works
+    # CovMat += np.diag(1e-0 * np.ones(nDims))
+
+    # now, add the diagonal modification to the covariance matrix
+    # the eta just for the current cluster
+    d = etasum / npoints
+
+    # Handle nmasked == 0
+    d[np.isnan(d)] = 0
+
+    # add diagonal
+    CovMat += np.diag(d)
+    # We don't compute the inverse explicitely: the factor is used
+    # to compute all Mahalanobis distances with this covariance matrix.
+    CovMatFactor = get_covariance_factor(CovMat)
+
+    # WARNING: this is numerically instable
+    # LogDet = np.log(np.linalg.det(CovMat))
+
+    _sign, LogDet = np.linalg.slogdet(CovMat)
+    if _sign < 0:
+        warn("The correlation matrix of cluster %s has a negative determinant (whaaat??)" % str(c))
+
+    # Boolean vector of size (nchannels,): which channels are unmasked?
+    unmask = unmasksum / float(npoints)
+
+    return (Mean, CovMat, CovMatFactor, LogDet, npoints, unmask)
+
+def compute_statistics(Fet1, Fet2, spikes_in_clusters, masks, lean=False):
+    """Return Gaussian statistics about each cluster.
+    
+    For every cluster, return a tuple (Mean, CovMat, CovMatFactor, LogDet,
+    npoints, unmask), where CovMatFactor is the Cholesky factor of CovMat
+    (see `get_covariance_factor`). See `ExpectedFeatures` for `lean`.
+    
+    """
+    expected = ExpectedFeatures(Fet1, Fet2, masks, lean=lean)
 
     stats = {}
 
     for c in spikes_in_clusters:
         # MyPoints = np.nonzero(Clu2==c)[0]
         MyPoints = spikes_in_clusters[c]
-        # MyFet2 = Fet2[MyPoints, :]
-        # now, take the modified features here
-        # MyFet2 = y[MyPoints, :]
-        MyFet2 = np.take(y, MyPoints, axis=0).astype(np.float64)
-        MyMasks = np.take(masks, MyPoints, axis=0)
-        # if len(MyPoints) > nDims:
-        # LogProp = np.log(len(MyPoints) / float(nPoints)) # log of the proportion in cluster c
-        Mean = np.mean(MyFet2, axis=0).reshape((1, -1))
-
-        if len(MyPoints) <= 1:
-            CovMat = 1e-3*np.eye(nDims)
-            stats[c] = (Mean, CovMat, 1e3*np.eye(nDims),
-                (1e-3)**nDims, len(MyPoints), np.zeros(nDims, dtype=np.bool))
-            continue
+        suffstats = expected.get_sufficient_statistics(MyPoints)
+        stats[c] = get_statistics(suffstats, expected.D, y0=expected.y0, 
+            c=c)
 
-
-        CovMat = np.cov(MyFet2, rowvar=0) # stats for cluster c
-
-        # Variation Bayesian approximation
-        priorPoint = 1
-        CovMat *= (len(MyFet2) - 1)  # get rid of the normalization factor
-        CovMat += D * priorPoint  # D = np.diag(sigma2.ravel())
-        CovMat /= (len(MyFet2) + priorPoint - 1)
+    return stats
 
 
-        # HACK: avoid instability issues, kind of works
-        # CovMat += np.diag(1e-0 * np.ones(nDims))
+class ClusterStatistics(object):
+    """Keep the sufficient statistics of every cluster across successive
+    computations of the similarity matrix on the same spikes, so that
+    only the clusters changed by an action are updated: merged clusters
+    are obtained by summing the statistics of their parents, and the
+    other changed clusters are recomputed from their spikes. See
+    `ExpectedFeatures` for `lean`."""
+    def __init__(self, lean=False):
+        self.lean = lean
+        self.reset()
+        
+    def reset(self):
+        self.key = None
+        self.clusters = None
+        self.expected = None
+        self.suffstats = {}
+        self.stats = {}
+        
+    def update(self, features, clusters, masks, key=None):
+        """Return the statistics of all clusters. `key` identifies the
+        spikes: the cache is discarded when it changes or is None."""
+        clusters = np.asarray(clusters)
+        if (key is None or key != self.key or 
+            self.clusters is None or len(clusters) != len(self.clusters)):
+            self.reset()
+            self.key = key
+            self.expected = ExpectedFeatures(features, features, masks, 
+                lean=self.lean)
+            clusters_old = clusters_new = np.unique(clusters)
+            changed = np.ones(len(clusters), dtype=np.bool)
+        else:
+            changed = clusters != self.clusters
+            clusters_old = np.unique(self.clusters[changed])
+            clusters_new = np.unique(clusters[changed])
+        
+        counts_old = dict((c, self.suffstats[c][0]) for c in clusters_old
+            if c in self.suffstats)
+        # Remove the clusters that have lost spikes.
+        suffstats_old = {}
+        for c in clusters_old:
+            if c in self.suffstats:
+                suffstats_old[c] = self.suffstats.pop(c)
+                del self.stats[c]
+        
+        for c in np.unique(np.hstack((clusters_old, clusters_new))):
+            spikes = np.nonzero(clusters == c)[0]
+            if len(spikes) == 0:
+                continue
+            # Old clusters of the spikes that moved to this cluster.
+            if self.clusters is not None:
+                parents = self.clusters[changed & (clusters == c)]
+            else:
+                parents = np.array([], dtype=clusters.dtype)
+            # Merge: this cluster is the union of whole old clusters.
+            if (len(parents) > 0 and c not in suffstats_old and 
+                all(counts_old.get(p) == np.sum(parents == p)
+                    for p in np.unique(parents))):
+                parents = np.unique(parents)
+                suffstats = [suffstats_old[p] for p in parents]
+                if c in self.suffstats:
+                    suffstats.append(self.suffstats[c])
+                self.suffstats[c] = sum_sufficient_statistics(suffstats)
+            else:
+                self.suffstats[c] = self.expected.get_sufficient_statistics(
+                    spikes)
+            self.stats[c] = get_statistics(self.suffstats[c], 
+                self.expected.D, y0=self.expected.y0, c=c)
+        
+        self.clusters = clusters.copy()
+        return self.stats
 
-        # now, add the diagonal modification to the covariance matrix
-        # the eta just for the current cluster
-        etac = np.take(eta, MyPoints, axis=0)
-        d = np.mean(etac, axis=0)
 
-        # Handle nmasked == 0
-        d[np.isnan(d)] = 0
+# -----------------------------------------------------------------------------
+# Mask overlap
+# -----------------------------------------------------------------------------
+def get_unmask_index(unmask, threshold=.99):
+    """Return, for every feature, the relative indices of the clusters
+    unmasked on it, given the (nclusters, nfeatures) unmask vectors.
+    
+    Two clusters are only compared if (unmaski * unmaskj).max() >= threshold,
+    which requires both of them to be above the threshold on a common
+    feature: only the clusters sharing a feature in the index need to be
+    tested.
+    
+    """
+    unmasked = unmask >= threshold
+    return [np.nonzero(unmasked[:, k])[0] for k in xrange(unmask.shape[1])]
 
-        # add diagonal
-        CovMat += np.diag(d)
-        # We don't compute that explicitely anymore: we solve Ax=b instead
-        # CovMatinv = np.linalg.inv(CovMat)
-        CovMatinv = None
+def get_overlapping_clusters(index, unmask, unmaski, threshold=.99):
+    """Return the sorted relative indices of the clusters whose unmask
+    vectors overlap with `unmaski`, using the index returned by
+    `get_unmask_index`."""
+    candidates = [index[k] for k in np.nonzero(unmaski >= threshold)[0]]
+    if not candidates:
+        return np.array([], dtype=np.int64)
+    candidates = np.unique(np.concatenate(candidates))
+    sim = (unmaski.reshape((1, -1)) * unmask[candidates]).max(axis=1)
+    return candidates[sim >= threshold]
 
-        # WARNING: this is numerically instable
-        # LogDet = np.log(np.linalg.det(CovMat))
 
-        _sign, LogDet = np.linalg.slogdet(CovMat)
-        if _sign < 0:
-            warn("The correlation matrix of cluster %d has a negative determinant (whaaat??)" % c)
+# -----------------------------------------------------------------------------
+# Stacked statistics
+# -----------------------------------------------------------------------------
+def _take(array, indices):
+    """Return array[indices], as a view without any copy if the indices are
+    sorted and contiguous."""
+    indices = np.asarray(indices, dtype=np.int64)
+    if (len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1 
+        and np.all(np.diff(indices) == 1)):
+        return array[indices[0]:indices[-1] + 1]
+    return array[indices]
+
+class StackedStatistics(object):
+    """Statistics of all clusters stacked in arrays, shared by the
+    similarity measures. The attributes have one row per cluster of
+    `clusters`."""
+    def __init__(self, stats, clusters, nPoints):
+        self.clusters = clusters
+        self.nPoints = nPoints
+        self.mu = np.vstack([stats[cj][0] for cj in clusters])
+        # Only the triangular factors of the covariance matrices are
+        # stacked: CovMat = factor * factor^T.
+        self.factor = np.array([stats[cj][2] for cj in clusters])
+        self.logdet = np.array([stats[cj][3] for cj in clusters])
+        self.npoints = np.array([stats[cj][4] for cj in clusters])
+        self.unmask = np.vstack([stats[cj][5] for cj in clusters])
+        self.nDims = self.mu.shape[1]
+        
+    def solve(self, sim, b):
+        """Return Lj^-1 b[j] for all j in sim, where Lj is the triangular
+        factor of the covariance matrix of j, with a batched solve. b has
+        the shape (len(sim), nDims, k)."""
+        return np.linalg.solve(_take(self.factor, sim), b)
+        
+    def mahalanobis(self, i, sim):
+        """Return the squared Mahalanobis distances between mu_i and mu_j,
+        with the covariance matrix of j, for all j in sim."""
+        dmu = _take(self.mu, sim) - self.mu[i]
+        b = self.solve(sim, dmu[..., np.newaxis])[..., 0]
+        return (b ** 2).sum(axis=1)
 
-        # Boolean vector of size (nchannels,): which channels are unmasked?
-        unmask = (MyMasks>0).mean(axis=0)
 
-        stats[c] = (Mean, CovMat, CovMatinv, LogDet, len(MyPoints), unmask)
+# -----------------------------------------------------------------------------
+# Similarity measures
+# -----------------------------------------------------------------------------
+# Every similarity measure takes the stacked statistics, the relative index
+# i of a cluster and the relative indices sim of the clusters to compare it
+# with, and returns the similarity values of the pairs (i, j), j in sim.
+def similarity_gaussian(stacked, i, sim):
+    """Probability that mu_i belongs to Cj (approximation of the original
+    Klusters grouping assistant, with an integral instead of a sum):
+    
+        $$p_{ij} = w_j * N(\mu_i | \mu_j; C_j)$$
+        
+    where wj is the relative size of cluster j.
+    
+    """
+    # nPoints is the total number of spikes.
+    w = stacked.npoints[sim].astype(np.float64) / stacked.nPoints
+    logp0 = (np.log(2*np.pi)*(-stacked.nDims/2.) + 
+        (-.5*stacked.logdet[sim]))
+    return w * np.exp(logp0 - .5 * stacked.mahalanobis(i, sim))
+
+def similarity_kl(stacked, i, sim):
+    """exp(-KL(N_i || N_j)), where KL is the Kullback-Leibler divergence
+    between the Gaussian distributions of the clusters."""
+    # tr(Cj^-1 Ci) = ||Lj^-1 Li||^2 with the triangular factors. The
+    # Mahalanobis terms are obtained with the same solve.
+    dmu = _take(stacked.mu, sim) - stacked.mu[i]
+    b = np.empty((len(dmu), stacked.nDims, stacked.nDims + 1))
+    b[:, :, 0] = dmu
+    b[:, :, 1:] = stacked.factor[i]
+    x = stacked.solve(sim, b)
+    mahalanobis = (x[:, :, 0] ** 2).sum(axis=1)
+    trace = (x[:, :, 1:] ** 2).sum(axis=2).sum(axis=1)
+    kl = .5 * (trace + mahalanobis - stacked.nDims + 
+        stacked.logdet[sim] - stacked.logdet[i])
+    return np.exp(-np.maximum(kl, 0))
+
+def similarity_bhattacharyya(stacked, i, sim):
+    """Bhattacharyya coefficient exp(-DB) between the Gaussian
+    distributions of the clusters."""
+    factor = _take(stacked.factor, sim)
+    covmat = .5 * (np.einsum('jkl,jml->jkm', factor, factor) + 
+        np.dot(stacked.factor[i], stacked.factor[i].T))
+    dmu = _take(stacked.mu, sim) - stacked.mu[i]
+    d2 = (dmu * np.linalg.solve(covmat, dmu[..., np.newaxis])[..., 0]).sum(
+        axis=1)
+    _, logdet = np.linalg.slogdet(covmat)
+    db = (d2 / 8. + .5 * (logdet - 
+        .5 * (stacked.logdet[sim] + stacked.logdet[i])))
+    return np.exp(-np.maximum(db, 0))
+
+def similarity_cosine(stacked, i, sim):
+    """Cosine between the mean feature vectors of the clusters, clipped to
+    positive values. This is the fastest measure."""
+    mu = _take(stacked.mu, sim)
+    mui = stacked.mu[i]
+    norms = np.sqrt((mu ** 2).sum(axis=1) * (mui ** 2).sum())
+    cosine = np.zeros(len(sim))
+    indices = norms > 0
+    cosine[indices] = np.dot(mu[indices], mui) / norms[indices]
+    return np.maximum(cosine, 0)
+
+# Available similarity measures, selected with the `similarity_measure`
+# user preference.
+SIMILARITY_MEASURES = {
+    'gaussian': similarity_gaussian,
+    'kl': similarity_kl,
+    'bhattacharyya': similarity_bhattacharyya,
+    'cosine': similarity_cosine,
+}
+
+def register_similarity_measure(name, measure):
+    """Register a new similarity measure (see `similarity_gaussian`)."""
+    SIMILARITY_MEASURES[name] = measure
+
+def get_similarity_measure(name=None):
+    """Return the similarity measure with the given name, or the Gaussian
+    one if the name is None or unknown."""
+    if name is None:
+        name = 'gaussian'
+    if name not in SIMILARITY_MEASURES:
+        warn("Unknown similarity measure '{0:s}', using 'gaussian'.".format(
+            str(name)))
+        name = 'gaussian'
+    return SIMILARITY_MEASURES[name]
 
-    return stats
 
+# -----------------------------------------------------------------------------
+# Correlation matrix
+# -----------------------------------------------------------------------------
 def compute_correlations_approximation(features, clusters, masks,
-        clusters_to_update=None, similarity_measure=None):
+        clusters_to_update=None, similarity_measure=None, stats=None):
     """Compute the correlation matrix between every pair of clusters.
 
-    Use an approximation of the original Klusters grouping assistant, with
-    an integral instead of a sum (integral of the product of the Gaussian
-    densities).
+    By default, use an approximation of the original Klusters grouping
+    assistant, with an integral instead of a sum (integral of the product
+    of the Gaussian densities). Other measures can be selected with
+    `similarity_measure` (see `SIMILARITY_MEASURES`).
 
-    A dictionary pairs => value is returned.
+    A MatrixBlock with the rows of the clusters to update is returned. The
+    symmetric pairs of the clusters whose masks do not overlap are also in
+    the block, with null values.
 
     Compute all (i, *) and (i, *) for i in clusters_to_update
 
+    The cluster statistics can be given in `stats` (see
+    `ClusterStatistics`), otherwise they are computed here.
+
     """
     nPoints = features.shape[0] #size(Fet1, 1)
-    nDims = features.shape[1] #size(Fet1, 2)
-    c = np.unique(clusters)
-
-    spikes_in_clusters = dict([(clu, np.nonzero(clusters == clu)[0]) for clu in c])
-    nclusters = len(spikes_in_clusters)
+    measure = get_similarity_measure(similarity_measure)
 
-    stats = compute_statistics(features, features, spikes_in_clusters, masks)
+    if stats is None:
+        c = np.unique(clusters)
+        spikes_in_clusters = dict([(clu, np.nonzero(clusters == clu)[0]) 
+            for clu in c])
+        stats = compute_statistics(features, features, spikes_in_clusters, 
+            masks)
 
     clusterslist = sorted(stats.keys())
 
-    # New matrix (clu0, clu1) => new value
-    C = {}
-
     if clusters_to_update is None:
         clusters_to_update = clusterslist
 
+    if not clusterslist:
+        return MatrixBlock.empty()
+
+    # New matrix rows (clu0, clu1) => new value
+    C = np.zeros((len(clusters_to_update), len(clusterslist)))
+    # Pairs (clu0, clu1) whose masks overlap.
+    overlap = np.zeros(C.shape, dtype=np.bool)
+
+    # Stack the statistics of all clusters.
+    stacked = StackedStatistics(stats, clusterslist, nPoints)
+    clusters_relative = dict((cj, j) for j, cj in enumerate(clusterslist))
+    # Clusters unmasked on every feature.
+    index = get_unmask_index(stacked.unmask)
+
     # Update the new matrix on the rows and diagonals of the clusters to
     # update.
-    for ci in clusters_to_update:
+    for i, ci in enumerate(clusters_to_update):
 
         # WARNING: some cluster statistics may be missing, as we only
         # use a subset of all spikes when computing the similarity matrix
         # (to avoid loading all features from HDF5). If a cluster is
         # missing, we set the similarity value to 0.
         if ci not in stats:
-            for cj in clusterslist:
-                C[ci, cj] = C[cj, ci] = 0.
             continue
+        
+        j = clusters_relative[ci]
 
-        mui, Ci, Ciinv, logdeti, npointsi, unmaski = stats[ci]
-        for cj in clusterslist:
-            muj, Cj, Cjinv, logdetj, npointsj, unmaskj = stats[cj]
-
-            # Only go on if the two cluster mask vectors are similar enough.
-            sim = (unmaski * unmaskj).max()
-            if sim < .99:
-                C[ci, cj] = C[cj, ci] = 0.
-                continue
-
-            dmu = (muj - mui).reshape((-1, 1))
+        # Only go on if the two cluster mask vectors are similar enough.
+        sim = get_overlapping_clusters(index, stacked.unmask, 
+            stacked.unmask[j])
+        C[i, sim] = measure(stacked, j, sim)
+        overlap[i, sim] = True
 
-            # pij is the probability that mui belongs to Cj:
-            #    $$p_{ij} = w_j * N(\mu_i | \mu_j; C_j)$$
-            # where wj is the relative size of cluster j
-            # pii is the probability that mui belongs to Ci
-            try:
-                bj = np.linalg.solve(Cj, dmu) #, sym_pos=True)  # we can use this option, but this requires scipy
-            except np.linalg.LinAlgError:
-                bj = np.linalg.lstsq(Cj, dmu)[0]
-            logpij = np.log(2*np.pi)*(-nDims/2.)+\
-                        (-.5*logdetj)+(-.5) * np.dot(bj.T, dmu)
-
-            # nPoints is the total number of spikes.
-            wj = float(npointsj) / nPoints
-
-            C[ci, cj] = wj * np.exp(logpij)[0,0]
-
-
-    return C
+    # The pairs (cj, ci) are null when the masks do not overlap, and they
+    # are computed with the row of cj otherwise.
+    return MatrixBlock(clusters_to_update, clusterslist, C, mirror='same',
+        mirror_mask=~overlap)
 
 def get_similarity_matrix(dic):
     """Return a correlation matrix from a dictionary. Normalization happens
@@ -202,14 +567,26 @@ def get_similarity_matrix(dic):
     return matrix
 
 def normalize(matrix, direction='row'):
-
+    """Normalize the rows or the columns of a dense matrix or a scipy CSR
+    matrix in place, so that their sums are 1."""
+    
     if direction == 'row':
-        s = matrix.sum(axis=1)
+        s = np.asarray(matrix.sum(axis=1)).ravel()
     else:
-        s = matrix.sum(axis=0)
+        s = np.asarray(matrix.sum(axis=0)).ravel()
 
     # Non-null rows.
     indices = (s != 0)
+    
+    # Sparse matrix: scale the stored values only.
+    if is_sparse(matrix):
+        scale = np.ones(len(s))
+        scale[indices] = 1. / s[indices]
+        if direction == 'row':
+            matrix.data *= np.repeat(scale, np.diff(matrix.indptr))
+        else:
+            matrix.data *= scale[matrix.indices]
+        return matrix
 
     # Row normalization.
     if direction == 'row':
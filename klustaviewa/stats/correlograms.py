@@ -9,10 +9,274 @@ from itertools import product
 import numpy as np
 
 from kwiklib.utils import logger as log
+from klustaviewa.stats.indexed_matrix import MatrixBlock
 
+
+# -----------------------------------------------------------------------------
+# Global variables
+# -----------------------------------------------------------------------------
+NCORRBINS_DEFAULT = 100
+CORRBIN_DEFAULT = .001
+
+# Maximum number of (pair, bin) keys accumulated by the NumPy version before
+# they are histogrammed.
+NKEYS_MAX = 10000000
+
+# Number of spikes loaded at once when streaming the whole recording.
+STREAM_CHUNK_SIZE = 1000000
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def _relative_indices(clusters_unique, clusters_to_update):
+    """Return the row of each cluster to update (-1 for the clusters that
+    do not need to be updated), and the column of each cluster."""
+    cluster_max = max(clusters_unique[-1], np.max(clusters_to_update))
+    clusters_rows = -np.ones(cluster_max + 1, dtype=np.int32)
+    clusters_rows[clusters_to_update] = np.arange(len(clusters_to_update))
+    clusters_columns = np.zeros(cluster_max + 1, dtype=np.int32)
+    clusters_columns[clusters_unique] = np.arange(len(clusters_unique))
+    return clusters_rows, clusters_columns
+
+def _signed_spiketimes(spiketimes):
+    """Return the spike times as a signed array, so that delays can be
+    negative. Unsigned spike times in samples, as stored in the .kwik
+    files, are viewed as int64 without copy."""
+    spiketimes = np.asarray(spiketimes)
+    if spiketimes.dtype == np.uint64:
+        return spiketimes.view(np.int64)
+    elif spiketimes.dtype.kind in 'iu':
+        return np.asarray(spiketimes, dtype=np.int64)
+    return spiketimes
+
+def _correlograms_block(correlograms, clusters_to_update, clusters_unique):
+    """Convert the relative correlograms array into a MatrixBlock, whose
+    row i is the cluster clusters_to_update[i]. The symmetric pairs are the
+    reversed correlograms."""
+    return MatrixBlock(clusters_to_update, clusters_unique,
+        correlograms.reshape((len(clusters_to_update), 
+            len(clusters_unique), -1)), mirror='reversed')
+
+def _empty_block(ncorrbins):
+    return MatrixBlock.empty((ncorrbins,), dtype=np.int32, mirror='reversed')
+
+
+# -----------------------------------------------------------------------------
+# Pure Python version
+# -----------------------------------------------------------------------------
+def compute_correlograms_python(spiketimes, clusters, clusters_to_update=None,
+    ncorrbins=None, corrbin=None):
+
+    if ncorrbins is None:
+        ncorrbins = NCORRBINS_DEFAULT
+    if corrbin is None:
+        corrbin = CORRBIN_DEFAULT
+
+    # Ensure ncorrbins is an even number.
+    assert ncorrbins % 2 == 0
+
+    # Compute the histogram corrbins.
+    # n = int(np.ceil(halfwidth / corrbin))
+    n = ncorrbins // 2
+    halfwidth = corrbin * n
+
+    # size of the histograms
+    spiketimes = _signed_spiketimes(spiketimes)
+    nspikes = len(spiketimes)
+
+    # unique clusters
+    clusters_unique = np.unique(clusters)
+    nclusters = len(clusters_unique)
+
+    # clusters to update
+    if clusters_to_update is None:
+        clusters_to_update = clusters_unique
+    nclusters_to_update = len(clusters_to_update)
+    if nclusters == 0 or nclusters_to_update == 0:
+        return _empty_block(ncorrbins)
+
+    # relative indices of the clusters
+    clusters_rows, clusters_columns = _relative_indices(clusters_unique,
+        clusters_to_update)
+
+    # initialize the correlograms, only for the pairs
+    # (clusters_to_update, clusters_unique)
+    correlograms = np.zeros(
+        (nclusters_to_update * nclusters, ncorrbins), dtype=np.int32)
+
+    # loop through all spikes, across all neurons, all sorted
+    for i in range(nspikes):
+        t0, cl0 = spiketimes[i], clusters[i]
+        row = clusters_rows[cl0]
+        # pass clusters that do not need to be processed
+        if row >= 0:
+            # i, t0, c0: current spike index, spike time, and cluster
+            # boundaries of the second loop
+            t0min, t0max = t0 - halfwidth, t0 + halfwidth
+            j = i + 1
+            # go forward in time up to the correlogram half-width
+            while j < nspikes:
+                t1, cl1 = spiketimes[j], clusters[j]
+                # pass clusters that do not need to be processed
+                # if clusters_mask[cl1]:
+                # compute only correlograms if necessary
+                # and avoid computing symmetric pairs twice
+                if t1 < t0max:
+                    d = t1 - t0
+                    k = int(d / corrbin) + n
+                    ind = nclusters * row + clusters_columns[cl1]
+                    correlograms[ind, k] += 1
+                else:
+                    break
+                j += 1
+            j = i - 1
+            # go backward in time up to the correlogram half-width
+            while j >= 0:
+                t1, cl1 = spiketimes[j], clusters[j]
+                # pass clusters that do not need to be processed
+                # compute only correlograms if necessary
+                # and avoid computing symmetric pairs twice
+                if t0min < t1:
+                    # positive delay, so that integer spike times are
+                    # truncated toward zero too
+                    d = t0 - t1
+                    k = n - 1 - int(d / corrbin)
+                    ind = nclusters * row + clusters_columns[cl1]
+                    correlograms[ind, k] += 1
+                else:
+                    break
+                j -= 1
+    return _correlograms_block(correlograms, clusters_to_update,
+        clusters_unique)
+
+
+# -----------------------------------------------------------------------------
+# Vectorized NumPy version
+# -----------------------------------------------------------------------------
+def compute_correlograms_numpy(spiketimes, clusters, clusters_to_update=None,
+    ncorrbins=None, corrbin=None):
+    """Compute the correlograms without any Python loop over the spikes.
+
+    The spike train is sorted, so the spikes within the half-width of every
+    spike form a contiguous window that is found with `searchsorted`. All
+    pairs (i, i + lag) are then processed for increasing lags, and the
+    (cluster pair, bin) keys are histogrammed with `bincount`. The output
+    is identical to the Cython and pure Python versions.
+
+    Integer spike times (in samples) are binned with integer arithmetic,
+    `corrbin` being then a number of samples.
+
+    """
+    if ncorrbins is None:
+        ncorrbins = NCORRBINS_DEFAULT
+    if corrbin is None:
+        corrbin = CORRBIN_DEFAULT
+
+    # Ensure ncorrbins is an even number.
+    assert ncorrbins % 2 == 0
+
+    spiketimes = _signed_spiketimes(spiketimes)
+    clusters = np.asarray(clusters)
+
+    # unique clusters
+    clusters_unique = np.unique(clusters)
+    nclusters = len(clusters_unique)
+
+    # clusters to update
+    if clusters_to_update is None:
+        clusters_to_update = clusters_unique
+    nclusters_to_update = len(clusters_to_update)
+    if nclusters == 0 or nclusters_to_update == 0:
+        return _empty_block(ncorrbins)
+
+    # relative indices of the clusters
+    clusters_rows, clusters_columns = _relative_indices(clusters_unique,
+        clusters_to_update)
+
+    correlograms = _correlograms_counts(spiketimes, clusters_rows[clusters],
+        clusters_columns[clusters], nclusters_to_update, nclusters,
+        ncorrbins, corrbin)
+    correlograms = correlograms.reshape((-1, ncorrbins))
+    return _correlograms_block(correlograms, clusters_to_update,
+        clusters_unique)
+
+def _correlograms_counts(spiketimes, rows, columns, nrows, nclusters,
+    ncorrbins, corrbin, reference=None):
+    """Return the flattened (nrows * nclusters, ncorrbins) correlograms
+    array, given the row (-1 if not updated) and the column of every
+    spike. Only the reference spikes within the range `reference` =
+    (start, end) are taken as the first spike of the pairs (all of them by
+    default)."""
+    integer = spiketimes.dtype.kind == 'i'
+    n = ncorrbins // 2
+    halfwidth = corrbin * n
+    if reference is None:
+        reference = (0, len(spiketimes))
+    reference_start, reference_end = reference
+    spikes = np.arange(reference_start, reference_end)
+    times = spiketimes[reference_start:reference_end]
+
+    # For every spike, the window [start, end) of spikes within the
+    # half-width, with exactly the same bounds as in the loop versions.
+    end = np.searchsorted(spiketimes, times + halfwidth, side='left')
+    start = np.searchsorted(spiketimes, times - halfwidth, side='right')
+    nforward = end - spikes - 1
+    nbackward = spikes - start
+    referenced = rows[reference_start:reference_end] >= 0
+
+    size = nrows * nclusters * ncorrbins
+    correlograms = np.zeros(size, dtype=np.int32)
+    keys = []
+    nkeys = 0
+
+    for direction, nlags in ((1, nforward), (-1, nbackward)):
+        # Spikes of the clusters to update with at least one neighbor in the
+        # window (relative to the reference range).
+        i = np.nonzero(referenced & (nlags >= 1))[0]
+        nlags = nlags[i]
+        i = i + reference_start
+        lag = 1
+        while len(i):
+            j = i + direction * lag
+            # Absolute delays, truncated toward zero as in the loop
+            # versions.
+            d = direction * (spiketimes[j] - spiketimes[i])
+            if integer:
+                q = d // corrbin
+            else:
+                q = (d / corrbin).astype(np.int64)
+            if direction > 0:
+                k = n + q
+            else:
+                k = n - 1 - q
+            key = (rows[i] * nclusters + columns[j]) * ncorrbins + k
+            # Discard rounding errors on the window edges.
+            keys.append(key[(k >= 0) & (k < ncorrbins)])
+            nkeys += len(key)
+            if nkeys >= NKEYS_MAX:
+                correlograms += np.bincount(np.concatenate(keys),
+                    minlength=size).astype(np.int32)
+                keys = []
+                nkeys = 0
+            lag += 1
+            remaining = nlags >= lag
+            i = i[remaining]
+            nlags = nlags[remaining]
+    if keys:
+        correlograms += np.bincount(np.concatenate(keys),
+            minlength=size).astype(np.int32)
+    return correlograms
+
+
+# -----------------------------------------------------------------------------
+# Backend selection
+# -----------------------------------------------------------------------------
 # Trying to load the Cython version.
 try:
-    from correlograms_cython import compute_correlograms_cython as compute_correlograms
+    from correlograms_cython import (
+        compute_correlograms_cython as _compute_correlograms_float,
+        compute_correlograms_cython_int as _compute_correlograms_int)
     log.debug(("Trying to load the compiled Cython version of the correlograms"
                "computations..."))
 except Exception as e:
@@ -21,101 +285,193 @@ except Exception as e:
         log.debug(("failed. Trying to use Cython directly..."))
         import pyximport; pyximport.install(
             setup_args={'include_dirs': np.get_include()})
-        from correlograms_cython import compute_correlograms_cython as compute_correlograms
+        from correlograms_cython import (
+            compute_correlograms_cython as _compute_correlograms_float,
+            compute_correlograms_cython_int as _compute_correlograms_int)
     except Exception as e:
         log.debug(e.message)
         log.info(("Unable to load the fast Cython version of the correlograms"
-                   "computations, so falling back to the pure Python version.")
+                   "computations, so falling back to the NumPy version.")
                    )
+        _compute_correlograms_float = compute_correlograms_numpy
+        _compute_correlograms_int = compute_correlograms_numpy
 
-        # Pure Python version.
-        # --------------------
-        def compute_correlograms(spiketimes, clusters, clusters_to_update=None,
-            ncorrbins=None, corrbin=None):
-            
-            if ncorrbins is None:
-                ncorrbins = NCORRBINS_DEFAULT
-            if corrbin is None:
-                corrbin = CORRBIN_DEFAULT
-            
-            # Ensure ncorrbins is an even number.
-            assert ncorrbins % 2 == 0
-            
-            # Compute the histogram corrbins.
-            # n = int(np.ceil(halfwidth / corrbin))
-            n = ncorrbins // 2
-            halfwidth = corrbin * n
-            
-            # size of the histograms
-            nspikes = len(spiketimes)
-            
-            # unique clusters
-            clusters_unique = np.unique(clusters)
-            nclusters = len(clusters_unique)
-            cluster_max = clusters_unique[-1]
-            
-            # clusters to update
-            if clusters_to_update is None:
-                clusters_to_update = clusters_unique
-            clusters_mask = np.zeros(cluster_max + 1, dtype=np.bool)
-            clusters_mask[clusters_to_update] = 1
-            
-            # initialize the correlograms
-            correlograms = np.zeros(
-        ((cluster_max + 1) ** 2, ncorrbins), dtype=np.int32)
-
-            # loop through all spikes, across all neurons, all sorted
-            for i in range(nspikes):
-                t0, cl0 = spiketimes[i], clusters[i]
-                # pass clusters that do not need to be processed
-                if clusters_mask[cl0]:
-                    # i, t0, c0: current spike index, spike time, and cluster
-                    # boundaries of the second loop
-                    t0min, t0max = t0 - halfwidth, t0 + halfwidth
-                    j = i + 1
-                    # go forward in time up to the correlogram half-width
-                    while j < nspikes:
-                        t1, cl1 = spiketimes[j], clusters[j]
-                        # pass clusters that do not need to be processed
-                        # if clusters_mask[cl1]:
-                        # compute only correlograms if necessary
-                        # and avoid computing symmetric pairs twice
-                        if t1 < t0max:
-                            d = t1 - t0
-                            k = int(d / corrbin) + n
-                            ind = (cluster_max + 1) * cl0 + cl1
-                            correlograms[ind, k] += 1
-                        else:
-                            break
-                        j += 1
-                    j = i - 1
-                    # go backward in time up to the correlogram half-width
-                    while j >= 0:
-                        t1, cl1 = spiketimes[j], clusters[j]
-                        # pass clusters that do not need to be processed
-                        # compute only correlograms if necessary
-                        # and avoid computing symmetric pairs twice
-                        if t0min < t1:
-                            d = t1 - t0
-                            k = int(d / corrbin) + n - 1
-                            ind = (cluster_max + 1) * cl0 + cl1
-                            correlograms[ind, k] += 1
-                        else:
-                            break
-                        j -= 1
-            dic = {(cl0, cl1): correlograms[(cluster_max + 1) * cl0 + cl1,:][::-1]
-                for cl0 in clusters_to_update for cl1 in clusters_unique}
-            # Add the symmetric pairs.
-            dic.update({(cl1, cl0): dic[cl0, cl1]
-                for cl0 in clusters_to_update for cl1 in clusters_unique})
-            return dic
+def compute_correlograms(spiketimes, clusters, clusters_to_update=None,
+    ncorrbins=None, corrbin=None):
+    """Compute the correlograms with the fastest available version.
+
+    Spike times are either in seconds (float64), or in samples (integers,
+    as stored in the .kwik files) with `corrbin` in samples too. In the
+    latter case, the spike train is not converted and the bin edges are
+    exact.
+
+    """
+    if ncorrbins is None:
+        ncorrbins = NCORRBINS_DEFAULT
+    spiketimes = _signed_spiketimes(spiketimes)
+    if spiketimes.dtype.kind == 'i':
+        assert corrbin is not None and corrbin == int(corrbin), (
+            "The bin size must be a number of samples.")
+        return _compute_correlograms_int(spiketimes, clusters,
+            clusters_to_update=clusters_to_update,
+            ncorrbins=ncorrbins, corrbin=int(corrbin))
+    if corrbin is None:
+        corrbin = CORRBIN_DEFAULT
+    return _compute_correlograms_float(spiketimes, clusters,
+        clusters_to_update=clusters_to_update,
+        ncorrbins=ncorrbins, corrbin=corrbin)
 
 
 # -----------------------------------------------------------------------------
-# Global variables
+# Parallel computation
 # -----------------------------------------------------------------------------
-NCORRBINS_DEFAULT = 100
-CORRBIN_DEFAULT = .001
+def _compute_correlograms_chunk(args):
+    spiketimes, clusters, clusters_to_update, ncorrbins, corrbin = args
+    return compute_correlograms(spiketimes, clusters,
+        clusters_to_update=clusters_to_update,
+        ncorrbins=ncorrbins, corrbin=corrbin)
+
+def sum_correlograms(correlograms_list):
+    """Sum the correlograms (MatrixBlock instances) computed on independent
+    parts of the spike train, which may contain different clusters."""
+    nonempty = [correlograms for correlograms in correlograms_list
+        if len(correlograms.rows) > 0 and len(correlograms.columns) > 0]
+    if not nonempty:
+        return correlograms_list[0]
+    correlograms_list = nonempty
+    rows = np.unique(np.hstack([correlograms.rows 
+        for correlograms in correlograms_list]))
+    columns = np.unique(np.hstack([correlograms.columns 
+        for correlograms in correlograms_list]))
+    data = np.zeros((len(rows), len(columns)) + 
+        correlograms_list[0].data.shape[2:], dtype=np.int32)
+    for correlograms in correlograms_list:
+        data[np.ix_(np.searchsorted(rows, correlograms.rows),
+            np.searchsorted(columns, correlograms.columns))] += \
+                correlograms.data
+    return MatrixBlock(rows, columns, data, mirror='reversed')
+
+def compute_correlograms_parallel(spiketimes_excerpts, clusters_excerpts,
+    clusters_to_update=None, ncorrbins=None, corrbin=None, pool=None,
+    nchunks=None, cancelled=None):
+    """Compute the correlograms on a list of excerpts of the spike train.
+
+    The excerpts are grouped into `nchunks` chunks of successive excerpts,
+    which are histogrammed in parallel in the `multiprocessing` pool, and
+    the counts are summed. Only the pairs straddling two chunks are lost,
+    and there are none when the excerpts do not touch each other.
+    Without pool, all excerpts are processed at once.
+    
+    If `cancelled` is given, the chunks are processed one after the other
+    instead, and None is returned as soon as `cancelled()` is true.
+
+    """
+    if nchunks is None:
+        nchunks = len(spiketimes_excerpts)
+    nchunks = min(nchunks, len(spiketimes_excerpts))
+    if cancelled is None and (pool is None or nchunks <= 1):
+        return compute_correlograms(np.concatenate(spiketimes_excerpts),
+            np.concatenate(clusters_excerpts),
+            clusters_to_update=clusters_to_update,
+            ncorrbins=ncorrbins, corrbin=corrbin)
+    chunks = np.array_split(np.arange(len(spiketimes_excerpts)), nchunks)
+    args = [(np.concatenate([spiketimes_excerpts[i] for i in chunk]),
+             np.concatenate([clusters_excerpts[i] for i in chunk]),
+             clusters_to_update, ncorrbins, corrbin)
+                for chunk in chunks]
+    if cancelled is None:
+        return sum_correlograms(pool.map(_compute_correlograms_chunk, args))
+    correlograms = None
+    for arg in args:
+        if cancelled():
+            return None
+        chunk = _compute_correlograms_chunk(arg)
+        if correlograms is None:
+            correlograms = chunk
+        else:
+            correlograms = sum_correlograms([correlograms, chunk])
+    return correlograms
+
+
+# -----------------------------------------------------------------------------
+# Full recording
+# -----------------------------------------------------------------------------
+def compute_correlograms_stream(spiketimes, clusters, clusters_to_update=None,
+    clusters_unique=None, ncorrbins=None, corrbin=None, chunk_size=None,
+    progress=None):
+    """Compute the exact correlograms on the whole spike train, which is
+    read chunk after chunk.
+
+    `spiketimes` and `clusters` can be any arrays supporting slicing, like
+    HDF5 arrays. Every chunk of reference spikes is processed along with
+    the spikes within the half-width before and after it, so that no pair
+    is lost. `progress(nspikes_done, nspikes)` is called after every chunk.
+
+    """
+    if ncorrbins is None:
+        ncorrbins = NCORRBINS_DEFAULT
+    if corrbin is None:
+        corrbin = CORRBIN_DEFAULT
+    if chunk_size is None:
+        chunk_size = STREAM_CHUNK_SIZE
+    assert ncorrbins % 2 == 0
+    halfwidth = corrbin * (ncorrbins // 2)
+    nspikes = len(spiketimes)
+
+    # unique clusters
+    if clusters_unique is None:
+        clusters_unique = np.unique(np.concatenate([np.unique(
+            clusters[start:start + chunk_size])
+                for start in xrange(0, nspikes, chunk_size)] or [[]]))
+    clusters_unique = np.asarray(clusters_unique, dtype=np.int32)
+    nclusters = len(clusters_unique)
+
+    # clusters to update
+    if clusters_to_update is None:
+        clusters_to_update = clusters_unique
+    nclusters_to_update = len(clusters_to_update)
+    if nclusters == 0 or nclusters_to_update == 0:
+        return _empty_block(ncorrbins)
+
+    # relative indices of the clusters
+    clusters_rows, clusters_columns = _relative_indices(clusters_unique,
+        clusters_to_update)
+
+    correlograms = np.zeros(nclusters_to_update * nclusters * ncorrbins, 
+        dtype=np.int32)
+    # Buffer with the spikes loaded so far, starting at the absolute index
+    # `buffer_start`.
+    times = _signed_spiketimes(spiketimes[:0])
+    rows = columns = np.zeros(0, dtype=np.int32)
+    buffer_start = loaded = 0
+    for start in xrange(0, nspikes, chunk_size):
+        end = min(start + chunk_size, nspikes)
+        # Load the chunk, and the spikes within the half-width after it.
+        while loaded < nspikes and (loaded < end or 
+                times[-1] < times[end - buffer_start - 1] + halfwidth):
+            stop = min(loaded + chunk_size, nspikes)
+            clusters_chunk = np.asarray(clusters[loaded:stop])
+            times = np.concatenate((times, 
+                _signed_spiketimes(spiketimes[loaded:stop])))
+            rows = np.concatenate((rows, clusters_rows[clusters_chunk]))
+            columns = np.concatenate((columns, 
+                clusters_columns[clusters_chunk]))
+            loaded = stop
+        correlograms += _correlograms_counts(times, rows, columns,
+            nclusters_to_update, nclusters, ncorrbins, corrbin,
+            reference=(start - buffer_start, end - buffer_start))
+        # Only keep the spikes within the half-width before the next chunk.
+        keep = min(np.searchsorted(times, 
+            times[end - buffer_start - 1] - halfwidth, side='right'),
+            end - buffer_start)
+        times, rows, columns = times[keep:], rows[keep:], columns[keep:]
+        buffer_start += keep
+        if progress is not None:
+            progress(end, nspikes)
+
+    correlograms = correlograms.reshape((-1, ncorrbins))
+    return _correlograms_block(correlograms, clusters_to_update,
+        clusters_unique)
 
 
 # -----------------------------------------------------------------------------
@@ -132,6 +488,56 @@ def compute_one_correlogram(spikes0, spikes1, ncorrbins, corrbin):
     return C[0, 1]
 
 
+# -----------------------------------------------------------------------------
+# Rebinning
+# -----------------------------------------------------------------------------
+def get_base_binning(ncorrbins, corrbin, corrbin_base=None, 
+    ncorrbins_base=None):
+    """Return the binning (ncorrbins, corrbin) of the correlograms to
+    compute, from which the requested binning can be derived, as well as
+    the binnings with larger bins or narrower windows.
+    
+    `corrbin_base` is the finest bin size, which is only used if it divides
+    `corrbin`, and `ncorrbins_base` the number of such bins in the widest
+    window. Bin sizes are in samples. If `corrbin_base` is not used, the
+    widest window keeps the same width with bins of size `corrbin`.
+    
+    The cached correlograms take `ncorrbins_base / ncorrbins` times the
+    memory of the displayed ones.
+    
+    """
+    if ncorrbins_base is not None:
+        # Half-width of the widest window, in samples.
+        halfwidth_base = ncorrbins_base // 2 * (corrbin_base or corrbin)
+    if corrbin_base is None or corrbin % corrbin_base != 0:
+        corrbin_base = corrbin
+    n = ncorrbins // 2 * (corrbin // corrbin_base)
+    if ncorrbins_base is not None:
+        n = max(n, -(-halfwidth_base // corrbin_base))
+    return 2 * n, corrbin_base
+    
+def get_rebin_factor(ncorrbins, corrbin, ncorrbins_base, corrbin_base):
+    """Return the number of base bins in every bin of the requested
+    binning, or None if it cannot be derived from the base binning."""
+    if ncorrbins % 2 != 0 or corrbin % corrbin_base != 0:
+        return None
+    factor = corrbin // corrbin_base
+    if ncorrbins // 2 * factor > ncorrbins_base // 2:
+        return None
+    return factor
+    
+def rebin_correlograms(correlograms, factor, ncorrbins):
+    """Sum the adjacent bins of the correlograms (along the last axis) by
+    groups of `factor`, on both sides of the center, and keep the
+    `ncorrbins` central bins. The bins are exactly those that would be
+    obtained by computing the correlograms with this binning directly."""
+    nbins = correlograms.shape[-1]
+    n = ncorrbins // 2 * factor
+    correlograms = correlograms[..., nbins // 2 - n:nbins // 2 + n]
+    return correlograms.reshape(correlograms.shape[:-1] + 
+        (ncorrbins, factor)).sum(axis=-1)
+    
+
 # -----------------------------------------------------------------------------
 # Baselines
 # -----------------------------------------------------------------------------
@@ -162,10 +568,15 @@ def excerpts(nsamples, nexcerpts=None, excerpt_size=None):
         end = min(start + excerpt_size, nsamples)
         yield start, end
 
-def get_excerpts(data, nexcerpts=None, excerpt_size=None):
+def split_excerpts(data, nexcerpts=None, excerpt_size=None):
+    """Return the list of excerpts."""
     nsamples = data.shape[0]
-    return np.concatenate([data[start:end,...] 
-                          for (start, end) in excerpts(nsamples, 
-                                                       nexcerpts=nexcerpts, 
-                                                       excerpt_size=excerpt_size)], 
+    return [data[start:end,...] 
+                for (start, end) in excerpts(nsamples, 
+                                             nexcerpts=nexcerpts, 
+                                             excerpt_size=excerpt_size)]
+
+def get_excerpts(data, nexcerpts=None, excerpt_size=None):
+    return np.concatenate(split_excerpts(data, nexcerpts=nexcerpts, 
+                                         excerpt_size=excerpt_size), 
                           axis=-1)
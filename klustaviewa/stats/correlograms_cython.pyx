@@ -1,9 +1,19 @@
 import numpy as np
 cimport numpy as np
+from klustaviewa.stats.indexed_matrix import MatrixBlock
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
 DTYPEI = np.int32
 ctypedef np.int32_t DTYPEI_t
+DTYPEL = np.int64
+ctypedef np.int64_t DTYPEL_t
+
+def _correlograms_block(correlograms, clusters_to_update, clusters_unique):
+    # Row i of the block is the cluster clusters_to_update[i], and the
+    # symmetric pairs are the reversed correlograms.
+    return MatrixBlock(clusters_to_update, clusters_unique,
+        correlograms.reshape((len(clusters_to_update), 
+            len(clusters_unique), -1)), mirror='reversed')
 
 def compute_correlograms_cython(
      np.ndarray[DTYPE_t, ndim=1] spiketimes,
@@ -22,29 +32,42 @@ def compute_correlograms_cython(
     # size of the histograms
     cdef long nspikes = len(spiketimes)
     
-    cdef long i, j, cl0, cl1, k, ind
+    cdef long i, j, cl0, cl1, k, ind, row
     cdef double t0, t1, t0min, t0max, d
 
     # unique clusters
     cdef np.ndarray[DTYPEI_t, ndim=1] clusters_unique = np.unique(clusters)
     cdef long nclusters = len(clusters_unique)
-    cdef long cluster_max = clusters_unique[-1]
     
     # clusters to update
     if clusters_to_update is None:
         clusters_to_update = clusters_unique
-    cdef np.ndarray[DTYPEI_t, ndim=1] clusters_mask = np.zeros(cluster_max + 1, dtype=DTYPEI)
-    clusters_mask[clusters_to_update] = 1
+    cdef long nclusters_to_update = len(clusters_to_update)
+    if nclusters == 0 or nclusters_to_update == 0:
+        return MatrixBlock.empty((ncorrbins,), dtype=DTYPEI, 
+            mirror='reversed')
+    cdef long cluster_max = max(clusters_unique[-1], clusters_to_update.max())
+    
+    # relative indices: row of each cluster to update (-1 for the clusters
+    # that do not need to be updated), and column of each cluster
+    cdef np.ndarray[DTYPEI_t, ndim=1] clusters_rows = -np.ones(
+        cluster_max + 1, dtype=DTYPEI)
+    clusters_rows[clusters_to_update] = np.arange(nclusters_to_update)
+    cdef np.ndarray[DTYPEI_t, ndim=1] clusters_columns = np.zeros(
+        cluster_max + 1, dtype=DTYPEI)
+    clusters_columns[clusters_unique] = np.arange(nclusters)
     
-    # initialize the correlograms
+    # initialize the correlograms, only for the pairs
+    # (clusters_to_update, clusters_unique)
     cdef np.ndarray[DTYPEI_t, ndim=2] correlograms = np.zeros(
-        ((cluster_max + 1) ** 2, ncorrbins), dtype=DTYPEI)
+        (nclusters_to_update * nclusters, ncorrbins), dtype=DTYPEI)
 
     # loop through all spikes, across all neurons, all sorted
     for i in xrange(nspikes):
         t0, cl0 = spiketimes[i], clusters[i]
+        row = clusters_rows[cl0]
         # pass clusters that do not need to be processed
-        if clusters_mask[cl0]:
+        if row >= 0:
             # i, t0, c0: current spike index, spike time, and cluster
             # boundaries of the second loop
             t0min, t0max = t0 - halfwidth, t0 + halfwidth
@@ -57,7 +80,7 @@ def compute_correlograms_cython(
                 if t1 < t0max:
                     d = t1 - t0
                     k = long(d / corrbin) + n
-                    ind = (cluster_max + 1) * cl0 + cl1
+                    ind = nclusters * row + clusters_columns[cl1]
                     correlograms[ind, k] += 1
                 else:
                     break
@@ -71,14 +94,94 @@ def compute_correlograms_cython(
                 if t0min < t1:
                     d = t1 - t0
                     k = long(d / corrbin) + n - 1
-                    ind = (cluster_max + 1) * cl0 + cl1
+                    ind = nclusters * row + clusters_columns[cl1]
+                    correlograms[ind, k] += 1
+                else:
+                    break
+                j -= 1
+    return _correlograms_block(correlograms, clusters_to_update,
+        clusters_unique)
+
+def compute_correlograms_cython_int(
+     np.ndarray[DTYPEL_t, ndim=1] spiketimes,
+     np.ndarray[DTYPEI_t, ndim=1] clusters,
+     np.ndarray[DTYPEI_t, ndim=1] clusters_to_update=None,
+     long ncorrbins=100,
+     long corrbin=20):
+    """Same as compute_correlograms_cython, with spike times and bin size
+    expressed in samples: only integer arithmetic in the loops."""
+    
+    # Ensure ncorrbins is an even number.
+    assert ncorrbins % 2 == 0
+    assert corrbin > 0
+    
+    # Compute the histogram corrbins.
+    cdef long n = ncorrbins // 2
+    cdef long halfwidth = corrbin * n
+    
+    # size of the histograms
+    cdef long nspikes = len(spiketimes)
+    
+    cdef long i, j, cl0, cl1, k, ind, row
+    cdef long t0, t1, t0min, t0max
+
+    # unique clusters
+    cdef np.ndarray[DTYPEI_t, ndim=1] clusters_unique = np.unique(clusters)
+    cdef long nclusters = len(clusters_unique)
+    
+    # clusters to update
+    if clusters_to_update is None:
+        clusters_to_update = clusters_unique
+    cdef long nclusters_to_update = len(clusters_to_update)
+    if nclusters == 0 or nclusters_to_update == 0:
+        return MatrixBlock.empty((ncorrbins,), dtype=DTYPEI, 
+            mirror='reversed')
+    cdef long cluster_max = max(clusters_unique[-1], clusters_to_update.max())
+    
+    # relative indices: row of each cluster to update (-1 for the clusters
+    # that do not need to be updated), and column of each cluster
+    cdef np.ndarray[DTYPEI_t, ndim=1] clusters_rows = -np.ones(
+        cluster_max + 1, dtype=DTYPEI)
+    clusters_rows[clusters_to_update] = np.arange(nclusters_to_update)
+    cdef np.ndarray[DTYPEI_t, ndim=1] clusters_columns = np.zeros(
+        cluster_max + 1, dtype=DTYPEI)
+    clusters_columns[clusters_unique] = np.arange(nclusters)
+    
+    # initialize the correlograms, only for the pairs
+    # (clusters_to_update, clusters_unique)
+    cdef np.ndarray[DTYPEI_t, ndim=2] correlograms = np.zeros(
+        (nclusters_to_update * nclusters, ncorrbins), dtype=DTYPEI)
+
+    # loop through all spikes, across all neurons, all sorted
+    for i in xrange(nspikes):
+        t0, cl0 = spiketimes[i], clusters[i]
+        row = clusters_rows[cl0]
+        # pass clusters that do not need to be processed
+        if row >= 0:
+            t0min, t0max = t0 - halfwidth, t0 + halfwidth
+            j = i + 1
+            # go forward in time up to the correlogram half-width
+            while j < nspikes:
+                t1, cl1 = spiketimes[j], clusters[j]
+                if t1 < t0max:
+                    # the delay is positive: the division truncates
+                    # toward zero as in the floating-point version
+                    k = (t1 - t0) // corrbin + n
+                    ind = nclusters * row + clusters_columns[cl1]
+                    correlograms[ind, k] += 1
+                else:
+                    break
+                j += 1
+            j = i - 1
+            # go backward in time up to the correlogram half-width
+            while j >= 0:
+                t1, cl1 = spiketimes[j], clusters[j]
+                if t0min < t1:
+                    k = n - 1 - (t0 - t1) // corrbin
+                    ind = nclusters * row + clusters_columns[cl1]
                     correlograms[ind, k] += 1
                 else:
                     break
                 j -= 1
-    dic = {(cl0, cl1): correlograms[(cluster_max + 1) * cl0 + cl1,:][::-1]
-        for cl0 in clusters_to_update for cl1 in clusters_unique}
-    # Add the symmetric pairs.
-    dic.update({(cl1, cl0): dic[cl0, cl1]
-        for cl0 in clusters_to_update for cl1 in clusters_unique})
-    return dic
+    return _correlograms_block(correlograms, clusters_to_update,
+        clusters_unique)
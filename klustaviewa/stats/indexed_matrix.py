@@ -8,6 +8,12 @@ from itertools import product
 
 import numpy as np
 
+# scipy is optional, it is only required by the sparse cache matrix.
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
 
 # -----------------------------------------------------------------------------
 # Utility functions
@@ -19,16 +25,184 @@ def is_default_slice(item):
 def is_indices(item):
     return (isinstance(item, list) or isinstance(item, tuple) or 
         isinstance(item, np.ndarray) or isinstance(item, (int, long, np.integer)))
+
+def lookup(table, indices, default=-1):
+    """Return table[indices], with the default value for the indices out of
+    the table."""
+    indices = np.asarray(indices, dtype=np.int64)
+    inside = (indices >= 0) & (indices < len(table))
+    values = np.empty(indices.shape, dtype=table.dtype)
+    values.fill(default)
+    values[inside] = table[indices[inside]]
+    return values
+
+def set_lookup(table, indices, values, default=-1):
+    """Set table[indices] = values, and return the table, which is 
+    reallocated with twice its size if some indices are out of it."""
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+        return table
+    if indices.min() < 0:
+        raise IndexError("Negative indices are not supported.")
+    size = indices.max() + 1
+    if size > len(table):
+        table_new = np.empty(max(2 * len(table), size), dtype=table.dtype)
+        table_new.fill(default)
+        table_new[:len(table)] = table
+        table = table_new
+    table[indices] = values
+    return table
+
+def is_sparse(matrix):
+    """Return whether a matrix is a scipy sparse matrix."""
+    return sparse is not None and sparse.issparse(matrix)
         
 
+# -----------------------------------------------------------------------------
+# Matrix block
+# -----------------------------------------------------------------------------
+class MatrixBlock(object):
+    """Values of the pairs (rows[i], columns[j]), stored in a dense array
+    data[i, j, ...].
+    
+    If `mirror` is 'same', the block also contains the symmetric pairs
+    (columns[j], rows[i]) with the same values. If `mirror` is 'reversed',
+    their values are reversed along the last axis (like correlograms).
+    `mirror_mask`, a boolean array of shape (len(rows), len(columns)),
+    restricts the symmetric pairs to those (columns[j], rows[i]) where
+    mirror_mask[i, j] is True.
+    
+    A block can be read like a dictionary (ci, cj) => value.
+    
+    """
+    def __init__(self, rows, columns, data, mirror=None, mirror_mask=None):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.columns = np.asarray(columns, dtype=np.int64)
+        self.data = data
+        self.mirror = mirror
+        self.mirror_mask = mirror_mask
+        assert data.shape[:2] == (len(self.rows), len(self.columns))
+        if mirror_mask is not None:
+            assert mirror_mask.shape == data.shape[:2]
+        self._rows_relative = None
+        self._columns_relative = None
+    
+    @staticmethod
+    def empty(shape=(), dtype=None, mirror=None):
+        """Return a block without any pair, with values of the given
+        shape."""
+        return MatrixBlock([], [], np.zeros((0, 0) + tuple(shape), 
+            dtype=dtype), mirror=mirror)
+        
+    def get_mirror_data(self):
+        """Return the values of the symmetric pairs (columns[j], rows[i]) in
+        an array data[j, i, ...], or None if there are none."""
+        if self.mirror is None:
+            return None
+        data = self.data.swapaxes(0, 1)
+        if self.mirror == 'reversed':
+            data = data[..., ::-1]
+        return data
+    
+    def get_mirror_mask(self):
+        """Return the boolean array mask[j, i], True if the symmetric pair
+        (columns[j], rows[i]) is in the block, or None if they all are."""
+        if self.mirror is None or self.mirror_mask is None:
+            return None
+        return self.mirror_mask.T
+    
+    def _in_mirror(self, i, j):
+        return self.mirror_mask is None or self.mirror_mask[i, j]
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rows_relative'] = state['_columns_relative'] = None
+        return state
+    
+    
+    # Dictionary interface
+    # --------------------
+    def _relative(self):
+        if self._rows_relative is None:
+            self._rows_relative = dict((index, i) 
+                for i, index in enumerate(self.rows))
+            self._columns_relative = dict((index, j) 
+                for j, index in enumerate(self.columns))
+        return self._rows_relative, self._columns_relative
+        
+    def __getitem__(self, key):
+        ci, cj = key
+        rows, columns = self._relative()
+        if ci in rows and cj in columns:
+            return self.data[rows[ci], columns[cj], ...]
+        if (self.mirror is not None and cj in rows and ci in columns and
+                self._in_mirror(rows[cj], columns[ci])):
+            value = self.data[rows[cj], columns[ci], ...]
+            if self.mirror == 'reversed':
+                value = value[..., ::-1]
+            return value
+        raise KeyError(key)
+    
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+    
+    def keys(self):
+        keys = [(ci, cj) for ci in self.rows for cj in self.columns]
+        if self.mirror is not None:
+            rows = set(self.rows)
+            keys.extend((cj, ci) for i, ci in enumerate(self.rows) 
+                for j, cj in enumerate(self.columns)
+                if cj not in rows and self._in_mirror(i, j))
+        return keys
+        
+    def __iter__(self):
+        return iter(self.keys())
+        
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+        
+    def items(self):
+        return list(self.iteritems())
+        
+    def values(self):
+        return [value for key, value in self.iteritems()]
+    
+    def __len__(self):
+        n = len(self.rows) * len(self.columns)
+        if self.mirror is not None:
+            outside = ~np.in1d(self.columns, self.rows)
+            if self.mirror_mask is None:
+                n += len(self.rows) * np.sum(outside)
+            else:
+                n += np.sum(self.mirror_mask[:, outside])
+        return int(n)
+    
+    def __repr__(self):
+        return '<MatrixBlock {0:d}x{1:d}>'.format(len(self.rows), 
+            len(self.columns))
+    
+
 # -----------------------------------------------------------------------------
 # Indexed matrix
 # -----------------------------------------------------------------------------
 class IndexedMatrix(object):
+    """Matrix whose rows and columns are indexed by sorted absolute indices.
+    
+    The values are stored in a square array with a capacity larger than the
+    number of indices. Every index has a slot (a row and a column) in this
+    array, and the slots of the removed indices are reused by the new
+    indices. The capacity is doubled when there is no free slot left, so
+    that adding or removing indices does not reallocate the whole array.
+    
+    """
     def __init__(self, indices=[], dtype=None, shape=None, data=None):
-        self.indices = np.sort(np.unique(indices))
+        self._set_indices(np.unique(indices))
         self.dtype = dtype
-        self.n = len(self.indices)
         if data is not None:
             shape = data.shape
         if shape is None:
@@ -37,14 +211,68 @@ class IndexedMatrix(object):
             assert shape[:2] == (self.n, self.n)
             self.shape = shape
         if data is None:
-            self._array = np.zeros(self.shape, dtype=self.dtype)
+            self._data = np.zeros(self.shape, dtype=self.dtype)
         else:
-            self._array = data
-        self.ndim = self._array.ndim
+            self._data = data
+        self.ndim = self._data.ndim
+        # Slot of every index in the array, and free slots.
+        self._slots = np.arange(self.n)
+        self._free = []
+        # Maximum capacity when doubling it, if any.
+        self.max_capacity = None
+    
+    
+    # Storage
+    # -------
+    @property
+    def capacity(self):
+        return self._data.shape[0]
+    
+    def _grow(self, capacity):
+        """Reallocate the array with a larger capacity."""
+        capacity_old = self.capacity
+        data = np.zeros((capacity, capacity) + tuple(self.shape[2:]), 
+            dtype=self._data.dtype)
+        data[:capacity_old, :capacity_old, ...] = self._data
+        self._data = data
+        # The new slots are used in increasing order.
+        self._free.extend(xrange(capacity - 1, capacity_old - 1, -1))
+    
+    def _get_slots(self, n):
+        """Return n free slots, whose rows and columns are zeros."""
+        if len(self._free) < n:
+            capacity = max(2 * self.capacity, 4)
+            if self.max_capacity is not None:
+                capacity = min(capacity, self.max_capacity)
+            self._grow(max(capacity, self.n + n))
+        slots = np.array(self._free[-n:][::-1], dtype=np.int64)
+        del self._free[-n:]
+        # The freed slots may contain old values.
+        self._data[slots, ...] = 0
+        self._data[:, slots, ...] = 0
+        return slots
+    
+    def _slots_of(self, item):
+        """Return the slots of an item: indices or default slice."""
+        if is_default_slice(item):
+            return self._slots
+        return self._slots[np.atleast_1d(self.to_relative(item, False))]
     
     
     # Indices
     # -------
+    def _set_indices(self, indices):
+        """Set the sorted indices, and update the table giving the relative
+        index of every absolute index (-1 for the absent indices)."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if not hasattr(self, '_lookup'):
+            self._lookup = np.zeros(0, dtype=np.int64)
+        else:
+            self._lookup[self.indices] = -1
+        self.indices = indices
+        self.n = len(indices)
+        self._lookup = set_lookup(self._lookup, indices, np.arange(self.n))
+        
     def add_indices(self, indices):
         """Add new indices only if they don't already exist."""
         if isinstance(indices, (int, long, np.integer)):
@@ -53,29 +281,19 @@ class IndexedMatrix(object):
             return
         # Keep only those indices which do not exist already.
         indices = self.not_in_indices(indices)
-        # Raise an error if at least one requested index is already in the
-        # current array indices.
-        if np.any(np.in1d(indices, self.indices)):
-            index = indices[np.nonzero(np.in1d(indices, self.indices))[0][0]]
-            raise IndexError("Index {0:d} is already an index of the array".
-                format(index))
+        if len(indices) == 0:
+            return
         # Get the new indices.
         indices_old = self.indices
         indices_new = np.array(sorted(set(indices_old).union(indices)))
-        # Create the new array.
-        self.indices = indices_new
-        self.n = len(indices_new)
+        # Put the new indices in free slots.
+        slots = np.empty(len(indices_new), dtype=np.int64)
+        slots[np.searchsorted(indices_new, indices_old)] = self._slots
+        slots[np.searchsorted(indices_new, indices)] = self._get_slots(
+            len(indices))
+        self._slots = slots
+        self._set_indices(indices_new)
         self.shape = (self.n, self.n) + tuple(self.shape[2:])
-        array_new = np.zeros(self.shape, dtype=self.dtype)
-        notblank_new = np.zeros(self.shape[:2], dtype=np.bool)
-        # Fill the new array with the existing values, except if the previous
-        # array was empty.
-        if len(indices_old) > 0:
-            indices_relative = self.to_relative(indices_old)
-            for j in xrange(len(indices_relative)):
-                array_new[indices_relative, indices_relative[j], ...] = \
-                    self._array[:, j, ...]
-        self._array = array_new
     
     def remove_indices(self, indices):
         if isinstance(indices, (int, long, np.integer)):
@@ -88,19 +306,20 @@ class IndexedMatrix(object):
             index = indices[np.nonzero(~np.in1d(indices, self.indices))[0][0]]
             raise IndexError("Index {0:d} is not an index of the array".
                 format(index))
-        indices_kept = np.array(sorted(set(self.indices) - set(indices)))
-        indices_relative = self.to_relative(indices_kept)
-        self._array = self._array[indices_relative, :, ...] \
-            [:, indices_relative, ...]
-        self.indices = indices_kept
-        self.n = len(self.indices)
+        removed = np.in1d(self.indices, indices)
+        self._free.extend(self._slots[removed])
+        self._slots = self._slots[~removed]
+        self._set_indices(self.indices[~removed])
         self.shape = (self.n, self.n) + tuple(self.shape[2:])
     
     def to_array(self, copy=False):
-        if copy:
-            return self._array.copy()
-        else:
-            return self._array
+        """Return the values in an array of shape (n, n, ...). The array is
+        a view on the storage if the slots are in order, and a copy
+        otherwise."""
+        if np.array_equal(self._slots, np.arange(self.n)):
+            array = self._data[:self.n, :self.n, ...]
+            return array.copy() if copy else array
+        return self._data[np.ix_(self._slots, self._slots)]
         
     def to_absolute(self, indices_relative, conserve_single_indices=True):
         if isinstance(indices_relative, (int, long, np.integer)):
@@ -123,20 +342,20 @@ class IndexedMatrix(object):
             single_index = False
         if len(indices_absolute) == 0:
             return []
+        indices_relative = lookup(self._lookup, indices_absolute)
         # Ensure all requested absolute indices are valid.
-        if not np.all(np.in1d(indices_absolute, self.indices)):
-            index = indices_absolute[
-                np.nonzero(~np.in1d(indices_absolute, self.indices))[0][0]]
+        if np.any(indices_relative < 0):
+            index = indices_absolute[np.nonzero(indices_relative < 0)[0][0]]
             raise IndexError("The index {0:d} is not valid.".format(index))
-        indices_relative = np.digitize(indices_absolute, self.indices) - 1
         if single_index and conserve_single_indices:
             indices_relative = indices_relative[0]
         return indices_relative
     
     def not_in_indices(self, indices=None):
         if indices is None:
-            indices = self.indices
-        return sorted(set(indices) - set(self.indices))
+            return []
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        return indices[lookup(self._lookup, indices) < 0].tolist()
     
     @property
     def size(self):
@@ -145,67 +364,38 @@ class IndexedMatrix(object):
     
     # Access
     # ------
+    def _index(self, item0, item1):
+        """Return the index of [item0, item1] in the storage array. The
+        result has the same dimensions as with an array of shape 
+        (n, n, ...)."""
+        slots = [self._slots[self.to_relative(item)] 
+            if isinstance(item, (int, long, np.integer))
+            else self._slots_of(item) for item in (item0, item1)]
+        if isinstance(slots[0], np.ndarray) and isinstance(slots[1], 
+            np.ndarray):
+            return np.ix_(*slots)
+        return tuple(slots)
+    
     def __getitem__(self, item):
         """Access [:,indices] or [indices,:]."""
-        # If item is (item0, item1).
-        if isinstance(item, tuple) and len(item) == 2:
-            # item0 is default slice, and item1 contains indices.
-            if is_default_slice(item[0]) and is_indices(item[1]):
-                return self._array[:, self.to_relative(item[1]), ...]
-            # item0 contains indices, and item1 is default slice.
-            elif is_default_slice(item[1]) and is_indices(item[0]):
-                return self._array[self.to_relative(item[0]), :, ...]
-            # item0 and item1 are indices.
-            elif is_indices(item[0]) and is_indices(item[1]):
-                value = (self._array[self.to_relative(item[0], False), :, ...]
-                    [:, self.to_relative(item[1], False), ...])
-                # Squeeze the appropriate dimensions if the requested indices
-                # are scalars and not enumerables.
-                if (isinstance(item[0], (int, long, np.integer)) and 
-                    isinstance(item[1], (int, long, np.integer))):
-                    value = value[0, 0, ...]
-                elif isinstance(item[0], (int, long, np.integer)):
-                    value = value[0, ...]
-                elif isinstance(item[1], (int, long, np.integer)):
-                    value = value[:, 0, ...]
-                return value
+        # If item is (item0, item1), with indices or default slices.
+        if (isinstance(item, tuple) and len(item) == 2 and
+            (is_indices(item[0]) or is_indices(item[1])) and
+            all(is_default_slice(x) or is_indices(x) for x in item)):
+            return self._data[self._index(*item)]
         raise IndexError(("Indexed matrices can only be accessed with [x,y] "
         "with x and y indices or default slice ':'."))
         
     def __setitem__(self, item, value):
-        # If item is (item0, item1).
-        if isinstance(item, tuple) and len(item) == 2:
-            # item0 is default slice, and item1 contains indices.
-            if is_default_slice(item[0]) and is_indices(item[1]):
-                self._array[:, self.to_relative(item[1]), ...] = value
-                return
-            # item0 contains indices, and item1 is default slice.
-            elif is_default_slice(item[1]) and is_indices(item[0]):
-                self._array[self.to_relative(item[0]), :, ...] = value
-                return
-            # item0 and item1 are indices.
-            elif is_indices(item[0]) and is_indices(item[1]):
-                # Case where both items are enumerables.
-                if (not isinstance(item[0], (int, long, np.integer)) and 
-                    not isinstance(item[1], (int, long, np.integer))):
-                    # TODO: this is inefficient. Rather inspire from update.
-                    # Assign value slice after slice.
-                    for j in xrange(len(item[1])):
-                        try:
-                            self._array[self.to_relative(item[0]), 
-                                        self.to_relative(item[1][j]), ...] \
-                                        = value[:, j, ...]
-                        except TypeError:
-                            # Case where value is a scalar and cannot be
-                            # sliced.
-                            self._array[self.to_relative(item[0]), 
-                                        self.to_relative(item[1][j]), ...] \
-                                        = value
-                else:
-                    self._array[self.to_relative(item[0]),
-                                self.to_relative(item[1]), 
-                                ...] = value
-                return
+        """Assign [:,indices], [indices,:] or [indices,indices]. The value
+        is broadcast to the shape of the same access with __getitem__."""
+        # If item is (item0, item1), with indices or default slices.
+        if (isinstance(item, tuple) and len(item) == 2 and
+            (is_indices(item[0]) or is_indices(item[1])) and
+            all(is_default_slice(x) or is_indices(x) for x in item)):
+            # Both enumerables are assigned at once with outer indexing.
+            self._data[self._index(*item)] = value
+            return
         raise IndexError(("Indexed matrices can only be accessed with [x,y] "
         "with x and y indices or default slice ':'."))
          
@@ -213,17 +403,42 @@ class IndexedMatrix(object):
         return self.n
     
     def submatrix(self, indices):
+        """Return the matrix with the specified indices only. If their slots
+        are contiguous, the submatrix is a read-only view on the storage
+        and reflects the later changes of this matrix. Otherwise, the values
+        are gathered in a new array."""
         if len(indices) == 0:
             return IndexedMatrix(shape=(0, 0) + self.shape[2:])
-        if not np.all(np.in1d(indices, self.indices)):
+        indices = np.unique(indices)
+        indices_relative = lookup(self._lookup, indices)
+        if np.any(indices_relative < 0):
             raise IndexError("Some indices are not valid.")
-        indices = sorted(indices)
-        submatrix = IndexedMatrix(indices=indices,
-            data=self[indices, indices].copy())
-        return submatrix
+        slots = self._slots[indices_relative]
+        start, stop = slots[0], slots[0] + len(slots)
+        if np.array_equal(slots, np.arange(start, stop)):
+            data = self._data[start:stop, start:stop, ...]
+            data.flags.writeable = False
+        else:
+            data = self._data[np.ix_(slots, slots)]
+        return IndexedMatrix._from_data(indices, data)
+    
+    @classmethod
+    def _from_data(cls, indices, data):
+        """Create a matrix with sorted unique indices and an existing array,
+        without checking nor copying them."""
+        matrix = cls.__new__(cls)
+        matrix._set_indices(indices)
+        matrix.dtype = data.dtype
+        matrix.shape = data.shape
+        matrix._data = data
+        matrix.ndim = data.ndim
+        matrix._slots = np.arange(matrix.n)
+        matrix._free = []
+        matrix.max_capacity = None
+        return matrix
         
     def __repr__(self):
-        return self._array.__repr__()
+        return self.to_array().__repr__()
     
 
 class CacheMatrix(IndexedMatrix):
@@ -245,6 +460,42 @@ class CacheMatrix(IndexedMatrix):
         # List of key indices.
         self.key_indices = []
     
+    @property
+    def key_indices(self):
+        """Sorted list of the key indices, derived from the table telling
+        whether every absolute index is a key index."""
+        if self._key_indices is None:
+            self._key_indices = np.nonzero(self._key_lookup)[0].tolist()
+        return self._key_indices
+    
+    @key_indices.setter
+    def key_indices(self, key_indices):
+        self._key_lookup = set_lookup(np.zeros(0, dtype=np.bool), 
+            key_indices, True, default=False)
+        self._key_indices = None
+    
+    def add_key_indices(self, key_indices):
+        """Add key indices, without adding them to the indices."""
+        if isinstance(key_indices, (int, long, np.integer)):
+            key_indices = [key_indices]
+        if len(key_indices) == 0:
+            return
+        self._key_lookup = set_lookup(self._key_lookup, key_indices, True,
+            default=False)
+        self._key_indices = None
+    
+    def remove_key_indices(self, key_indices):
+        """Remove key indices, without removing them from the indices."""
+        if isinstance(key_indices, (int, long, np.integer)):
+            key_indices = [key_indices]
+        key_indices = np.asarray(key_indices, dtype=np.int64)
+        key_indices = key_indices[(key_indices >= 0) & 
+            (key_indices < len(self._key_lookup))]
+        if len(key_indices) == 0:
+            return
+        self._key_lookup[key_indices] = False
+        self._key_indices = None
+    
     def invalidate(self, indices):
         """Remove indices from the cache."""
         if isinstance(indices, (int, long, np.integer)):
@@ -252,21 +503,55 @@ class CacheMatrix(IndexedMatrix):
         # Only remove the indices that are present in the existing indices.
         indices = sorted(set(indices).intersection(set(self.indices)))
         self.remove_indices(indices)
-        for index in indices:
-            if index in self.key_indices:
-                self.key_indices.remove(index)
+        self.remove_key_indices(indices)
+    
+    def merge(self, indices, index_new):
+        """Replace the indices by a new index, whose row and column are the
+        sums of their rows and columns. This is only possible with additive
+        values (like histogram counts) and when all indices are key indices,
+        otherwise nothing happens and False is returned."""
+        if isinstance(indices, (int, long, np.integer)):
+            indices = [indices]
+        if len(indices) == 0 or not np.all(lookup(self._key_lookup, indices,
+            False)):
+            return False
+        # The new index may be present in the cache, but with stale values.
+        if index_new in self.indices:
+            self.invalidate(index_new)
+        indices_relative = self.to_relative(indices)
+        indices_kept = sorted(set(self.indices) - set(indices))
+        # Sum the rows and the columns of the merged indices.
+        row = self[indices, :].sum(axis=0)
+        column = self[:, indices].sum(axis=1)
+        diagonal = row[indices_relative, ...].sum(axis=0)
+        if len(indices_kept) > 0:
+            indices_kept_relative = self.to_relative(indices_kept)
+            row = row[indices_kept_relative, ...]
+            column = column[indices_kept_relative, ...]
+        # Replace the merged indices by the new index.
+        self.invalidate(indices)
+        self.add_indices(index_new)
+        if len(indices_kept) > 0:
+            self[index_new, indices_kept] = row
+            self[indices_kept, index_new] = column
+        self[index_new, index_new] = diagonal
+        self.add_key_indices(index_new)
+        return True
     
     def not_in_key_indices(self, indices):
         """Return those indices which are not key indices and thus need to
         be updated."""
         if isinstance(indices, (int, long, np.integer)):
             indices = [indices]
-        return sorted(set(indices) - set(self.key_indices))
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        return indices[~lookup(self._key_lookup, indices, False)].tolist()
     
     def update(self, key_indices, dic):
         """Update the cache using a dictionary indexed by pairs of absolute
-        indices. New indices are silently added. The key indices must also
-        be provided."""
+        indices, or a MatrixBlock. New indices are silently added. The key
+        indices must also be provided."""
+        if isinstance(dic, MatrixBlock):
+            return self.update_block(key_indices, dic)
         
         items0, items1 = zip(*dic.keys())
         # Add non-existing indices.
@@ -276,15 +561,260 @@ class CacheMatrix(IndexedMatrix):
         if len(indices_new) > 0:
             self.add_indices(indices_new)
         # Update key indices.
-        if isinstance(key_indices, (int, long, np.integer)):
-            key_indices = [key_indices]
-        self.key_indices = sorted(set(self.key_indices).union(
-            set(key_indices)))
+        self.add_key_indices(key_indices)
+        # Update the matrix with the new values.
+        slots0 = self._slots[self.to_relative(items0)]
+        slots1 = self._slots[self.to_relative(items1)]
+        for (item0, item1, slot0, slot1) in zip(
+                items0, items1, slots0, slots1):
+            self._data[slot0, slot1, ...] = dic[(item0, item1)]
+    
+    def update_block(self, key_indices, block):
+        """Update the cache using a MatrixBlock, with one assignment for
+        the block and one for its symmetric pairs."""
+        # Add non-existing indices.
+        indices_new = self.not_in_indices(list(block.rows) + 
+            list(block.columns))
+        if len(indices_new) > 0:
+            self.add_indices(indices_new)
+        # Update key indices.
+        self.add_key_indices(key_indices)
+        if len(block.rows) == 0 or len(block.columns) == 0:
+            return
         # Update the matrix with the new values.
-        items0_relative = self.to_relative(items0)
-        items1_relative = self.to_relative(items1)
-        for (item0, item1, item0_relative, item1_relative) in zip(
-                items0, items1, items0_relative, items1_relative):
-            self._array[item0_relative, item1_relative, ...] = dic[(
-                item0, item1)]
-       
+        rows_slots = self._slots_of(block.rows)
+        columns_slots = self._slots_of(block.columns)
+        data_mirror = block.get_mirror_data()
+        if data_mirror is not None:
+            mask = block.get_mirror_mask()
+            if mask is not None:
+                # The symmetric pairs out of the mask keep their values.
+                mask = mask.reshape(mask.shape + (1,) * (data_mirror.ndim - 2))
+                data_mirror = np.where(mask, data_mirror,
+                    self._data[np.ix_(columns_slots, rows_slots)])
+            self._data[np.ix_(columns_slots, rows_slots)] = data_mirror
+        self._data[np.ix_(rows_slots, columns_slots)] = block.data
+
+
+class SparseCacheMatrix(CacheMatrix):
+    """Cache matrix with two-dimensional values stored in a scipy sparse
+    CSR matrix, where the null values are not stored.
+    
+    This is used for the similarity matrix, where most pairs of clusters are
+    never compared. The values are updated with `update` like in a
+    CacheMatrix, and accessing values returns dense arrays. `to_array`
+    returns the sparse matrix.
+    
+    """
+    def __init__(self, dtype=np.float64):
+        if sparse is None:
+            raise ImportError("scipy is required for sparse cache matrices.")
+        self._set_indices([])
+        self.dtype = dtype
+        self.shape = (0, 0)
+        self.ndim = 2
+        self._array = sparse.csr_matrix(self.shape, dtype=self.dtype)
+        self.key_indices = []
+    
+    
+    # Indices
+    # -------
+    def add_indices(self, indices):
+        """Add new indices only if they don't already exist."""
+        if isinstance(indices, (int, long, np.integer)):
+            indices = [indices]
+        indices = self.not_in_indices(indices)
+        if len(indices) == 0:
+            return
+        indices_old = self.indices
+        self._set_indices(sorted(set(indices_old).union(indices)))
+        self.shape = (self.n, self.n)
+        # Move the stored values to their new positions.
+        coo = self._array.tocoo()
+        if len(indices_old) > 0:
+            indices_relative = np.asarray(self.to_relative(indices_old))
+            row, col = indices_relative[coo.row], indices_relative[coo.col]
+        else:
+            row, col = coo.row, coo.col
+        self._array = sparse.csr_matrix((coo.data, (row, col)), 
+            shape=self.shape, dtype=self.dtype)
+    
+    def remove_indices(self, indices):
+        if isinstance(indices, (int, long, np.integer)):
+            indices = [indices]
+        if len(indices) == 0:
+            return
+        if np.any(~np.in1d(indices, self.indices)):
+            index = indices[np.nonzero(~np.in1d(indices, self.indices))[0][0]]
+            raise IndexError("Index {0:d} is not an index of the array".
+                format(index))
+        kept = ~np.in1d(self.indices, indices)
+        self._array = self._array[kept, :][:, kept].tocsr()
+        self._set_indices(self.indices[kept])
+        self.shape = (self.n, self.n)
+        
+    def to_array(self, copy=False):
+        """Return the sparse matrix."""
+        if copy:
+            return self._array.copy()
+        else:
+            return self._array
+        
+    def _assign(self, rows, columns, values):
+        """Assign values to the pairs (rows[k], columns[k]) of relative
+        indices. If a pair appears several times, the last value is kept."""
+        rows = np.asarray(rows, dtype=np.int64).ravel()
+        columns = np.asarray(columns, dtype=np.int64).ravel()
+        values = np.asarray(values, dtype=self.dtype).ravel()
+        if len(rows) == 0:
+            return
+        n = self.n
+        keys = rows * n + columns
+        # Keep the last value of every pair.
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        rows, columns, values, keys = (rows[last], columns[last], 
+            values[last], keys[last])
+        # Remove the existing values of the pairs, and add the new non-null
+        # values.
+        coo = self._array.tocoo()
+        kept = ~np.in1d(coo.row.astype(np.int64) * n + coo.col, keys)
+        nonzero = values != 0
+        self._array = sparse.csr_matrix((
+            np.hstack((coo.data[kept], values[nonzero])),
+            (np.hstack((coo.row[kept], rows[nonzero])),
+             np.hstack((coo.col[kept], columns[nonzero])))),
+            shape=self.shape, dtype=self.dtype)
+    
+    
+    # Access
+    # ------
+    def _to_relative_item(self, item):
+        if is_default_slice(item):
+            return np.arange(self.n)
+        return np.atleast_1d(self.to_relative(item, False))
+        
+    def __getitem__(self, item):
+        """Access [:,indices], [indices,:] or [indices,indices], and return
+        a dense array."""
+        if not (isinstance(item, tuple) and len(item) == 2 and
+            all(is_default_slice(x) or is_indices(x) for x in item)):
+            raise IndexError(("Indexed matrices can only be accessed with "
+            "[x,y] with x and y indices or default slice ':'."))
+        rows = self._to_relative_item(item[0])
+        columns = self._to_relative_item(item[1])
+        value = self._array[rows, :][:, columns].toarray()
+        if isinstance(item[0], (int, long, np.integer)):
+            value = value[0, ...]
+            if isinstance(item[1], (int, long, np.integer)):
+                value = value[0]
+        elif isinstance(item[1], (int, long, np.integer)):
+            value = value[:, 0]
+        return value
+        
+    def __setitem__(self, item, value):
+        if not (isinstance(item, tuple) and len(item) == 2 and
+            all(is_default_slice(x) or is_indices(x) for x in item)):
+            raise IndexError(("Indexed matrices can only be accessed with "
+            "[x,y] with x and y indices or default slice ':'."))
+        rows = self._to_relative_item(item[0])
+        columns = self._to_relative_item(item[1])
+        value = np.asarray(value, dtype=self.dtype)
+        # Scalar indices have no dimension in the value.
+        if isinstance(item[0], (int, long, np.integer)):
+            value = value.reshape((1, -1)) if value.ndim else value
+        elif isinstance(item[1], (int, long, np.integer)):
+            value = value.reshape((-1, 1)) if value.ndim else value
+        value = value + np.zeros((len(rows), len(columns)), dtype=self.dtype)
+        rows, columns = np.meshgrid(rows, columns, indexing='ij')
+        self._assign(rows, columns, value)
+        
+    def submatrix(self, indices):
+        if len(indices) == 0:
+            return IndexedMatrix(shape=(0, 0))
+        if not np.all(np.in1d(indices, self.indices)):
+            raise IndexError("Some indices are not valid.")
+        indices = sorted(indices)
+        return IndexedMatrix(indices=indices, data=self[indices, indices])
+    
+    def merge(self, indices, index_new):
+        """The similarity values are not additive: nothing happens and
+        False is returned."""
+        return False
+    
+    
+    # Update
+    # ------
+    def update(self, key_indices, dic):
+        """Update the cache using a dictionary indexed by pairs of absolute
+        indices, or a MatrixBlock."""
+        if isinstance(dic, MatrixBlock):
+            return self.update_block(key_indices, dic)
+        items0, items1 = zip(*dic.keys())
+        self.add_indices(sorted(set(items0).union(items1)))
+        self.add_key_indices(key_indices)
+        self._assign(self.to_relative(items0, False), 
+            self.to_relative(items1, False),
+            [dic[key] for key in zip(items0, items1)])
+    
+    def update_block(self, key_indices, block):
+        """Update the cache using a MatrixBlock, whose values may be in a
+        dense array or in a scipy sparse matrix, in a single assignment for
+        the block and its symmetric pairs."""
+        self.add_indices(list(block.rows) + list(block.columns))
+        self.add_key_indices(key_indices)
+        if len(block.rows) == 0 or len(block.columns) == 0:
+            return
+        rows = np.asarray(self.to_relative(block.rows, False))
+        columns = np.asarray(self.to_relative(block.columns, False))
+        in_rows = np.zeros(self.n, dtype=np.bool)
+        in_rows[rows] = True
+        in_columns = np.zeros(self.n, dtype=np.bool)
+        in_columns[columns] = True
+        # The stored values of the pairs of the block are replaced.
+        coo = self._array.tocoo()
+        replaced = in_rows[coo.row] & in_columns[coo.col]
+        # Only the non-null values of the block are stored.
+        i, j, values = _nonzero(block.data)
+        new = [(rows[i], columns[j], values)]
+        if block.mirror is not None:
+            # The values are scalars: the symmetric pairs have the same
+            # values, except those which are also in the block and keep the
+            # block values, like in CacheMatrix.
+            mirrored = in_columns[coo.row] & in_rows[coo.col]
+            mirror = ~(in_rows[columns[j]] & in_columns[rows[i]])
+            if block.mirror_mask is not None:
+                # The symmetric pairs out of the mask keep their values.
+                position = np.zeros(self.n, dtype=np.int64)
+                position[rows] = np.arange(len(rows))
+                rows_position = position[coo.col[mirrored]]
+                position[columns] = np.arange(len(columns))
+                mirrored[mirrored] = block.mirror_mask[rows_position,
+                    position[coo.row[mirrored]]]
+                mirror &= block.mirror_mask[i, j]
+            replaced |= mirrored
+            new.append((columns[j][mirror], rows[i][mirror], 
+                values[mirror]))
+        kept = ~replaced
+        new.insert(0, (coo.row[kept], coo.col[kept], coo.data[kept]))
+        self._array = sparse.csr_matrix((
+            np.hstack([values for _, _, values in new]),
+            (np.hstack([i for i, _, _ in new]), 
+             np.hstack([j for _, j, _ in new]))),
+            shape=self.shape, dtype=self.dtype)
+    
+    def sparse_rows(self, indices):
+        """Return the rows of the specified absolute indices in a scipy CSR
+        matrix, with a column for every index of the matrix."""
+        return self._array[self._to_relative_item(indices), :]
+
+
+def _nonzero(data):
+    """Return the row indices, the column indices and the values of the
+    non-null elements of a dense array or a scipy sparse matrix."""
+    if is_sparse(data):
+        coo = data.tocoo()
+        nonzero = coo.data != 0
+        return coo.row[nonzero], coo.col[nonzero], coo.data[nonzero]
+    i, j = np.nonzero(data)
+    return i, j, data[i, j]
@@ -0,0 +1,67 @@
+"""Benchmark of the assignment of a block in an indexed matrix.
+
+Run with `python bench_indexed_matrix.py`. This is not a unit test.
+
+"""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import time
+
+import numpy as np
+
+from klustaviewa.stats.indexed_matrix import IndexedMatrix
+
+
+# -----------------------------------------------------------------------------
+# Benchmark
+# -----------------------------------------------------------------------------
+def setitem_columns(matrix, rows, columns, value):
+    """Previous implementation of matrix[rows, columns] = value, assigning
+    one column after the other."""
+    data, slots = matrix._data, matrix._slots
+    for j in xrange(len(columns)):
+        try:
+            data[slots[matrix.to_relative(rows)],
+                 slots[matrix.to_relative(columns[j])], ...] = value[:, j, ...]
+        except TypeError:
+            data[slots[matrix.to_relative(rows)],
+                 slots[matrix.to_relative(columns[j])], ...] = value
+
+def bench(n=500, nrows=500, nbins=100, repeat=3):
+    """Assign nrows x n values in a matrix with n indices."""
+    indices = np.arange(2, 2 + 2 * n, 2)
+    matrix = IndexedMatrix(indices=indices, shape=(n, n, nbins))
+    # Rows and columns in a random order.
+    rows = np.random.permutation(indices)[:nrows]
+    columns = np.random.permutation(indices)
+    value = np.random.rand(nrows, n, nbins)
+    
+    def timeit(f):
+        t0 = time.time()
+        for _ in xrange(repeat):
+            f()
+        return (time.time() - t0) / repeat
+    
+    def vectorized():
+        matrix[rows, columns] = value
+    def columnwise():
+        setitem_columns(matrix, rows, columns, value)
+    
+    t_vectorized = timeit(vectorized)
+    expected = matrix.to_array().copy()
+    matrix[:, indices] = 0
+    t_columnwise = timeit(columnwise)
+    assert np.array_equal(matrix.to_array(), expected)
+    
+    print(("{0:d}x{1:d}x{2:d} assignment: {3:.4f}s column by column, "
+        "{4:.4f}s vectorized ({5:.1f}x faster).").format(nrows, n, nbins, 
+        t_columnwise, t_vectorized, t_columnwise / t_vectorized))
+    
+
+if __name__ == '__main__':
+    # Whole matrix.
+    bench(500, 500)
+    # A few rows, as when updating the cache after a selection.
+    bench(500, 4)
@@ -3,10 +3,17 @@
 # -----------------------------------------------------------------------------
 # Imports
 # -----------------------------------------------------------------------------
+import os
+import tempfile
+
+from nose import SkipTest
 from nose.tools import raises
 import numpy as np
 
-from klustaviewa.stats.cache import StatsCache
+from klustaviewa.stats.cache import StatsCache, get_cluster_hashes
+from klustaviewa.stats.correlograms import compute_correlograms
+from klustaviewa.stats.correlations import normalize
+from klustaviewa.stats.indexed_matrix import MatrixBlock, sparse
 
 
 # -----------------------------------------------------------------------------
@@ -30,6 +37,231 @@ def test_cache():
     np.array_equal(cache.correlograms.not_in_key_indices(indices), indices)
     np.array_equal(cache.similarity_matrix.not_in_key_indices(indices), 
         indices)
+
+def test_cache_merge():
+    spiketimes = np.sort(np.random.rand(5000) * 5.)
+    clusters = np.random.randint(low=2, high=6, size=5000).astype(np.int32)
+    cache = StatsCache(ncorrbins=20)
+    cache.correlograms.update([2, 3], compute_correlograms(spiketimes, 
+        clusters, np.array([2, 3], dtype=np.int32), ncorrbins=20, 
+        corrbin=.001))
+    
+    # Merge 2 and 3 into 6.
+    cache.merge([2, 3], 6)
+    assert np.array_equal(cache.correlograms.not_in_key_indices([4, 5, 6]),
+        [4, 5])
+    
+    clusters[(clusters == 2) | (clusters == 3)] = 6
+    correlograms = compute_correlograms(spiketimes, clusters, 
+        np.array([6], dtype=np.int32), ncorrbins=20, corrbin=.001)
+    for (clu0, clu1), correlogram in correlograms.iteritems():
+        assert np.array_equal(cache.correlograms[clu0, clu1], correlogram)
+    
+    # 4 is not a key index: its correlograms need to be recomputed.
+    cache.merge([4, 6], 7)
+    assert np.array_equal(cache.correlograms.not_in_key_indices([5, 7]), 
+        [5, 7])
+    assert 4 not in cache.correlograms.indices
+    
+def test_cache_persistence():
+    spiketimes = np.sort(np.random.rand(5000) * 5.)
+    clusters = np.random.randint(low=2, high=6, size=5000).astype(np.int32)
+    cache = StatsCache(ncorrbins=20)
+    cache.correlograms.update([2, 3], compute_correlograms(spiketimes, 
+        clusters, np.array([2, 3], dtype=np.int32), ncorrbins=20, 
+        corrbin=.001))
+    filename = os.path.join(tempfile.mkdtemp(), 'correlograms.npz')
+    cache.save(filename, get_cluster_hashes(clusters), ncorrbins=20,
+        corrbin=.001)
+    
+    # Different parameters: nothing is loaded.
+    cache = StatsCache(ncorrbins=20)
+    assert not cache.load(filename, get_cluster_hashes(clusters), 
+        ncorrbins=20, corrbin=.002)
+    
+    # Cluster 2 is renumbered to 7, and clusters 3 and 4 are modified.
+    clusters[clusters == 2] = 7
+    clusters[np.nonzero(clusters == 3)[0][:10]] = 4
+    assert cache.load(filename, get_cluster_hashes(clusters), ncorrbins=20,
+        corrbin=.001)
+    assert np.array_equal(cache.correlograms.key_indices, [7])
+    # Only the pairs of key clusters are restored.
+    assert np.array_equal(cache.correlograms.indices, [7])
+    
+    correlograms = compute_correlograms(spiketimes, clusters, 
+        np.array([7], dtype=np.int32), ncorrbins=20, corrbin=.001)
+    assert np.array_equal(cache.correlograms[7, 7], correlograms[7, 7])
+    
+    # Corrupt or incomplete files are ignored.
+    with open(filename, 'wb') as f:
+        f.write('corrupt')
+    assert not cache.load(filename, get_cluster_hashes(clusters), 
+        ncorrbins=20, corrbin=.001)
+    np.savez(filename, correlograms=np.zeros((2, 2, 20)), 
+        param_ncorrbins=20, param_corrbin=.001)
+    assert not cache.load(filename, get_cluster_hashes(clusters), 
+        ncorrbins=20, corrbin=.001)
+    np.savez(filename, correlograms=np.zeros((2, 2, 20)), 
+        hashes=np.array(['a', 'b', 'c']), keys=np.ones(3, dtype=np.bool),
+        param_ncorrbins=20, param_corrbin=.001)
+    assert not cache.load(filename, get_cluster_hashes(clusters), 
+        ncorrbins=20, corrbin=.001)
+
+def test_cache_binning():
+    spiketimes = np.sort(np.random.randint(low=0, high=100000, 
+        size=3000)).astype(np.int64)
+    clusters = np.random.randint(low=2, high=6, size=3000).astype(np.int32)
+    indices = [2, 3, 5]
+    
+    cache = StatsCache(ncorrbins=60, corrbin=5)
+    correlograms = compute_correlograms(spiketimes, clusters,
+        ncorrbins=60, corrbin=5)
+    for i in indices:
+        cache.correlograms.update(i, correlograms)
+    
+    # Coarser binning derived from the cached correlograms.
+    correlograms_coarse = compute_correlograms(spiketimes, clusters,
+        ncorrbins=20, corrbin=10)
+    matrix = cache.get_correlograms(indices, ncorrbins=20, corrbin=10)
+    assert np.array_equal(matrix.indices, indices)
+    for i in indices:
+        for j in indices:
+            assert np.array_equal(matrix[i, j], correlograms_coarse[i, j])
+    
+    assert cache.get_rebin_factor(60, 10) is None
+
+@raises(ValueError)
+def test_cache_binning_error():
+    cache = StatsCache(ncorrbins=60, corrbin=5)
+    cache.get_correlograms([2, 3], ncorrbins=20, corrbin=7)
+    
+def _test_cache_similarity_matrix(similarity_sparse):
+    cache = StatsCache(ncorrbins=100, similarity_sparse=similarity_sparse)
     
+    def check():
+        matrix = cache.similarity_matrix.to_array().copy()
+        normalized = cache.similarity_matrix_normalized
+        if similarity_sparse:
+            # The matrices are never densified.
+            assert sparse.issparse(normalized)
+            matrix, normalized = matrix.toarray(), normalized.toarray()
+        expected = normalize(matrix)
+        assert np.allclose(normalized, expected)
+        assert np.allclose(cache.get_cluster_quality(), np.diag(expected))
     
-    
\ No newline at end of file
+    def update(rows, columns):
+        data = np.random.rand(len(rows), len(columns))
+        data[data < .3] = 0
+        cache.update_similarity_matrix(rows, 
+            MatrixBlock(rows, columns, data))
+    
+    indices = [2, 3, 5, 7, 8]
+    update(indices, indices)
+    check()
+    
+    # The matrix previously returned is not modified by the next updates.
+    previous = cache.similarity_matrix_normalized
+    if similarity_sparse:
+        previous = previous.toarray()
+    previous = previous.copy()
+    normalized = cache.similarity_matrix_normalized
+    cache.invalidate([7])
+    update([7], indices)
+    check()
+    if similarity_sparse:
+        normalized = normalized.toarray()
+    assert np.array_equal(normalized, previous)
+    
+    # Merge: the normalized rows with values in the merged columns change.
+    cache.merge([3, 5], 9)
+    indices = [2, 7, 8, 9]
+    update([9], indices)
+    check()
+    
+    # Update some rows only.
+    cache.invalidate([2])
+    update([2], indices)
+    check()
+    
+def test_cache_similarity_matrix_mirror():
+    cache = StatsCache(ncorrbins=100)
+    indices = [2, 3, 5]
+    cache.update_similarity_matrix(indices, MatrixBlock(indices, indices, 
+        np.random.rand(3, 3) + .1))
+    
+    # The row of 5 is updated, and the pairs (5, 2) and (2, 5) are set to 0.
+    data = np.random.rand(1, 3) + .1
+    data[0, 0] = 0
+    mirror_mask = np.array([[True, False, False]])
+    cache.update_similarity_matrix([5], MatrixBlock([5], indices, data, 
+        mirror='same', mirror_mask=mirror_mask))
+    matrix = cache.similarity_matrix.to_array().copy()
+    assert matrix[0, 2] == 0
+    assert matrix[1, 2] > 0
+    # The row of 2 is normalized again.
+    assert np.allclose(cache.similarity_matrix_normalized, normalize(matrix))
+    
+def test_cache_similarity_matrix():
+    _test_cache_similarity_matrix(False)
+    
+def test_cache_similarity_matrix_sparse():
+    if sparse is None:
+        raise SkipTest("scipy is not available.")
+    _test_cache_similarity_matrix(True)
+    
+def test_cache_eviction():
+    ncorrbins = 10
+    # Room for the correlograms of 4 clusters (float64 values).
+    cache = StatsCache(ncorrbins=ncorrbins, max_memory=16 * ncorrbins * 8)
+    # As in the correlograms tasks, the computed correlograms have a column
+    # for every cluster.
+    clusters_all = np.arange(100)
+    
+    def update(clusters):
+        clusters_to_update = cache.get_correlograms_to_update(clusters)
+        if clusters_to_update:
+            rows = np.array(clusters_to_update)
+            data = (rows.reshape((-1, 1, 1)) * 1000 + 
+                clusters_all.reshape((1, -1, 1)) + 
+                np.zeros(ncorrbins))
+            cache.update_correlograms(clusters_to_update, 
+                MatrixBlock(rows, clusters_all, data, mirror='reversed'))
+        assert cache.correlograms.n <= 4
+        
+    update([2, 3])
+    # Contiguous slots: a view on the cache storage is taken.
+    correlograms0 = cache.get_correlograms([2, 3])
+    update([4, 5])
+    assert np.array_equal(cache.correlograms.indices, [2, 3, 4, 5])
+    assert cache.counters == dict(hits=0, misses=4, evictions=0)
+    # 2 is used again, so that 3 is the least recently used cluster.
+    cache.get_correlograms([2])
+    update([6])
+    assert np.array_equal(cache.correlograms.indices, [2, 4, 5, 6])
+    assert cache.counters['evictions'] == 1
+    assert cache.correlograms.capacity == 4
+    
+    update([2, 6])
+    assert cache.counters['hits'] == 2
+    # The selected clusters are never evicted.
+    update([7, 8, 9])
+    assert np.array_equal(cache.correlograms.indices, [6, 7, 8, 9])
+    assert cache.counters == dict(hits=2, misses=8, evictions=4)
+    assert cache.correlograms.capacity == 4
+    
+    correlograms = cache.get_correlograms([6, 7, 9])
+    # The pairs of 6 and 9 are stored when computing 9, with its mirror.
+    assert np.array_equal(correlograms[6, 9], 9006 * np.ones(ncorrbins))
+    assert np.array_equal(correlograms[9, 7], 9007 * np.ones(ncorrbins))
+    
+    # The returned correlograms do not change when the cache is updated and
+    # their slots are reused.
+    assert np.array_equal(correlograms0[2, 3], 2003 * np.ones(ncorrbins))
+    assert np.array_equal(correlograms0[3, 3], 3003 * np.ones(ncorrbins))
+    update([10, 11])
+    update([12, 13])
+    assert 6 not in cache.correlograms.indices
+    assert np.array_equal(correlograms[6, 9], 9006 * np.ones(ncorrbins))
+    assert np.array_equal(correlograms[9, 7], 9007 * np.ones(ncorrbins))
+    assert np.array_equal(correlograms[7, 7], 7007 * np.ones(ncorrbins))
+
@@ -6,10 +6,16 @@
 import os
 
 import numpy as np
+from nose import SkipTest
 
 from klustaviewa.stats.cache import CacheMatrix
-from klustaviewa.stats.correlations import compute_correlations, normalize
+from klustaviewa.stats.correlations import (compute_correlations, normalize,
+    compute_statistics, get_covariance_factor, ClusterStatistics,
+    ExpectedFeatures, SIMILARITY_MEASURES, StackedStatistics,
+    get_unmask_index, get_overlapping_clusters)
 from klustaviewa.stats.tools import matrix_of_pairs
+from klustaviewa.stats.correlations import normalize as normalize_matrix
+from klustaviewa.stats.indexed_matrix import sparse
 from kwiklib.dataio.tests.mock_data import (setup, teardown,
     nspikes, nclusters, nsamples, nchannels, fetdim, TEST_FOLDER)
 from kwiklib.dataio import KlustersLoader
@@ -54,6 +60,198 @@ def test_compute_correlations():
     assert matrix[0,1] > 100 * matrix[0, 2]
     assert matrix[0,1] > 100 * matrix[1, 2]
 
+def test_compute_correlations_pairs():
+    n = 200
+    nspikes = 4 * n
+    nDims = 3
+    clusters = np.repeat([0, 1, 2, 3],  n)
+    features = np.random.randn(nspikes, nDims) + clusters.reshape((-1, 1))
+    masks = np.ones((nspikes, nDims))
+    
+    correlations = compute_correlations(features, clusters, masks)
+    
+    # Compare with the Gaussian densities computed pair by pair.
+    spikes_in_clusters = dict([(clu, np.nonzero(clusters == clu)[0]) 
+        for clu in range(4)])
+    stats = compute_statistics(features, features, spikes_in_clusters, masks)
+    for ci in range(4):
+        for cj in range(4):
+            mui = stats[ci][0]
+            muj, Cj, _, logdetj, npointsj, _ = stats[cj]
+            dmu = (muj - mui).reshape((-1, 1))
+            logp = (np.log(2*np.pi)*(-nDims/2.) - .5*logdetj -
+                .5*np.dot(dmu.T, np.linalg.solve(Cj, dmu))[0, 0])
+            assert np.allclose(correlations[ci, cj], 
+                float(npointsj) / nspikes * np.exp(logp))
+
+def test_compute_correlations_update():
+    n = 200
+    nspikes = 3 * n
+    clusters = np.repeat([0, 1, 2],  n)
+    features = np.random.randn(nspikes, 4)
+    masks = np.zeros((nspikes, 4))
+    masks[:, :2] = 1
+    
+    matrix = CacheMatrix()
+    matrix.update([0, 1, 2], compute_correlations(features, clusters, masks))
+    assert matrix[0, 2] > 0 and matrix[2, 0] > 0
+    value = matrix[0, 1]
+    
+    # Cluster 2 now only has unmasked features that the other clusters do
+    # not have: the pairs (2, *), and also (*, 2), are null.
+    masks[clusters == 2] = 0
+    masks[clusters == 2, 2:] = 1
+    correlations = compute_correlations(features, clusters, masks,
+        clusters_to_update=[2])
+    matrix.update([2], correlations)
+    for cj in (0, 1):
+        assert matrix[2, cj] == 0
+        assert matrix[cj, 2] == 0
+    assert matrix[2, 2] > 0
+    assert matrix[0, 1] == value
+    
+def test_covariance_factor():
+    X = np.random.randn(10, 4)
+    CovMat = np.dot(X.T, X)
+    L = get_covariance_factor(CovMat)
+    assert np.allclose(L, np.tril(L))
+    assert np.allclose(np.dot(L, L.T), CovMat)
+    
+    # Singular covariance matrix.
+    CovMat[:, -1] = CovMat[-1, :] = 0
+    L = get_covariance_factor(CovMat)
+    assert np.allclose(np.dot(L, L.T), CovMat)
+    assert np.all(np.isfinite(np.linalg.inv(L)))
+
+def test_cluster_statistics():
+    nspikes = 2000
+    nDims = 4
+    features = np.random.randn(nspikes, nDims)
+    masks = np.ones((nspikes, nDims))
+    masks[:500, -1] = 0
+    clusters = np.random.randint(low=2, high=7, size=nspikes)
+    
+    def check(statistics, clusters, key):
+        stats = statistics.update(features, clusters, masks, key=key)
+        spikes_in_clusters = dict([(clu, np.nonzero(clusters == clu)[0]) 
+            for clu in np.unique(clusters)])
+        stats_full = compute_statistics(features, features, 
+            spikes_in_clusters, masks)
+        assert sorted(stats.keys()) == sorted(stats_full.keys())
+        for clu in stats_full:
+            for x, y in zip(stats[clu], stats_full[clu]):
+                assert np.allclose(x, y)
+    
+    statistics = ClusterStatistics()
+    check(statistics, clusters, 'spikes')
+    
+    # Merge.
+    clusters = clusters.copy()
+    clusters[(clusters == 3) | (clusters == 5)] = 7
+    check(statistics, clusters, 'spikes')
+    assert 3 not in statistics.stats
+    
+    # Split.
+    clusters = clusters.copy()
+    clusters[(clusters == 7) & (features[:, 0] > 0)] = 8
+    check(statistics, clusters, 'spikes')
+    
+    # Move some spikes to an existing cluster.
+    clusters = clusters.copy()
+    clusters[:10] = 2
+    check(statistics, clusters, 'spikes')
+    
+    # Different spikes.
+    features = np.random.randn(nspikes, nDims)
+    check(statistics, clusters, 'other spikes')
+    
+    # Expected features computed on the fly.
+    check(ClusterStatistics(lean=True), clusters, 'spikes')
+
+def test_expected_features_lean():
+    nspikes = 1000
+    nDims = 5
+    features = np.random.randn(nspikes, nDims).astype(np.float32)
+    masks = (np.random.rand(nspikes, nDims) > .3).astype(np.float32)
+    masks[:10, 0] = .5
+    spikes = np.nonzero(np.random.rand(nspikes) > .5)[0]
+    
+    expected0 = ExpectedFeatures(features, features, masks)
+    expected1 = ExpectedFeatures(features, features, masks, lean=True, 
+        chunk_size=128)
+    expected2 = ExpectedFeatures(features.astype(np.float64), 
+        features.astype(np.float64), masks, chunk_size=128)
+    # Single-precision features are not promoted.
+    assert expected0.y.dtype == np.float32
+    assert expected1.y is None
+    
+    for expected in (expected1, expected2):
+        assert np.allclose(expected.y0, expected0.y0, atol=1e-5)
+        assert np.allclose(expected.D, expected0.D)
+        for x, y in zip(expected.get_sufficient_statistics(spikes),
+                        expected0.get_sufficient_statistics(spikes)):
+            assert np.allclose(x, y, atol=1e-3)
+    
+def test_similarity_measures():
+    nspikes = 1000
+    nDims = 3
+    clusters = np.random.randint(low=2, high=6, size=nspikes)
+    features = np.random.randn(nspikes, nDims) + clusters.reshape((-1, 1))
+    masks = np.ones((nspikes, nDims))
+    spikes_in_clusters = dict([(clu, np.nonzero(clusters == clu)[0]) 
+        for clu in np.unique(clusters)])
+    stats = compute_statistics(features, features, spikes_in_clusters, masks)
+    stacked = StackedStatistics(stats, sorted(stats.keys()), nspikes)
+    sim = np.arange(4)
+    
+    for name, measure in SIMILARITY_MEASURES.iteritems():
+        matrix = compute_correlations(features, clusters, masks,
+            similarity_measure=name)
+        assert np.array_equal(matrix.rows, [2, 3, 4, 5])
+        assert np.all(matrix.data >= 0)
+        assert np.allclose(matrix.data[1], measure(stacked, 1, sim))
+        if name != 'gaussian':
+            # Symmetric measures (except KL) equal to 1 on the diagonal.
+            assert np.allclose(np.diag(matrix.data), 1)
+            if name != 'kl':
+                assert np.allclose(matrix.data, matrix.data.T)
+    
+    # KL divergence between the Gaussian distributions of two clusters.
+    mu0, C0 = stats[2][0].ravel(), stats[2][1]
+    mu1, C1 = stats[3][0].ravel(), stats[3][1]
+    C1inv = np.linalg.inv(C1)
+    kl = .5 * (np.trace(np.dot(C1inv, C0)) + 
+        np.dot(mu1 - mu0, np.dot(C1inv, mu1 - mu0)) - nDims +
+        np.log(np.linalg.det(C1) / np.linalg.det(C0)))
+    assert np.allclose(SIMILARITY_MEASURES['kl'](stacked, 0, [1]), 
+        np.exp(-kl))
+    
+def test_unmask_index():
+    nclusters, nfeatures = 50, 32
+    unmask = np.zeros((nclusters, nfeatures))
+    for i in xrange(nclusters):
+        start = np.random.randint(low=0, high=nfeatures - 4)
+        unmask[i, start:start + 4] = np.random.choice([.5, .995, 1.], 4)
+    
+    index = get_unmask_index(unmask)
+    for i in xrange(nclusters):
+        overlapping = get_overlapping_clusters(index, unmask, unmask[i])
+        expected = np.nonzero((unmask[i] * unmask).max(axis=1) >= .99)[0]
+        assert np.array_equal(overlapping, expected)
+
+def test_normalize_sparse():
+    if sparse is None:
+        raise SkipTest("scipy is not available.")
+    matrix = np.random.rand(10, 10)
+    matrix[matrix < .7] = 0
+    matrix[3, :] = 0
+    for direction in ('row', 'column'):
+        expected = normalize_matrix(matrix.copy(), direction=direction)
+        actual = normalize_matrix(sparse.csr_matrix(matrix), 
+            direction=direction)
+        assert sparse.issparse(actual)
+        assert np.allclose(actual.toarray(), expected)
+
 def normalize(x):
     return x
 
@@ -3,9 +3,14 @@
 # -----------------------------------------------------------------------------
 # Imports
 # -----------------------------------------------------------------------------
+from multiprocessing import Pool
+
 import numpy as np
 
-from klustaviewa.stats.correlograms import compute_correlograms
+from klustaviewa.stats.correlograms import (compute_correlograms,
+    compute_correlograms_python, compute_correlograms_numpy,
+    compute_correlograms_parallel, compute_correlograms_stream,
+    get_base_binning, get_rebin_factor, rebin_correlograms, split_excerpts)
 
 
 # -----------------------------------------------------------------------------
@@ -39,4 +44,195 @@ def test_compute_correlograms():
     assert np.array_equal(correlograms[(1, 0)], c10)
     
     # print (correlograms[(0, 1)], c01)
-    
\ No newline at end of file
+        
+def test_compute_correlograms_relative():
+    train0 = np.array(np.arange(0., 10., .1), dtype=np.float64)
+    spiketimes = np.hstack((train0, train0 + .0015))
+    # Large cluster indices: only the selected pairs should be allocated.
+    clusters = np.hstack((100000 * np.ones(len(train0), dtype=np.int32),
+                          200000 * np.ones(len(train0), dtype=np.int32)))
+    indices_sorting = np.argsort(spiketimes)
+    spiketimes = spiketimes[indices_sorting]
+    clusters = clusters[indices_sorting]
+
+    correlograms = compute_correlograms(spiketimes, clusters,
+        clusters_to_update=np.array([100000], dtype=np.int32),
+        ncorrbins=20, corrbin=.001)
+    
+    assert sorted(correlograms.keys()) == [(100000, 100000), 
+        (100000, 200000), (200000, 100000)]
+    
+    c01 = np.zeros(20, dtype=np.int32)
+    c01[11] = 100
+    
+    c10 = np.zeros(20, dtype=np.int32)
+    c10[8] = 100
+    
+    assert np.array_equal(correlograms[(100000, 100000)], np.zeros(20))
+    assert np.array_equal(correlograms[(100000, 200000)], c01)
+    assert np.array_equal(correlograms[(200000, 100000)], c10)
+
+def test_compute_correlograms_numpy():
+    spiketimes = np.sort(np.random.rand(2000) * 2.)
+    # Include some synchronous spikes.
+    spiketimes[1::100] = spiketimes[::100]
+    clusters = np.random.randint(low=0, high=5, size=2000).astype(np.int32)
+    clusters_to_update = np.array([1, 3], dtype=np.int32)
+    
+    for clu in (None, clusters_to_update):
+        correlograms0 = compute_correlograms_python(spiketimes, clusters,
+            clusters_to_update=clu, ncorrbins=20, corrbin=.001)
+        correlograms1 = compute_correlograms_numpy(spiketimes, clusters,
+            clusters_to_update=clu, ncorrbins=20, corrbin=.001)
+        
+        assert sorted(correlograms0.keys()) == sorted(correlograms1.keys())
+        for key in correlograms0.keys():
+            assert np.array_equal(correlograms0[key], correlograms1[key])
+
+def test_compute_correlograms_parallel():
+    spiketimes = np.sort(np.random.rand(10000) * 10.)
+    clusters = np.random.randint(low=0, high=5, size=10000).astype(np.int32)
+    clusters_to_update = np.array([1, 3], dtype=np.int32)
+    
+    spiketimes_excerpts = split_excerpts(spiketimes, nexcerpts=10, 
+        excerpt_size=500)
+    clusters_excerpts = split_excerpts(clusters, nexcerpts=10, 
+        excerpt_size=500)
+    
+    correlograms0 = compute_correlograms_parallel(spiketimes_excerpts, 
+        clusters_excerpts, clusters_to_update=clusters_to_update,
+        ncorrbins=20, corrbin=.001)
+    pool = Pool(2)
+    correlograms1 = compute_correlograms_parallel(spiketimes_excerpts, 
+        clusters_excerpts, clusters_to_update=clusters_to_update,
+        ncorrbins=20, corrbin=.001, pool=pool, nchunks=2)
+    pool.close()
+    pool.join()
+    
+    assert sorted(correlograms0.keys()) == sorted(correlograms1.keys())
+    for key in correlograms0.keys():
+        assert np.array_equal(correlograms0[key], correlograms1[key])
+    
+def test_compute_correlograms_cancelled():
+    spiketimes = np.sort(np.random.rand(10000) * 10.)
+    clusters = np.random.randint(low=0, high=5, size=10000).astype(np.int32)
+    clusters_to_update = np.array([1, 3], dtype=np.int32)
+    
+    spiketimes_excerpts = split_excerpts(spiketimes, nexcerpts=10, 
+        excerpt_size=500)
+    clusters_excerpts = split_excerpts(clusters, nexcerpts=10, 
+        excerpt_size=500)
+    
+    correlograms0 = compute_correlograms_parallel(spiketimes_excerpts, 
+        clusters_excerpts, clusters_to_update=clusters_to_update,
+        ncorrbins=20, corrbin=.001)
+    # Chunks processed one after the other.
+    correlograms1 = compute_correlograms_parallel(spiketimes_excerpts, 
+        clusters_excerpts, clusters_to_update=clusters_to_update,
+        ncorrbins=20, corrbin=.001, cancelled=lambda: False)
+    assert sorted(correlograms0.keys()) == sorted(correlograms1.keys())
+    for key in correlograms0.keys():
+        assert np.array_equal(correlograms0[key], correlograms1[key])
+    
+    # Cancelled after the third chunk.
+    nchecks = []
+    def cancelled():
+        nchecks.append(None)
+        return len(nchecks) > 3
+    assert compute_correlograms_parallel(spiketimes_excerpts, 
+        clusters_excerpts, clusters_to_update=clusters_to_update,
+        ncorrbins=20, corrbin=.001, cancelled=cancelled) is None
+    assert len(nchecks) == 4
+    
+def test_compute_correlograms_samples():
+    freq = 20000
+    spiketimes = np.sort(np.random.randint(low=0, high=2 * freq, 
+        size=2000)).astype(np.uint64)
+    clusters = np.random.randint(low=0, high=5, size=2000).astype(np.int32)
+    clusters_to_update = np.array([1, 3], dtype=np.int32)
+    
+    for clu in (None, clusters_to_update):
+        # Spike times and bin size in samples.
+        correlograms0 = compute_correlograms(spiketimes, clusters,
+            clusters_to_update=clu, ncorrbins=20, corrbin=20)
+        correlograms1 = compute_correlograms_python(spiketimes, clusters,
+            clusters_to_update=clu, ncorrbins=20, corrbin=20)
+        correlograms2 = compute_correlograms_numpy(spiketimes, clusters,
+            clusters_to_update=clu, ncorrbins=20, corrbin=20)
+        
+        assert sorted(correlograms0.keys()) == sorted(correlograms1.keys())
+        for key in correlograms0.keys():
+            assert np.array_equal(correlograms0[key], correlograms1[key])
+            assert np.array_equal(correlograms0[key], correlograms2[key])
+    
+    # Delays falling exactly on a bin edge.
+    train0 = np.arange(0, 20 * freq, 2000, dtype=np.uint64)
+    spiketimes = np.hstack((train0, train0 + 20))
+    clusters = np.hstack((np.zeros(len(train0), dtype=np.int32),
+                          np.ones(len(train0), dtype=np.int32)))
+    indices_sorting = np.argsort(spiketimes)
+    correlograms = compute_correlograms(spiketimes[indices_sorting], 
+        clusters[indices_sorting], ncorrbins=20, corrbin=20)
+    
+    c01 = np.zeros(20, dtype=np.int32)
+    c01[11] = 200
+    assert np.array_equal(correlograms[(0, 1)], c01)
+    assert np.array_equal(correlograms[(1, 0)], c01[::-1])
+    
+def test_compute_correlograms_stream():
+    spiketimes = np.sort(np.random.rand(3000) * 2.)
+    # Include some synchronous spikes.
+    spiketimes[1::100] = spiketimes[::100]
+    clusters = np.random.randint(low=0, high=5, size=3000).astype(np.int32)
+    clusters_to_update = np.array([1, 3], dtype=np.int32)
+    
+    for clu in (None, clusters_to_update):
+        correlograms0 = compute_correlograms_numpy(spiketimes, clusters,
+            clusters_to_update=clu, ncorrbins=20, corrbin=.001)
+        progress = []
+        # Chunks shorter than the correlogram window.
+        correlograms1 = compute_correlograms_stream(spiketimes, clusters,
+            clusters_to_update=clu, ncorrbins=20, corrbin=.001,
+            chunk_size=7, progress=lambda *args: progress.append(args))
+        
+        assert progress[-1] == (3000, 3000)
+        assert sorted(correlograms0.keys()) == sorted(correlograms1.keys())
+        for key in correlograms0.keys():
+            assert np.array_equal(correlograms0[key], correlograms1[key])
+
+def test_rebin_correlograms():
+    freq = 20000.
+    spiketimes = np.sort(np.random.randint(low=0, high=5 * freq, 
+        size=3000)).astype(np.uint64)
+    clusters = np.random.randint(low=0, high=4, size=3000).astype(np.int32)
+    
+    # Base binning: 5 samples, 80 bins.
+    correlograms_base = compute_correlograms(spiketimes, clusters,
+        ncorrbins=80, corrbin=5)
+    for ncorrbins, corrbin in [(80, 5), (40, 10), (20, 20), (10, 10)]:
+        factor = get_rebin_factor(ncorrbins, corrbin, 80, 5)
+        correlograms = compute_correlograms(spiketimes, clusters,
+            ncorrbins=ncorrbins, corrbin=corrbin)
+        for key in correlograms.keys():
+            assert np.array_equal(rebin_correlograms(correlograms_base[key],
+                factor, ncorrbins), correlograms[key])
+    
+    # Binnings that cannot be derived from the base binning.
+    assert get_rebin_factor(80, 10, 80, 5) is None
+    assert get_rebin_factor(20, 7, 80, 5) is None
+    assert get_rebin_factor(21, 5, 80, 5) is None
+    
+def test_get_base_binning():
+    assert get_base_binning(100, 20) == (100, 20)
+    assert get_base_binning(100, 20, corrbin_base=10) == (200, 10)
+    assert get_base_binning(100, 20, corrbin_base=10, 
+        ncorrbins_base=400) == (400, 10)
+    # The base bin size must divide the bin size.
+    assert get_base_binning(100, 20, corrbin_base=7) == (100, 20)
+    # The widest window keeps its width with the larger bins: 193 bins of
+    # 13 samples, i.e. 101 bins of 25 samples.
+    assert get_base_binning(100, 25, corrbin_base=13, 
+        ncorrbins_base=386) == (202, 25)
+    assert get_base_binning(100, 26, corrbin_base=13, 
+        ncorrbins_base=386) == (386, 13)
+    
@@ -4,9 +4,11 @@
 # Imports
 # -----------------------------------------------------------------------------
 from nose.tools import raises
+from nose import SkipTest
 import numpy as np
 
-from klustaviewa.stats.indexed_matrix import IndexedMatrix, CacheMatrix
+from klustaviewa.stats.indexed_matrix import (IndexedMatrix, CacheMatrix,
+    SparseCacheMatrix, MatrixBlock, sparse)
 
 
 # -----------------------------------------------------------------------------
@@ -156,6 +158,37 @@ def test_indexed_matrix_10():
     assert submatrix.shape == (2, 2, 10)
     assert np.array_equal(submatrix.to_array()[0, 1, ...], 2 * np.ones(10))
     
+def test_indexed_matrix_submatrix_view():
+    indices = [2, 3, 5, 7]
+    matrix = IndexedMatrix(indices=indices, shape=(4, 4, 10))
+    matrix[indices, indices] = np.random.rand(4, 4, 10)
+    
+    # Contiguous slots: read-only view on the storage.
+    submatrix = matrix.submatrix([5, 3])
+    assert np.array_equal(submatrix.indices, [3, 5])
+    assert np.may_share_memory(submatrix.to_array(), matrix._data)
+    assert not submatrix.to_array().flags.writeable
+    assert np.array_equal(submatrix.to_array(), matrix[[3, 5], [3, 5]])
+    assert np.array_equal(submatrix[5, 3], matrix[5, 3])
+    
+    # Non-contiguous slots: gathered copy.
+    submatrix = matrix.submatrix([2, 7])
+    assert not np.may_share_memory(submatrix.to_array(), matrix._data)
+    assert np.array_equal(submatrix.to_array(), matrix[[2, 7], [2, 7]])
+    
+    # The slot of a removed index is reused by a new index.
+    matrix.remove_indices([3])
+    matrix.add_indices([11])
+    submatrix = matrix.submatrix([11, 2])
+    assert np.array_equal(submatrix.indices, [2, 11])
+    assert np.array_equal(submatrix.to_array(), matrix[[2, 11], [2, 11]])
+    
+    try:
+        matrix.submatrix([2, 3])
+        assert False
+    except IndexError:
+        pass
+    
     
 # -----------------------------------------------------------------------------
 # Cache matrix tests
@@ -207,4 +240,178 @@ def test_cache_matrix_2():
     assert np.array_equal(matrix.not_in_key_indices(indices), [])
     
     
-    
\ No newline at end of file
+        
+def test_cache_matrix_merge():
+    indices = [2, 3, 5, 7]
+    matrix = CacheMatrix(shape=(0, 0, 3))
+    
+    d = {(i, j): np.array([i, j, 1]) for i in indices for j in indices}
+    matrix.update([2, 3, 5], d)
+    
+    # 7 is not a key index, so the merge is not possible.
+    assert not matrix.merge([5, 7], 8)
+    assert np.array_equal(matrix.indices, indices)
+    
+    assert matrix.merge([2, 5], 8)
+    assert np.array_equal(matrix.indices, [3, 7, 8])
+    assert np.array_equal(matrix.not_in_key_indices([3, 7, 8]), [7])
+    
+    assert np.array_equal(matrix[8, 3], [7, 6, 2])
+    assert np.array_equal(matrix[3, 8], [6, 7, 2])
+    assert np.array_equal(matrix[8, 7], [7, 14, 2])
+    assert np.array_equal(matrix[8, 8], [14, 14, 4])
+    assert np.array_equal(matrix[3, 7], [3, 7, 1])
+
+    
+def test_indexed_matrix_slots():
+    matrix = IndexedMatrix(shape=(0, 0, 2))
+    # Reference values: (i, j) => [i, j].
+    def check():
+        indices = matrix.indices
+        expected = np.zeros((len(indices), len(indices), 2))
+        expected[..., 0] = indices.reshape((-1, 1))
+        expected[..., 1] = indices.reshape((1, -1))
+        assert np.array_equal(matrix.to_array(), expected)
+    def fill(indices):
+        matrix.add_indices(indices)
+        for i in indices:
+            matrix[i, :] = np.dstack(np.broadcast_arrays(i, 
+                matrix.indices))[0]
+            matrix[:, i] = np.dstack(np.broadcast_arrays(matrix.indices, 
+                i))[0]
+    
+    fill([4, 2, 9])
+    check()
+    capacity = matrix.capacity
+    fill([5, 1])
+    check()
+    # The capacity is doubled when needed.
+    assert matrix.capacity == 2 * capacity
+    
+    # The slots of the removed indices are reused.
+    matrix.remove_indices([2, 9])
+    check()
+    capacity = matrix.capacity
+    fill([3, 12])
+    check()
+    assert matrix.capacity == capacity
+    assert np.array_equal(matrix.indices, [1, 3, 4, 5, 12])
+
+    
+def test_indexed_matrix_setitem_block():
+    indices = [2, 3, 5, 7, 11]
+    matrix = IndexedMatrix(indices=indices, shape=(5, 5, 3))
+    expected = np.zeros((5, 5, 3))
+    
+    value = np.random.rand(2, 3, 3)
+    matrix[[7, 2], [3, 11, 5]] = value
+    expected[np.ix_([3, 0], [1, 4, 2])] = value
+    assert np.array_equal(matrix.to_array(), expected)
+    
+    # Scalar and broadcast values.
+    matrix[[3, 5], [2, 3]] = 4
+    expected[np.ix_([1, 2], [0, 1])] = 4
+    matrix[[11], :] = np.arange(3)
+    expected[4, :] = np.arange(3)
+    assert np.array_equal(matrix.to_array(), expected)
+    
+def test_cache_matrix_lookup():
+    matrix = CacheMatrix()
+    matrix.update([3, 10], {(3, 10): 1., (10, 3): 2., (3, 3): 3.})
+    assert matrix.not_in_indices([10, 2, 3, 100]) == [2, 100]
+    assert matrix.not_in_key_indices([10, 2, 3, 100]) == [2, 100]
+    assert np.array_equal(matrix.to_relative([10, 3]), [1, 0])
+    
+    matrix.invalidate(3)
+    matrix.update([1], {(1, 10): 4., (10, 1): 5.})
+    assert matrix.not_in_indices([10, 1, 3]) == [3]
+    assert matrix.not_in_key_indices([10, 1, 3]) == [3]
+    assert matrix.key_indices == [1, 10]
+    assert matrix[10, 1] == 5.
+    assert np.array_equal(matrix.to_relative([10, 1]), [1, 0])
+
+
+# -----------------------------------------------------------------------------
+# Matrix block tests
+# -----------------------------------------------------------------------------
+def test_matrix_block():
+    rows, columns = [5, 2], [2, 3, 5]
+    data = np.random.randint(size=(2, 3, 4), low=0, high=10)
+    block = MatrixBlock(rows, columns, data, mirror='reversed')
+    
+    assert len(block) == 8
+    assert sorted(block.keys()) == sorted(set(block.keys()))
+    assert np.array_equal(block[5, 3], data[0, 1])
+    assert np.array_equal(block[3, 5], data[0, 1][::-1])
+    assert np.array_equal(block[2, 5], data[1, 2])
+    assert (3, 3) not in block
+    
+    block = MatrixBlock(rows, columns, data)
+    assert len(block) == 6
+    assert (3, 5) not in block
+    
+def test_cache_matrix_block():
+    indices = [2, 3, 5, 7]
+    rows = [7, 3]
+    data = np.random.randint(size=(2, 4, 3), low=0, high=10)
+    block = MatrixBlock(rows, indices, data, mirror='reversed')
+    
+    # Same result as with the equivalent dictionary.
+    matrix0 = CacheMatrix(shape=(0, 0, 3))
+    matrix0.update(rows, dict(block.iteritems()))
+    matrix1 = CacheMatrix(shape=(0, 0, 3))
+    matrix1.update(rows, block)
+    
+    assert np.array_equal(matrix1.indices, indices)
+    assert np.array_equal(matrix1.not_in_key_indices(indices), [2, 5])
+    assert np.array_equal(matrix0.to_array(), matrix1.to_array())
+    
+
+# -----------------------------------------------------------------------------
+# Sparse cache matrix tests
+# -----------------------------------------------------------------------------
+def test_sparse_cache_matrix():
+    if sparse is None:
+        raise SkipTest("scipy is not available.")
+    indices = [2, 3, 5, 7]
+    rows = [7, 3]
+    data = np.random.rand(2, 4)
+    data[data < .5] = 0
+    block = MatrixBlock(rows, indices, data)
+    
+    matrix0 = CacheMatrix()
+    matrix1 = SparseCacheMatrix()
+    for matrix in (matrix0, matrix1):
+        matrix.update(rows, block)
+        matrix.update([2], {(2, 2): 1., (2, 7): 0., (11, 2): 3.})
+    
+    assert sparse.issparse(matrix1.to_array())
+    assert np.array_equal(matrix0.indices, matrix1.indices)
+    assert np.array_equal(matrix0.key_indices, matrix1.key_indices)
+    assert np.array_equal(matrix0.to_array(), matrix1.to_array().toarray())
+    assert np.array_equal(matrix0[3, :], matrix1[3, :])
+    assert np.array_equal(matrix0[[2, 5], 7], matrix1[[2, 5], 7])
+    
+    # Only the non-null values are stored.
+    assert matrix1.to_array().nnz == np.sum(matrix0.to_array() != 0)
+    
+    for matrix in (matrix0, matrix1):
+        matrix.invalidate([3, 11])
+        matrix[5, [2, 7]] = [4., 5.]
+    assert np.array_equal(matrix1.indices, [2, 5, 7])
+    assert np.array_equal(matrix0.to_array(), matrix1.to_array().toarray())
+    assert np.array_equal(matrix0.submatrix([5, 7]).to_array(),
+        matrix1.submatrix([5, 7]).to_array())
+    
+    # Symmetric pairs, with dense and sparse block values.
+    data = np.random.rand(2, 4)
+    data[data < .5] = 0
+    for matrix in (matrix0, matrix1):
+        matrix.update([2, 13], MatrixBlock([2, 13], [2, 5, 7, 13], data, 
+            mirror='same'))
+    assert np.array_equal(matrix0.to_array(), matrix1.to_array().toarray())
+    matrix1.update([2, 13], MatrixBlock([2, 13], [2, 5, 7, 13], 
+        sparse.csr_matrix(data), mirror='same'))
+    assert np.array_equal(matrix0.to_array(), matrix1.to_array().toarray())
+    assert matrix1.to_array().nnz == np.sum(matrix0.to_array() != 0)
+
@@ -69,6 +69,40 @@ def get_histogram_points(hist):
     
     return x, y
 
+def set_histogram_points(y, hist):
+    """Update in place the y coordinates of tesselated correlograms.
+    
+    Arguments:
+      * y: a N x (5*Nsamples+1) array, as returned by get_histogram_points.
+      * hist: a N x Nsamples array, where each line contains an histogram.
+      
+    """
+    y[:,1::5] = hist
+    y[:,2::5] = hist
+
+def get_normalization_factors(correlograms, normalization='row'):
+    """Return the factors dividing the correlograms and the baselines.
+    
+    Arguments:
+      * correlograms: a N x N x Nsamples array.
+      * normalization: 'row' to fit every row of correlograms in the
+        window, or 'uniform' to fit every correlogram.
+      
+    Returns:
+      * correlograms_factors, baselines_factors: arrays broadcastable to the
+        correlograms and the baselines.
+      
+    """
+    n = correlograms.shape[0]
+    if normalization == 'row':
+        M = correlograms.reshape((n, -1)).max(axis=1).reshape((n, 1))
+    elif normalization == 'uniform':
+        M = correlograms.max(axis=2)
+    else:
+        M = np.ones((n, 1))
+    M = np.where(M > 0, M, 1)
+    return M.reshape(M.shape + (1,)), M
+    
     
 # -----------------------------------------------------------------------------
 # Data manager
@@ -93,12 +127,13 @@ class CorrelogramsDataManager(Manager):
             # clusters_selected=clusters_selected, ncorrbins=ncorrbins)
         self.correlograms = correlograms
         
-        # Copy the original arrays for normalization.
-        self.baselines = baselines
-        self.baselines0 = baselines.copy()
+        # Keep the original arrays for normalization, which writes into
+        # separate buffers.
+        self.baselines0 = np.asarray(baselines, dtype=np.float64)
+        self.baselines = np.empty_like(self.baselines0)
         
-        self.correlograms_array = correlograms.to_array()
-        self.correlograms_array0 = self.correlograms_array.copy()
+        self.correlograms_array0 = correlograms.to_array()
+        self.correlograms_array = np.empty(self.correlograms_array0.shape)
         
         nclusters, nclusters, self.nbins = self.correlograms_array.shape
         self.ncorrelograms = nclusters * nclusters
@@ -134,6 +169,14 @@ class CorrelogramsDataManager(Manager):
         # index 0 = heterogeneous clusters, index>0 ==> cluster index + 1
         # self.cluster_colors = get_array(cluster_colors)
         
+        # vertex positions of the correlograms: x only depends on the
+        # number of bins, y is updated in place by normalize
+        X, Y = get_histogram_points(np.zeros((self.ncorrelograms, self.nbins)))
+        self.nsamples = X.shape[1]
+        self.position = np.zeros((X.size, 2), dtype=np.float32)
+        self.position[:,0] = X.ravel()
+        self.position_y = np.zeros(X.shape, dtype=np.float32)
+        
         # normalize and update the data position
         self.normalize(normalization)
     
@@ -156,39 +199,18 @@ class CorrelogramsDataManager(Manager):
             self.nsamples, axis=0)
         
     def normalize(self, normalization='row'):
-        self.correlograms_array = self.correlograms_array0.copy()
-        self.baselines = self.baselines0.copy()
-        if normalization == 'row':
-            # normalization
-            for i in range(self.nclusters):
-                # divide all correlograms in the row by the max of this histogram
-                correlogram_diagonal = self.correlograms_array[i, i, ...]
-                m = correlogram_diagonal.max()
-                if m > 0:
-                    self.correlograms_array[i,:,:] /= m
-                    self.baselines[i,:] /= m
-                # normalize all correlograms in the row so that they all fit in the 
-                # window
-                m = self.correlograms_array[i,:,:].max()
-                if m > 0:
-                    self.correlograms_array[i,:,:] /= m
-                    self.baselines[i,:] /= m
-        elif normalization == 'uniform':
-            M = self.correlograms_array.max(axis=2)
-            self.correlograms_array /= M.reshape(
-                (self.nclusters, self.nclusters, 1))
-            self.baselines /= M
+        if self.ncorrelograms == 0:
+            return
+        factors, baselines_factors = get_normalization_factors(
+            self.correlograms_array0, normalization)
+        np.divide(self.correlograms_array0, factors, 
+            out=self.correlograms_array)
+        np.divide(self.baselines0, baselines_factors, out=self.baselines)
     
-        # get the vertex positions
-        X, Y = get_histogram_points(self.correlograms_array.reshape(
+        # update the vertex positions in place
+        set_histogram_points(self.position_y, self.correlograms_array.reshape(
             (self.ncorrelograms, self.nbins)))
-        n = X.size
-        self.nsamples = X.shape[1]
-        
-        # fill the data array
-        self.position = np.empty((n, 2), dtype=np.float32)
-        self.position[:,0] = X.ravel()
-        self.position[:,1] = Y.ravel()
+        self.position[:,1] = self.position_y.ravel()
         
      
 # -----------------------------------------------------------------------------
@@ -342,6 +364,16 @@ class CorrelogramsPaintManager(PlotPaintManager):
             depth=-1,
             visible=False)
         
+    def update_normalization(self):
+        """Only upload the new vertex positions of the correlograms."""
+        self.set_data(position=self.data_manager.position, 
+            visual='correlograms')
+        self.reinitialize_visual(
+            baselines=self.data_manager.baselines,
+            nclusters=self.data_manager.nclusters,
+            clusters=self.data_manager.clusters0,
+            visual='baselines')
+        
     def update(self):
         self.reinitialize_visual(
             # size=self.data_manager.position.shape[0],
@@ -439,7 +471,7 @@ class CorrelogramsInteractionManager(PlotInteractionManager):
                 len(self.normalization_list))
             normalization = self.normalization_list[self.normalization_index]
         self.data_manager.normalize(normalization)
-        self.paint_manager.update()
+        self.paint_manager.update_normalization()
         self.parent.updateGL()
     
         
@@ -85,6 +85,9 @@ class SimilarityMatrixDataManager(Manager):
         if similarity_matrix is None:
             similarity_matrix = np.zeros(0)
             cluster_colors_full = np.zeros(0)
+        # The texture needs a dense matrix.
+        if hasattr(similarity_matrix, 'toarray'):
+            similarity_matrix = similarity_matrix.toarray()
         
         if similarity_matrix.size == 0:
             similarity_matrix = -np.ones((2, 2))
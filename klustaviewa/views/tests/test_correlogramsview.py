@@ -17,6 +17,7 @@ from kwiklib.dataio.selection import select
 from kwiklib.dataio.tools import check_dtype, check_shape
 from klustaviewa import USERPREF
 from klustaviewa.views import CorrelogramsView
+from klustaviewa.views.correlogramsview import get_normalization_factors
 from klustaviewa.views.tests.utils import show_view, get_data
 
 
@@ -45,4 +46,21 @@ def test_correlogramsview():
     # Show the view.
     show_view(CorrelogramsView, **kwargs)
     
-    
\ No newline at end of file
+def test_normalization_factors():
+    correlograms = rnd.rand(3, 3, 10)
+    correlograms[0, 1, :] = 0
+    
+    factors, baselines_factors = get_normalization_factors(correlograms,
+        'row')
+    normalized = correlograms / factors
+    assert np.allclose(normalized.reshape((3, -1)).max(axis=1), 1)
+    assert baselines_factors.shape == (3, 1)
+    
+    factors, baselines_factors = get_normalization_factors(correlograms,
+        'uniform')
+    normalized = correlograms / factors
+    assert np.allclose(normalized.max(axis=2)[1:, :], 1)
+    # Empty correlograms are left unchanged.
+    assert np.array_equal(normalized[0, 1, :], np.zeros(10))
+    assert baselines_factors.shape == (3, 3)
+    
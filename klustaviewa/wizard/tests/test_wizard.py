@@ -64,6 +64,31 @@ def test_wizard():
     t1 = w.current_target()
     assert t0 != t1
     
+def test_wizard_upcoming():
+    
+    # Create mock data.
+    clusters = create_clusters(nspikes, nclusters)
+    cluster_groups = create_cluster_groups(nclusters)
+    similarity_matrix = create_similarity_matrix(nclusters)
+    
+    # Initialize the wizard.
+    w = Wizard()
+    assert w.upcoming_clusters() == []
+    w.set_data(similarity_matrix=similarity_matrix,
+               cluster_groups=cluster_groups)
+    w.update_candidates()
+    
+    upcoming = w.upcoming_clusters()
+    assert upcoming[0] == w.current_target()
+    assert upcoming[1] == w.current_candidate()
+    
+    # The skipped candidates are not upcoming anymore.
+    c0 = w.next_candidate()
+    c1 = w.next_candidate()
+    upcoming = w.upcoming_clusters()
+    assert c0 not in upcoming
+    assert upcoming[1] == c1
+    
 def test_wizard_merge():
     
     # Create mock data.
@@ -21,6 +21,14 @@ def unique(seq):
     seen_add = seen.add
     return [x for x in seq if x not in seen and not seen_add(x)]
 
+def get_row_column(matrix, index):
+    """Return dense copies of a row and a column of a dense array or a 
+    scipy sparse matrix."""
+    if hasattr(matrix, 'toarray'):
+        return (matrix[index, :].toarray().ravel(),
+                matrix[:, index].toarray().ravel())
+    return matrix[index, :].copy(), matrix[:, index].copy()
+
     
 # -----------------------------------------------------------------------------
 # Wizard
@@ -56,7 +64,8 @@ class Wizard(object):
             self.clusters_unique = get_array(get_indices(cluster_groups))
             self.cluster_groups = get_array(cluster_groups)
             
-        if (similarity_matrix is not None and similarity_matrix.size > 0):
+        if (similarity_matrix is not None and 
+            np.prod(similarity_matrix.shape) > 0):
 
             if len(get_array(cluster_groups)) != similarity_matrix.shape[0]:
                 log.warn(("Cannot update the wizard: cluster_groups "
@@ -65,7 +74,9 @@ class Wizard(object):
                 return
 
             self.matrix = similarity_matrix
-            self.quality = np.diag(self.matrix)
+            # The similarity matrix may be a dense array or a scipy sparse
+            # matrix.
+            self.quality = self.matrix.diagonal()
             
         
     
@@ -99,16 +110,17 @@ class Wizard(object):
         
         hidden = self.cluster_groups <= 1
         
-        # Hide values in the matrix for hidden clusters.
-        matrix = self.matrix.copy()
-        matrix[hidden, :] = -1
-        matrix[:, hidden] = -1
-        n = matrix.shape[0]
+        # Hide values in the target row and column for hidden clusters.
+        row, column = get_row_column(self.matrix, target_rel)
+        if hidden[target_rel]:
+            row[:] = -1
+            column[:] = -1
+        row[hidden] = -1
+        column[hidden] = -1
+        n = self.matrix.shape[0]
         
         # Sort all neighbor clusters.
-        clusters_rel = np.argsort(
-            np.hstack((matrix[target_rel, :],
-                       matrix[:, target_rel])))[::-1] % n
+        clusters_rel = np.argsort(np.hstack((row, column)))[::-1] % n
                        
         # Remove duplicates and preserve the order.
         clusters_rel = unique(clusters_rel)
@@ -147,6 +159,16 @@ class Wizard(object):
     def reset_skipped(self):
         self.skipped = []
         
+    def upcoming_clusters(self):
+        """Return the clusters that are likely to be shown next: the current
+        target, followed by its next candidates by decreasing similarity."""
+        target = self.current_target()
+        if target is None:
+            return []
+        candidates = [candidate for candidate in self.candidates[self.index:]
+            if candidate not in self.skipped]
+        return [target] + candidates
+        
     
     # Navigation methods.
     # -------------------